@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+
+FILENAME = 'blob'
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def worker(root, source, base_id, mode, chunks, chunk_size, size):
+    downloader_id, seeder_id = base_id, base_id + 1
+    create_network(root, {downloader_id: 10 ** 12, seeder_id: 10 ** 12}, {downloader_id: [seeder_id], seeder_id: [downloader_id]})
+
+    for c in range(chunks):
+        os.link(source / f'{FILENAME}.ch{c}', root / str(seeder_id) / f'{FILENAME}.ch{c}')
+
+    (root / str(downloader_id) / f'{FILENAME}.p2p').write_text(f'{FILENAME}\n{chunks}\n1\n{size}\n{chunk_size}\n')
+
+    Constants.ASSEMBLY_MODE = mode
+    Constants.UDP_CLIENT_GRACE_PERIOD = 0
+
+    downloader = Peer(downloader_id)
+    Peer(seeder_id)
+
+    baseline = peak_rss()
+    start = time.perf_counter()
+
+    succeeded = downloader.run(f'{FILENAME}.p2p')
+
+    return {
+        'mode': mode,
+        'succeeded': succeeded,
+        'elapsed': time.perf_counter() - start,
+        'baseline_rss': baseline,
+        'peak_rss': peak_rss()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare wall time and peak RSS of positional assembly and chunk concatenation.')
+    parser.add_argument('--size', type=int, default=1024, help='file size in MB')
+    parser.add_argument('--chunks', type=int, default=4)
+    parser.add_argument('--worker', choices=['positional', 'concatenate'], help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    parser.add_argument('--base-id', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    chunk_size = -(-size // args.chunks)
+
+    if args.worker:
+        with quiet():
+            result = worker(Path(args.root) / args.worker, Path(args.root) / 'source', args.base_id, args.worker, args.chunks, chunk_size, size)
+
+        report(json.dumps(result))
+        return
+
+    with quiet():
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / 'source'
+            os.makedirs(source)
+
+            for c in range(args.chunks):
+                write_random_file(source / f'{FILENAME}.ch{c}', min(chunk_size, size - c * chunk_size))
+
+            for i, mode in enumerate(('concatenate', 'positional')):
+                output = subprocess.run(
+                    [sys.executable, __file__, '--size', str(args.size), '--chunks', str(args.chunks), '--worker', mode, '--root', tmp, '--base-id', str(i * 2)],
+                    check=True, capture_output=True, text=True
+                ).stdout
+
+                r = json.loads(output.strip().splitlines()[-1])
+
+                report(f"{r['mode']:>11}: {args.size} MB in {args.chunks} chunks, {r['elapsed']:.2f}s, peak RSS {r['peak_rss'] / 2 ** 20:.0f} MB (baseline {r['baseline_rss'] / 2 ** 20:.0f} MB)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import random
+import time
+import tracemalloc
+
+from fixtures import quiet, report
+
+from utils import bitfield
+from models.availability import AvailabilityTable
+
+def responses(chunks, responders):
+    # A quarter of the responders are seeders, the others hold a random half of the chunks; each has its own sending time
+    result = []
+    for r in range(responders):
+        chunk_set = bitfield.from_range(0, chunks) if r % 4 == 0 else random.getrandbits(chunks)
+        result.append((('10.0.0.1', 4000 + r), {random.randint(1, 1000): chunk_set}))
+
+    return result
+
+def merge_table(chunks, announced):
+    table = AvailabilityTable(chunks)
+
+    for source, chunk_times in announced:
+        table.merge(source, chunk_times)
+
+    return table
+
+def merge_dicts(chunks, announced):
+    # The previous layout: the best source of every chunk, and every source advertising it with its time
+    buffer = [None] * (chunks + 1)
+    advertisers = [{} for _ in range(chunks + 1)]
+
+    for (address, port), chunk_times in announced:
+        for sending_time, chunk_set in chunk_times.items():
+            for c in bitfield.chunks(chunk_set):
+                advertisers[c][(address, port)] = sending_time
+
+                if not buffer[c] or buffer[c]['time'] > sending_time:
+                    buffer[c] = {'chunk': c, 'address': address, 'port': port, 'time': sending_time}
+
+    return buffer, advertisers
+
+def measure(merge, chunks, announced):
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    result = merge(chunks, announced)
+
+    elapsed = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, memory
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory and merge time of chunk availability for many chunks and responders.')
+    parser.add_argument('--chunks', type=int, default=100_000)
+    parser.add_argument('--responders', type=int, default=1000)
+    parser.add_argument('--dict-responders', type=int, default=10, help='responders merged into the previous per-chunk dicts, whose cost is extrapolated')
+    args = parser.parse_args()
+
+    with quiet():
+        random.seed(0)
+        announced = responses(args.chunks, args.responders)
+
+        # Merging into the table is timed without allocation tracing, which slows down every allocation
+        start = time.perf_counter()
+        table = merge_table(args.chunks, announced)
+        elapsed = time.perf_counter() - start
+
+        _, _, memory = measure(merge_table, args.chunks, announced)
+
+        start = time.perf_counter()
+        rarest = table.rarest(table.located)
+        query = time.perf_counter() - start
+
+        rarest_chunks = bitfield.chunks(rarest)
+
+        report(f'     table: {args.chunks} chunks x {args.responders} responders merged in {elapsed:.2f}s ({elapsed / args.responders * 1000:.2f} ms per response), {memory / 2 ** 20:.1f} MB')
+        report(f'            {"all" if table.all_located() else "not all"} chunks located, {len(rarest_chunks)} rarest chunks found in {query * 1000:.2f} ms, with {table.availability(rarest_chunks[0])} sources each')
+
+        subset = announced[:args.dict_responders]
+        start = time.perf_counter()
+        merge_dicts(args.chunks, subset)
+        elapsed = time.perf_counter() - start
+
+        _, _, memory = measure(merge_dicts, args.chunks, subset)
+        scale = args.responders / len(subset)
+
+        report(f'     dicts: {args.chunks} chunks x {len(subset)} responders merged in {elapsed:.2f}s ({elapsed / len(subset) * 1000:.2f} ms per response), {memory / 2 ** 20:.1f} MB')
+        report(f'            about {elapsed * scale:.0f}s and {memory * scale / 2 ** 30:.1f} GB for {args.responders} responders')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+
+def benchmark(root, base_id, files, chunks, chunk_size, pool, depth):
+    downloader_id, seeder_id = base_id, base_id + 1
+    create_network(root, {downloader_id: 10 ** 12, seeder_id: 10 ** 12}, {downloader_id: [seeder_id], seeder_id: [downloader_id]})
+
+    for f in range(files):
+        for c in range(chunks):
+            write_random_file(root / str(seeder_id) / f'file{f}.ch{c}', chunk_size)
+
+        (root / str(downloader_id) / f'file{f}.p2p').write_text(f'file{f}\n{chunks}\n1\n{chunks * chunk_size}\n{chunk_size}\n')
+
+    Constants.TCP_CONNECTION_POOL = pool
+    Constants.REQUEST_PIPELINE_DEPTH = depth
+
+    downloader = Peer(downloader_id)
+    Peer(seeder_id)
+
+    pool = downloader.async_connection_pool if Constants.TRANSFER_MODE == 'asyncio' else downloader.connection_pool
+
+    start = time.perf_counter()
+    succeeded = sum(downloader.run(f'file{f}.p2p') for f in range(files))
+    elapsed = time.perf_counter() - start
+
+    return succeeded, elapsed, pool.opened, pool.reused
+
+def main():
+    parser = argparse.ArgumentParser(description='Download many small-chunk files in a row with and without connection reuse and request pipelining.')
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--chunks', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads')
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.TRANSFER_MODE = args.mode
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0
+
+        configurations = [(False, 1), (True, 1), (True, 4), (True, 16)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, (pool, depth) in enumerate(configurations):
+                succeeded, elapsed, opened, reused = benchmark(Path(tmp), i * 2, args.files, args.chunks, args.chunk_size, pool, depth)
+
+                label = f"{'pool' if pool else 'no pool'}, depth {depth}"
+                report(f'{label:>16}: {succeeded}/{args.files} files of {args.chunks} x {args.chunk_size} B chunks in {elapsed:.2f}s, {opened} connections opened, {reused} reused')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from fixtures import create_network, mesh, write_random_file, quiet, report
+
+from utils.constants import Constants
+from utils.files_reader import write_file_metadata
+from utils.hashing import hash_and_split
+from models.peer import Peer
+from models.tcpserver import send_range
+
+def folder_usage(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+def seed(root, seeder_id, ids, files, size, chunks):
+    for f in range(files):
+        filename = f'file{f}'
+        write_random_file(root / str(seeder_id) / filename, size)
+        file_size, chunk_size, file_hash, chunk_hashes = hash_and_split(root / str(seeder_id) / filename, chunks)
+
+        for id in ids:
+            write_file_metadata(root / str(id) / f'{filename}.p2p', {
+                'filename': filename, 'chunks': chunks, 'ttl': 1, 'size': file_size, 'chunk_size': chunk_size, 'file_hash': file_hash, 'chunk_hashes': chunk_hashes
+            })
+
+def quota_benchmark(root, base_id, quota, remove_chunks, files, size, chunks):
+    # The downloader fetches every file of the seeder in turn, keeping at most `quota` bytes of them
+    seeder_id, downloader_id = base_id, base_id + 1
+    create_network(root, {seeder_id: 1 << 30, downloader_id: 1 << 30}, mesh([seeder_id, downloader_id]))
+    seed(root, seeder_id, [seeder_id, downloader_id], files, size, chunks)
+
+    Constants.STORE_QUOTA = 0
+    Constants.STORE_REMOVE_ASSEMBLED_CHUNKS = remove_chunks
+
+    Peer(seeder_id).create_tcp_server()
+    downloader = Peer(downloader_id)
+
+    # Set once the seeder is up, so only the downloader is held to the quota
+    Constants.STORE_QUOTA = quota
+
+    succeeded, peak = 0, 0
+    for f in range(files):
+        succeeded += downloader.run(f'file{f}.p2p')
+        peak = max(peak, folder_usage(root / str(downloader_id)))
+
+    return succeeded, peak, folder_usage(root / str(downloader_id)), downloader.content_store.stats()
+
+def drain(connection):
+    while connection.recv(1 << 20):
+        pass
+
+def cache_benchmark(root, base_id, cache_size, files, size, chunks, requests, skew, seed_value):
+    # Chunk requests served straight to a socket, their popularity following a Zipf distribution
+    peer_id = base_id
+    create_network(root, {peer_id: 1 << 30, peer_id + 1: 1 << 30}, mesh([peer_id, peer_id + 1]))
+    seed(root, peer_id, [peer_id], files, size, chunks)
+
+    Constants.STORE_QUOTA = 0
+    Constants.HOT_CACHE_SIZE = cache_size
+    peer = Peer(peer_id)
+
+    keys = [(f'file{f}', c) for f in range(files) for c in range(chunks)]
+    weights = [1 / (rank + 1) ** skew for rank in range(len(keys))]
+    sample = random.Random(seed_value).choices(keys, weights, k=requests)
+
+    sender, receiver = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(receiver,), daemon=True)
+    reader.start()
+
+    start = time.perf_counter()
+    for filename, c in sample:
+        source_filename, offset, chunk_size = peer.file_index.chunk_range(filename, c)
+        with peer.content_store.serving(filename):
+            send_range(sender, peer, source_filename, offset, chunk_size, 0, f'{filename}.ch{c}')
+
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    reader.join()
+    receiver.close()
+
+    return elapsed, peer.content_store.stats()
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the disk usage of a peer downloading many files with and without the content store quota, and the chunk serving rate with and without the hot cache.')
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--size', type=int, default=1024, help='file size in KB')
+    parser.add_argument('--chunks', type=int, default=16)
+    parser.add_argument('--quota', type=int, default=2048, help='quota of the downloader in KB')
+    parser.add_argument('--requests', type=int, default=20000, help='chunk requests served in the hot cache comparison')
+    parser.add_argument('--skew', type=float, default=1.0, help='exponent of the Zipf popularity of the chunks')
+    parser.add_argument('--cache-size', type=int, default=4096, help='hot cache size in KB')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    size = args.size * 1024
+
+    with quiet():
+        Constants.UDP_CLIENT_TIMEOUT = 2
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0.1
+
+        with tempfile.TemporaryDirectory() as tmp:
+            modes = {
+                'keep everything': (0, False),
+                'remove assembled chunks': (0, True),
+                f'quota {args.quota} KB': (args.quota * 1024, True)
+            }
+
+            for i, (mode, (quota, remove_chunks)) in enumerate(modes.items()):
+                succeeded, peak, final, stats = quota_benchmark(Path(tmp) / 'quota' / str(i), 2 * i, quota, remove_chunks, args.files, size, args.chunks)
+
+                report(f'{mode:>23}: {succeeded}/{args.files} downloads, folder peak {peak / 2 ** 20:.2f} MB, final {final / 2 ** 20:.2f} MB, {stats["evictions"]} files removed')
+
+            for i, cache_size in enumerate((0, args.cache_size * 1024)):
+                elapsed, stats = cache_benchmark(Path(tmp) / 'cache' / str(i), 100 + 2 * i, cache_size, args.files, size, args.chunks, args.requests, args.skew, args.seed)
+
+                mode = f'hot cache {cache_size // 1024} KB' if cache_size else 'no hot cache'
+                hit_rate = f"{stats['cache_hit_rate']:.1%}" if stats['cache_hit_rate'] is not None else 'n/a'
+
+                report(f'{mode:>23}: {args.requests / elapsed:.0f} chunk requests/s, hit rate {hit_rate}, {stats["cached_chunks"]} chunks cached')
+
+if __name__ == '__main__':
+    main()
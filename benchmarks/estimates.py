@@ -0,0 +1,117 @@
+import argparse
+import random
+import statistics
+
+from fixtures import report
+
+from utils.constants import Constants
+from models.estimator import SourceEstimator, parallel_makespan
+
+def log_uniform(rng, low, high):
+    return low * (high / low) ** rng.random()
+
+def scenario(rng, args):
+    # Sources advertise their configured speed, but the link to the downloader (RTT, congestion, a slower hop) decides what it actually gets
+    chunks = rng.randint(args.min_chunks, args.max_chunks)
+    size = int(log_uniform(rng, args.min_size * 1024, args.max_size * 1024 * 1024))
+    chunk_size = -(-size // chunks)
+
+    sources = {}
+    for s in range(args.sources):
+        speed = int(log_uniform(rng, 32 * 1024, 8 * 1024 * 1024))
+        sources[s] = {
+            'speed': speed,
+            'rtt': log_uniform(rng, 0.001, 0.3),
+            'throughput': speed * rng.uniform(args.min_link_share, 1),
+            'file': rng.random() < args.file_holders,
+            'chunks': {c for c in range(chunks) if rng.random() < args.chunk_share}
+        }
+
+    # Every chunk is held by at least one source, so fetching by chunks is always possible
+    for c in range(chunks):
+        if not any(c in s['chunks'] for s in sources.values()):
+            rng.choice(list(sources.values()))['chunks'].add(c)
+
+    return size, chunks, chunk_size, sources
+
+def true_times(size, chunks, chunk_size, sources, parallelism):
+    chunk_times = [{s: v['rtt'] + chunk_size / v['throughput'] for s, v in sources.items() if c in v['chunks']} for c in range(chunks)]
+    file_times = [v['rtt'] + size / v['throughput'] for v in sources.values() if v['file']]
+
+    return parallel_makespan(chunk_times, parallelism), min(file_times, default=float('inf'))
+
+def old_rule(size, chunks, chunk_size, sources):
+    # Whole seconds of size // speed, the sum of the fastest source of every chunk against the fastest full copy
+    chunks_time = sum(min(chunk_size // v['speed'] for v in sources.values() if c in v['chunks']) for c in range(chunks))
+    file_time = min((size // v['speed'] for v in sources.values() if v['file']), default=float('inf'))
+
+    return 'file' if chunks_time > file_time else 'chunks'
+
+def new_rule(rng, size, chunks, chunk_size, sources, args):
+    estimator = SourceEstimator()
+
+    # Past transfers with some sources, each measurement off by a random factor
+    for s, v in sources.items():
+        if rng.random() >= args.known_sources:
+            continue
+
+        for _ in range(args.samples):
+            estimator.record_rtt(s, v['rtt'] * rng.lognormvariate(0, args.noise))
+            duration = chunk_size / (v['throughput'] * rng.lognormvariate(0, args.noise))
+            estimator.record_transfer(s, chunk_size, duration)
+
+    chunk_times = [
+        {s: estimator.transfer_time(s, chunk_size, chunk_size / v['speed']) for s, v in sources.items() if c in v['chunks']}
+        for c in range(chunks)
+    ]
+    chunks_time = parallel_makespan(chunk_times, args.parallelism)
+    file_time = min((estimator.transfer_time(s, size, size / v['speed']) for s, v in sources.items() if v['file']), default=float('inf'))
+
+    return 'file' if chunks_time > file_time else 'chunks'
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate downloads over heterogeneous links and compare the chunks or full file decision of summed integer size // speed times with the one of the parallel makespan of estimated times.')
+    parser.add_argument('--trials', type=int, default=2000)
+    parser.add_argument('--sources', type=int, default=6)
+    parser.add_argument('--min-size', type=int, default=16, help='smallest file size in KB')
+    parser.add_argument('--max-size', type=int, default=64, help='largest file size in MB')
+    parser.add_argument('--min-chunks', type=int, default=2)
+    parser.add_argument('--max-chunks', type=int, default=64)
+    parser.add_argument('--chunk-share', type=float, default=0.4, help='probability of a source holding each chunk')
+    parser.add_argument('--file-holders', type=float, default=0.3, help='probability of a source holding the full file')
+    parser.add_argument('--min-link-share', type=float, default=0.05, help='smallest fraction of its advertised speed a source actually delivers')
+    parser.add_argument('--known-sources', type=float, default=0.7, help='probability of having transferred from a source before')
+    parser.add_argument('--samples', type=int, default=5, help='past transfers with every known source')
+    parser.add_argument('--noise', type=float, default=0.3, help='standard deviation of the log of the measurement error')
+    parser.add_argument('--parallelism', type=int, default=Constants.MAX_TCP_CLIENTS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {'size // speed': [], 'estimates': []}
+    skipped = 0
+
+    for _ in range(args.trials):
+        size, chunks, chunk_size, sources = scenario(rng, args)
+        times = dict(zip(('chunks', 'file'), true_times(size, chunks, chunk_size, sources, args.parallelism)))
+
+        if times['file'] == float('inf'):
+            skipped += 1
+            continue
+
+        best = min(times.values())
+        decisions = {'size // speed': old_rule(size, chunks, chunk_size, sources), 'estimates': new_rule(rng, size, chunks, chunk_size, sources, args)}
+
+        for rule, decision in decisions.items():
+            results[rule].append((times[decision] - best, times[decision] / best - 1))
+
+    report(f'{len(results["estimates"])} scenarios with a full copy available ({skipped} without one skipped), {args.parallelism} parallel connections')
+    for rule, regrets in results.items():
+        optimal = sum(1 for absolute, _ in regrets if absolute <= 0) / len(regrets)
+        mean = statistics.mean(absolute for absolute, _ in regrets)
+        relative = sorted(r for _, r in regrets)
+
+        report(f'{rule:>13}: optimal {optimal:.1%}, mean regret {mean:.2f}s, relative regret mean {statistics.mean(relative):.1%} p95 {relative[int(0.95 * len(relative))]:.1%}')
+
+if __name__ == '__main__':
+    main()
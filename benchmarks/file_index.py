@@ -0,0 +1,80 @@
+import argparse
+import re
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, quiet, report
+
+from utils.protocol import encode_query
+from models.peer import Peer
+
+REQUESTER_PORT = 7999
+
+def directory_scan(peer_folder, requested_file):
+    chunks = {}
+    entire_file_size = None
+
+    for f in [f for f in peer_folder.iterdir() if f.is_file()]:
+        if f.name.startswith(requested_file):
+            size = f.stat().st_size
+            if f.name == requested_file:
+                entire_file_size = size
+                continue
+
+            chunks[int(re.search(r'\.ch(\d+)', f.name).group(1))] = size
+
+    return entire_file_size, chunks
+
+def populate(peer_folder, files):
+    for i in range(files):
+        (peer_folder / f'file{i}.bin.ch{i % 8}').touch()
+
+    (peer_folder / 'target.bin').write_bytes(b'x' * 1024)
+
+def query_latency(peer, requester, queries):
+    latencies = []
+    for query_id in range(queries):
+        request = encode_query(1, 99, query_id, '127.0.0.1', REQUESTER_PORT, 'target.bin')
+
+        start = time.perf_counter()
+        requester.sendto(request, peer.udp_server.address)
+        requester.recvfrom(4096)
+        latencies.append(time.perf_counter() - start)
+
+    return sorted(latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure UDP query latency with the in-memory file index.')
+    parser.add_argument('--files', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    with quiet():
+        requester = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        requester.bind(('127.0.0.1', REQUESTER_PORT))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, files in enumerate(args.files):
+                peer_id = 2 * i
+                root = create_network(Path(tmp) / str(files), {peer_id: 1000, peer_id + 1: 1000}, {peer_id: [peer_id + 1], peer_id + 1: [peer_id]})
+                peer_folder = root / str(peer_id)
+                populate(peer_folder, files)
+
+                start = time.perf_counter()
+                directory_scan(peer_folder, 'target.bin')
+                scan = time.perf_counter() - start
+
+                start = time.perf_counter()
+                peer = Peer(peer_id)
+                build = time.perf_counter() - start
+
+                latencies = query_latency(peer, requester, args.queries)
+
+                p50 = latencies[len(latencies) // 2]
+                p99 = latencies[int(len(latencies) * 0.99)]
+                report(f'{files} files: index build {build * 1000:.1f} ms, query p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms (one directory scan: {scan * 1000:.1f} ms)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import sys
+import os
+import random
+import contextlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from utils.constants import Constants
+
+def create_network(root, speeds, topology, address='127.0.0.1', udp_base=6100):
+    root = Path(root)
+
+    config = ''.join(f'{id}: {address}, {udp_base + id}, {speed}\n' for id, speed in speeds.items())
+    topologia = ''.join(f"{id}: {', '.join(str(n) for n in neighbors)}\n" for id, neighbors in topology.items())
+
+    for id in speeds:
+        peer_folder = root / str(id)
+        os.makedirs(peer_folder, exist_ok=True)
+
+        (peer_folder / 'config.txt').write_text(config)
+        (peer_folder / 'topologia.txt').write_text(topologia)
+
+    Constants.FILES_PATH = root
+
+    return root
+
+def chain(ids):
+    return {id: [n for n in (ids[i - 1] if i > 0 else None, ids[i + 1] if i + 1 < len(ids) else None) if n is not None] for i, id in enumerate(ids)}
+
+def ring(ids):
+    return {id: [ids[i - 1], ids[(i + 1) % len(ids)]] for i, id in enumerate(ids)}
+
+def mesh(ids):
+    return {id: [n for n in ids if n != id] for id in ids}
+
+def random_graph(ids, degree, seed=0):
+    rng = random.Random(seed)
+    topology = {id: set(neighbors) for id, neighbors in ring(ids).items()}
+
+    for id in ids:
+        while len(topology[id]) < degree:
+            n = rng.choice(ids)
+            if n != id:
+                topology[id].add(n)
+                topology[n].add(id)
+
+    return {id: sorted(neighbors) for id, neighbors in topology.items()}
+
+def write_random_file(path, size, block_size=1 << 20):
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = os.urandom(min(block_size, size))
+            f.write(block)
+            size -= len(block)
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def report(line):
+    print(line, file=sys.__stdout__, flush=True)
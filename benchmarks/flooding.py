@@ -0,0 +1,66 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, ring, mesh, random_graph, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+
+def wait_until_settled(peers, quiet_period):
+    total = -1
+    while True:
+        time.sleep(quiet_period)
+
+        current = sum(p.udp_server.requests_received for p in peers)
+        if current == total:
+            return total
+
+        total = current
+
+def benchmark(root, topology, ttl):
+    create_network(root, {id: 1000 for id in topology}, topology)
+
+    requester_id = min(topology)
+    (root / str(requester_id) / 'missing.p2p').write_text(f'missing\n1\n{ttl}\n')
+
+    peers = [Peer(id) for id in topology]
+    requester = peers[0]
+
+    requester.run('missing.p2p')
+
+    return wait_until_settled(peers, 2.5)
+
+def main():
+    parser = argparse.ArgumentParser(description='Count flooding messages per query with and without duplicate suppression.')
+    parser.add_argument('--peers', type=int, default=10)
+    parser.add_argument('--ttl', type=int, default=3)
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.UDP_CLIENT_TIMEOUT = args.ttl + 1
+
+        topologies = {
+            'ring': ring,
+            'mesh': lambda ids: mesh(ids[:6]),
+            'random': lambda ids: random_graph(ids, 3)
+        }
+
+        base_id = 0
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, build in topologies.items():
+                results = {}
+
+                for suppression in (False, True):
+                    Constants.DUPLICATE_QUERY_SUPPRESSION = suppression
+
+                    topology = build(list(range(base_id, base_id + args.peers)))
+                    base_id += args.peers
+
+                    results[suppression] = benchmark(Path(tmp), topology, args.ttl)
+
+                report(f'{name:>6} ({len(topology)} peers, TTL {args.ttl}): {results[False]} messages without suppression, {results[True]} with suppression')
+
+if __name__ == '__main__':
+    main()
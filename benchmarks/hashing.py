@@ -0,0 +1,54 @@
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+from fixtures import write_random_file, quiet, report
+
+from utils.constants import Constants
+from utils.hashing import hash_and_split
+
+def algorithm_throughput(name, data, repeat):
+    if name == 'crc32':
+        start = time.perf_counter()
+        for _ in range(repeat):
+            zlib.crc32(data)
+        return len(data) * repeat / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        hashlib.new(name, data)
+    return len(data) * repeat / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure hashing throughput for chunk verification and metadata creation.')
+    parser.add_argument('--size', type=int, default=256, help='file size in MB for the metadata creation pass')
+    parser.add_argument('--chunks', type=int, default=16)
+    parser.add_argument('--algorithms', nargs='+', default=['crc32', 'sha256', 'sha1', 'blake2b'])
+    args = parser.parse_args()
+
+    with quiet():
+        block = os.urandom(Constants.TRANSFER_BLOCK_SIZE)
+        repeat = max(1, (64 * 1024 * 1024) // len(block))
+
+        for name in args.algorithms:
+            throughput = algorithm_throughput(name, block, repeat)
+            report(f'{name:>8}: {throughput / 1e6:.0f} MB/s over {len(block) // 1024} KB blocks')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'blob'
+            write_random_file(path, args.size * 1024 * 1024)
+
+            for split in (False, True):
+                start = time.perf_counter()
+                hash_and_split(path, args.chunks, write_chunks=split)
+                elapsed = time.perf_counter() - start
+
+                action = 'hash and split' if split else 'hash only'
+                report(f'{action:>14}: {args.size} MB in {args.chunks} chunks with {Constants.HASH_ALGORITHM} in {elapsed:.2f}s, {args.size * 1024 * 1024 / elapsed / 1e6:.0f} MB/s')
+
+if __name__ == '__main__':
+    main()
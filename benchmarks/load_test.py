@@ -0,0 +1,223 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, chain, ring, mesh, random_graph, write_random_file, quiet, report
+
+from utils.constants import Constants
+from utils.files_reader import write_file_metadata
+from utils.hashing import hash_and_split
+from models.peer import Peer
+
+TOPOLOGIES = {
+    'chain': lambda ids, degree: chain(ids),
+    'ring': lambda ids, degree: ring(ids),
+    'mesh': lambda ids, degree: mesh(ids),
+    'random': random_graph
+}
+
+def usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+def seed_files(root, ids, files, size, chunks, chunk_holders, ttl, rng):
+    # Every file has one peer with all of it and its chunks spread over other peers, every peer has its metadata
+    seeded = {}
+
+    for f in range(files):
+        filename = f'file{f}'
+        holders = rng.sample(ids, min(len(ids), 1 + chunk_holders))
+
+        source = root / 'source'
+        os.makedirs(source, exist_ok=True)
+        write_random_file(source / filename, size)
+        file_size, chunk_size, file_hash, chunk_hashes = hash_and_split(source / filename, chunks, write_chunks=True)
+
+        os.link(source / filename, root / str(holders[0]) / filename)
+        for c in range(chunks):
+            holder = holders[1 + c % (len(holders) - 1)] if len(holders) > 1 else holders[0]
+            os.link(source / f'{filename}.ch{c}', root / str(holder) / f'{filename}.ch{c}')
+
+        for id in ids:
+            write_file_metadata(root / str(id) / f'{filename}.p2p', {
+                'filename': filename, 'chunks': chunks, 'ttl': ttl, 'size': file_size, 'chunk_size': chunk_size, 'file_hash': file_hash, 'chunk_hashes': chunk_hashes
+            })
+
+        seeded[filename] = {'size': file_size, 'holders': holders}
+
+    return seeded
+
+def peer_process(root, id, constants, connection):
+    # Each peer runs in its own process, so its CPU time and RSS are its own; the parent drives it through the pipe
+    Constants.FILES_PATH = root
+    for name, value in constants.items():
+        setattr(Constants, name, value)
+
+    with quiet():
+        peer = Peer(id)
+        cpu_start, _ = usage()
+        downloads = []
+
+        connection.send('ready')
+
+        while True:
+            command, args = connection.recv()
+
+            if command == 'download':
+                downloads = [peer.download(f'{filename}.p2p') for filename in args]
+                connection.send('started')
+
+            elif command == 'wait':
+                results = []
+                for d in downloads:
+                    d.wait()
+                    results.append({
+                        'peer': id,
+                        'filename': d.filename,
+                        'succeeded': d.succeeded,
+                        'completion_time': d.completion_time,
+                        'search_latency': d.search_latency,
+                        'search_responses': d.search_responses
+                    })
+
+                connection.send(results)
+
+            elif command == 'stats':
+                cpu, rss = usage()
+                connection.send({
+                    'peer': id,
+                    'cpu_seconds': cpu - cpu_start,
+                    'peak_rss': rss,
+                    'queries_received': peer.udp_server.requests_received,
+                    'forwards_dropped': peer.udp_server.forwards_dropped,
+                    'queries_shed': peer.udp_server.shed,
+                    'bytes_uploaded': peer.upload_bucket.total
+                })
+                return
+
+def percentile(values, p):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def number(value, suffix = ''):
+    return 'n/a' if value is None else f'{value:.2f}{suffix}'
+
+def benchmark(root, args):
+    ids = list(range(args.base_id, args.base_id + args.peers))
+    rng = random.Random(args.seed)
+
+    create_network(root, {id: args.speed * 1024 for id in ids}, TOPOLOGIES[args.topology](ids, args.degree))
+    seeded = seed_files(root, ids, args.files, args.size * 1024 * 1024, args.chunks, args.chunk_holders, args.ttl, rng)
+
+    # Every downloader fetches every file it holds nothing of, all of them at once
+    downloaders = rng.sample(ids, min(len(ids), args.downloaders))
+    plan = {id: [f for f, s in seeded.items() if id not in s['holders']] for id in downloaders}
+
+    constants = {
+        'UDP_CLIENT_TIMEOUT': args.search_timeout,
+        'SOURCE_BUSY_BACKOFF': 0.2
+    }
+
+    processes = {}
+    for id in ids:
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=peer_process, args=(root, id, constants, child), daemon=True)
+        process.start()
+        processes[id] = (process, parent)
+
+    try:
+        for _, connection in processes.values():
+            connection.recv()
+
+        start = time.monotonic()
+        for id, files in plan.items():
+            processes[id][1].send(('download', files))
+            processes[id][1].recv()
+
+        downloads = []
+        for id in plan:
+            processes[id][1].send(('wait', None))
+            downloads.extend(processes[id][1].recv())
+
+        makespan = time.monotonic() - start
+
+        peers = []
+        for _, connection in processes.values():
+            connection.send(('stats', None))
+            peers.append(connection.recv())
+    finally:
+        for process, _ in processes.values():
+            process.terminate()
+            process.join()
+
+    succeeded = [d for d in downloads if d['succeeded']]
+    latencies = [d['search_latency'] for d in downloads if d['search_latency'] is not None]
+    downloaded = sum(seeded[d['filename']]['size'] for d in succeeded)
+    messages = sum(p['queries_received'] for p in peers)
+
+    summary = {
+        'downloads': len(downloads),
+        'succeeded': len(succeeded),
+        'makespan': makespan,
+        'search_latency_p50': percentile(latencies, 50),
+        'search_latency_p95': percentile(latencies, 95),
+        'query_messages_per_search': messages / len(downloads) if downloads else None,
+        'responses_per_search': statistics.mean(d['search_responses'] for d in downloads) if downloads else None,
+        'aggregate_throughput': downloaded / makespan,
+        'download_throughput_p50': percentile([seeded[d['filename']]['size'] / d['completion_time'] for d in succeeded], 50),
+        'mean_cpu_seconds': statistics.mean(p['cpu_seconds'] for p in peers),
+        'max_peak_rss': max(p['peak_rss'] for p in peers)
+    }
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'summary': summary,
+        'peers': sorted(peers, key=lambda p: p['peer']),
+        'downloads': downloads
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a network of peers, one process each, downloading random files concurrently; results are written as JSON.')
+    parser.add_argument('--peers', type=int, default=16)
+    parser.add_argument('--topology', choices=list(TOPOLOGIES), default='random')
+    parser.add_argument('--degree', type=int, default=3, help='neighbors per peer of the random topology')
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size', type=int, default=1, help='file size in MB')
+    parser.add_argument('--chunks', type=int, default=8)
+    parser.add_argument('--chunk-holders', type=int, default=2, help='peers other than the full copy holding a share of the chunks of every file')
+    parser.add_argument('--ttl', type=int, default=3)
+    parser.add_argument('--downloaders', type=int, default=8, help='peers downloading every file they do not hold')
+    parser.add_argument('--speed', type=int, default=1024, help='upload speed of every peer in KB/s')
+    parser.add_argument('--search-timeout', type=float, default=5)
+    parser.add_argument('--base-id', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file the JSON results are written to, by default they are printed')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        result = benchmark(Path(tmp), args)
+
+    if not args.output:
+        report(json.dumps(result, indent=2))
+        return
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    s = result['summary']
+    report(f"{s['succeeded']}/{s['downloads']} downloads in {s['makespan']:.1f}s, {s['aggregate_throughput'] / 2 ** 20:.2f} MB/s aggregate")
+    report(f"search latency p50 {number(s['search_latency_p50'], 's')} p95 {number(s['search_latency_p95'], 's')}, {number(s['query_messages_per_search'])} query messages and {number(s['responses_per_search'])} responses per search")
+    report(f"{s['mean_cpu_seconds']:.2f} CPU seconds per peer, peak RSS {s['max_peak_rss'] / 2 ** 20:.0f} MB, results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
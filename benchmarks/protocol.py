@@ -0,0 +1,62 @@
+import argparse
+import random
+import time
+
+from fixtures import quiet, report
+
+from utils import bitfield
+from utils.protocol import encode_responses, decode_response
+
+def announcements(chunks):
+    # Every chunk with one sending time but the last, every other chunk, and a random half with random times
+    contiguous = {c: 100 for c in range(chunks)}
+    contiguous[chunks - 1] = 40
+
+    return {
+        'contiguous': contiguous,
+        'alternate': {c: 100 for c in range(0, chunks, 2)},
+        'random': {c: random.choice((90, 100, 110)) for c in random.sample(range(chunks), chunks // 2)}
+    }
+
+def v1_size(chunks):
+    # Fixed 268 bytes header with a padded filename, then 8 bytes per chunk
+    return 268 + 8 * len(chunks)
+
+def measure(chunks, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        datagrams = encode_responses(1, 1, '127.0.0.1', 4001, True, 1000, chunks)
+    encode = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        responses = [decode_response(d) for d in datagrams]
+    decode = (time.perf_counter() - start) / repeat
+
+    decoded = {}
+    for response in responses:
+        for sending_time, chunk_set in response['chunks'].items():
+            decoded.update((c, sending_time) for c in bitfield.chunks(chunk_set))
+
+    if decoded != chunks:
+        raise AssertionError('Decoded announcement differs from the encoded one')
+
+    return datagrams, encode, decode
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure encoding and decoding of flooding responses announcing many chunks.')
+    parser.add_argument('--chunks', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with quiet():
+        random.seed(0)
+
+        for name, chunks in announcements(args.chunks).items():
+            datagrams, encode, decode = measure(chunks, args.repeat)
+            size = sum(len(d) for d in datagrams)
+
+            report(f'{name:>10}: {len(chunks)} chunks in {len(datagrams)} datagrams, {size} B (v1 {v1_size(chunks)} B), encode {encode * 1000:.2f} ms, decode {decode * 1000:.2f} ms')
+
+if __name__ == '__main__':
+    main()
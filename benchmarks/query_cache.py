@@ -0,0 +1,107 @@
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, ring, random_graph, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+from models.availability import AvailabilityTable
+
+FILENAME = 'popular'
+
+MODES = {
+    'flooding': {'QUERY_RESULT_CACHE': False, 'QUERY_AGGREGATION_WINDOW': 0},
+    'cache': {'QUERY_RESULT_CACHE': True, 'QUERY_AGGREGATION_WINDOW': 0},
+    'cache+aggregation': {'QUERY_RESULT_CACHE': True, 'QUERY_AGGREGATION_WINDOW': 0.05}
+}
+
+TOPOLOGIES = {
+    'ring': lambda ids, degree: ring(ids),
+    'random': random_graph
+}
+
+DATAGRAM_KINDS = ('response', 'forward', 'relay', 'cached', 'announcement')
+
+def datagrams(peers):
+    # Queries sent by requesters are counted by the searches themselves
+    return sum(p.metrics.counter('p2p_udp_datagrams_sent_total', '', ('kind',)).value(kind) for p in peers for kind in DATAGRAM_KINDS)
+
+def wait_until_settled(peers, quiet_period):
+    total = -1
+    while True:
+        time.sleep(quiet_period)
+
+        current = datagrams(peers)
+        if current == total:
+            return
+
+        total = current
+
+def benchmark(root, base_id, mode, topology, peers, degree, holders, searches, ttl, interval, rng):
+    for name, value in MODES[mode].items():
+        setattr(Constants, name, value)
+
+    ids = list(range(base_id, base_id + peers))
+    create_network(root, {id: 1024 * 1024 for id in ids}, TOPOLOGIES[topology](ids, degree))
+
+    holder_ids = rng.sample(ids, holders)
+    for id in holder_ids:
+        write_random_file(root / str(id) / FILENAME, 64 * 1024)
+
+    network = {id: Peer(id) for id in ids}
+    requesters = [id for id in ids if id not in holder_ids]
+
+    # The same popular file is searched for again and again, each time by a peer chosen at random
+    latencies, queries = [], 0
+    for _ in range(searches):
+        requester = network[rng.choice(requesters)]
+
+        client = requester.search(ttl, FILENAME, AvailabilityTable(1))
+        client.start()
+        client.join()
+
+        queries += len(requester.neighbors)
+        if client.located_after is not None:
+            latencies.append(client.located_after)
+
+        time.sleep(interval)
+
+    wait_until_settled(network.values(), 1)
+
+    return len(latencies), latencies, (queries + datagrams(network.values())) / searches
+
+def main():
+    parser = argparse.ArgumentParser(description='Search repeatedly for one popular file from random peers, measuring datagrams per search and the time to locate it with plain flooding, with cached results at intermediate peers and with aggregated relays.')
+    parser.add_argument('--peers', type=int, default=20)
+    parser.add_argument('--topology', choices=list(TOPOLOGIES), default='random')
+    parser.add_argument('--degree', type=int, default=3, help='neighbors per peer of the random topology')
+    parser.add_argument('--holders', type=int, default=2, help='peers holding the file')
+    parser.add_argument('--searches', type=int, default=20)
+    parser.add_argument('--ttl', type=int, default=4)
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between searches')
+    parser.add_argument('--reroute-delay', type=float, default=0.1, help='seconds a query waits before being forwarded')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.REROUTE_DELAY = args.reroute_delay
+        Constants.UDP_CLIENT_TIMEOUT = args.ttl * args.reroute_delay + 1
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0.05
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, mode in enumerate(args.modes):
+                rng = random.Random(args.seed)
+                located, latencies, messages = benchmark(Path(tmp), i * args.peers, mode, args.topology, args.peers, args.degree, args.holders, args.searches, args.ttl, args.interval, rng)
+
+                median = f'{statistics.median(latencies) * 1000:.1f} ms' if latencies else 'n/a'
+                p95 = f'{sorted(latencies)[int(0.95 * len(latencies))] * 1000:.1f} ms' if latencies else 'n/a'
+
+                report(f'{mode:>17}: {located}/{args.searches} located, {messages:.1f} datagrams per search, time to locate median {median} p95 {p95}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from models.peer import Peer
+from models.tcpclient import TCPClient
+
+FILENAME = 'blob'
+
+def benchmark(root, server_id, speed, connections, chunk_size):
+    client_id = server_id + 1
+    create_network(root, {server_id: speed, client_id: speed}, {server_id: [client_id], client_id: [server_id]})
+
+    for c in range(connections):
+        write_random_file(root / str(server_id) / f'{FILENAME}.ch{c}', chunk_size)
+
+    server_peer = Peer(server_id)
+    client_peer = Peer(client_id)
+    server = server_peer.create_tcp_server()
+
+    clients = [TCPClient(client_peer, server.address, server.port, None, FILENAME, [c]) for c in range(connections)]
+
+    start = time.perf_counter()
+    for c in clients:
+        c.start()
+
+    for c in clients:
+        c.join()
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        'configured': speed,
+        'reported': server_peer.upload_rate(),
+        'observed': connections * chunk_size / elapsed,
+        'elapsed': elapsed
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare configured and achieved upload rates of the token bucket.')
+    parser.add_argument('--speeds', type=int, nargs='+', default=[64 * 1024, 256 * 1024, 1024 * 1024])
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=4, help='approximate duration of each transfer')
+    args = parser.parse_args()
+
+    with quiet():
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, speed in enumerate(args.speeds):
+                chunk_size = int(speed * args.seconds / args.connections)
+
+                r = benchmark(Path(tmp), 2 * i, speed, args.connections, chunk_size)
+
+                report(f"configured {r['configured']} B/s: observed {r['observed']:.0f} B/s, reported {r['reported']:.0f} B/s ({r['elapsed']:.2f}s)")
+
+if __name__ == '__main__':
+    main()
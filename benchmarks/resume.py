@@ -0,0 +1,116 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from utils.files_reader import write_file_metadata
+from utils.hashing import hash_and_split
+from models.peer import Peer
+
+FILENAME = 'blob'
+
+def seeder(root, id):
+    Constants.FILES_PATH = root
+    Constants.TCP_SERVER_SENDFILE = False
+
+    peer = Peer(id)
+    peer.create_tcp_server()
+
+    def stop(*_):
+        (root / f'uploaded.{id}').write_text(str(peer.upload_bucket.total))
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    (root / f'ready.{id}').touch()
+    while True:
+        time.sleep(1)
+
+def start_seeder(root, id):
+    process = subprocess.Popen([sys.executable, __file__, '--seeder', str(id), '--root', str(root)], stdout=subprocess.DEVNULL)
+
+    while not (root / f'ready.{id}').exists():
+        time.sleep(0.05)
+
+    (root / f'ready.{id}').unlink()
+    return process
+
+def stop_seeder(root, id, process):
+    process.terminate()
+    process.wait()
+
+    return int((root / f'uploaded.{id}').read_text())
+
+def leftover_bytes(folder):
+    return sum(path.stat().st_size for path in (folder / 'tmp').iterdir()) if (folder / 'tmp').exists() else 0
+
+def benchmark(root, base_id, resume, size, chunks, speed, fraction, holds):
+    downloader_id, seeder_id = base_id, base_id + 1
+    create_network(root, {downloader_id: speed, seeder_id: speed}, {downloader_id: [seeder_id], seeder_id: [downloader_id]})
+
+    write_random_file(root / str(seeder_id) / FILENAME, size)
+    file_size, chunk_size, file_hash, chunk_hashes = hash_and_split(root / str(seeder_id) / FILENAME, chunks, write_chunks=holds == 'chunks')
+    if holds == 'chunks':
+        (root / str(seeder_id) / FILENAME).unlink()
+
+    for id in (downloader_id, seeder_id):
+        write_file_metadata(root / str(id) / f'{FILENAME}.p2p', {
+            'filename': FILENAME, 'chunks': chunks, 'ttl': 1, 'size': file_size, 'chunk_size': chunk_size, 'file_hash': file_hash, 'chunk_hashes': chunk_hashes
+        })
+
+    Constants.RESUME_DOWNLOADS = resume
+    downloader = Peer(downloader_id)
+
+    process = start_seeder(root, seeder_id)
+    download = downloader.download(f'{FILENAME}.p2p')
+
+    time.sleep(fraction * size / speed)
+    uploaded = stop_seeder(root, seeder_id, process)
+    download.wait()
+
+    process = start_seeder(root, seeder_id)
+    succeeded = downloader.run(f'{FILENAME}.p2p')
+    uploaded += stop_seeder(root, seeder_id, process)
+
+    # A finished download leaves neither its partial file nor its journal behind
+    return succeeded, uploaded - size, leftover_bytes(root / str(downloader_id))
+
+def main():
+    parser = argparse.ArgumentParser(description='Kill the seeder mid-transfer and count the bytes transferred again after restarting the download.')
+    parser.add_argument('--size', type=int, default=32, help='file size in MB')
+    parser.add_argument('--chunks', type=int, default=4)
+    parser.add_argument('--speed', type=int, default=16, help='seeder speed in MB/s')
+    parser.add_argument('--kill-at', type=float, default=0.5, help='fraction of the transfer time after which the seeder is killed')
+    parser.add_argument('--holds', choices=['file', 'chunks'], default='file', help='whether the seeder holds the full file or only its chunks')
+    parser.add_argument('--seeder', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seeder is not None:
+        with quiet():
+            seeder(Path(args.root), args.seeder)
+        return
+
+    with quiet():
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0
+        Constants.KEEP_CHUNK_FILES = False
+
+        size = args.size * 1024 * 1024
+        speed = args.speed * 1024 * 1024
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, resume in enumerate((False, True)):
+                succeeded, retransferred, leftover = benchmark(Path(tmp), i * 2, resume, size, args.chunks, speed, args.kill_at, args.holds)
+
+                label = 'journal' if resume else 'no journal'
+                report(f'{label:>10}: {"completed" if succeeded else "failed"} after restart, {retransferred / 2 ** 20:.1f} MB of {args.size} MB transferred again, {leftover / 2 ** 20:.1f} MB left in tmp')
+
+if __name__ == '__main__':
+    main()
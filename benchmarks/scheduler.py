@@ -0,0 +1,62 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+
+FILENAME = 'blob'
+
+def benchmark(root, scheduler, base_id, speeds, chunks, chunk_size):
+    Constants.CHUNK_SCHEDULER = scheduler
+
+    downloader_id = base_id
+    seeder_ids = [base_id + 1 + i for i in range(len(speeds))]
+
+    create_network(
+        root,
+        {downloader_id: max(speeds), **dict(zip(seeder_ids, speeds))},
+        {downloader_id: seeder_ids, **{s: [downloader_id] for s in seeder_ids}}
+    )
+
+    for s in seeder_ids:
+        for c in range(chunks):
+            write_random_file(root / str(s) / f'{FILENAME}.ch{c}', chunk_size)
+
+    (root / str(downloader_id) / f'{FILENAME}.p2p').write_text(f'{FILENAME}\n{chunks}\n1\n')
+
+    downloader = Peer(downloader_id)
+    for s in seeder_ids:
+        Peer(s)
+
+    start = time.perf_counter()
+    downloader.run(f'{FILENAME}.p2p')
+    elapsed = time.perf_counter() - start
+
+    assert (root / str(downloader_id) / FILENAME).stat().st_size == chunks * chunk_size
+
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare static chunk grouping with the work-stealing scheduler.')
+    parser.add_argument('--speeds', type=int, nargs='+', default=[512 * 1024, 256 * 1024, 128 * 1024, 64 * 1024], help='upload speed of each seeder in B/s')
+    parser.add_argument('--chunks', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=512 * 1024)
+    parser.add_argument('--max-tcp-clients', type=int, default=4)
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.UDP_CLIENT_TIMEOUT = 1
+        Constants.MAX_TCP_CLIENTS = args.max_tcp_clients
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, scheduler in enumerate(('static', 'work_stealing')):
+                elapsed = benchmark(Path(tmp), scheduler, i * (len(args.speeds) + 1), args.speeds, args.chunks, args.chunk_size)
+
+                report(f'{scheduler:>13}: {elapsed:.2f}s including the search phase')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, mesh, write_random_file, quiet, report
+
+from utils.constants import Constants
+from utils.files_reader import write_file_metadata
+from utils.hashing import hash_and_split
+from models.peer import Peer
+
+FILENAME = 'blob'
+
+MODES = {
+    'without seeding': {'SEED_WHILE_DOWNLOADING': False, 'ANNOUNCE_CHUNKS': False},
+    'with seeding': {'SEED_WHILE_DOWNLOADING': True, 'ANNOUNCE_CHUNKS': True}
+}
+
+def benchmark(root, base_id, mode, downloaders, size, chunks, speed):
+    for name, value in MODES[mode].items():
+        setattr(Constants, name, value)
+
+    seeder_id = base_id
+    downloader_ids = [base_id + 1 + i for i in range(downloaders)]
+    ids = [seeder_id, *downloader_ids]
+
+    create_network(root, {id: speed for id in ids}, mesh(ids))
+
+    write_random_file(root / str(seeder_id) / FILENAME, size)
+    file_size, chunk_size, file_hash, chunk_hashes = hash_and_split(root / str(seeder_id) / FILENAME, chunks)
+
+    for id in ids:
+        write_file_metadata(root / str(id) / f'{FILENAME}.p2p', {
+            'filename': FILENAME, 'chunks': chunks, 'ttl': 1, 'size': file_size, 'chunk_size': chunk_size, 'file_hash': file_hash, 'chunk_hashes': chunk_hashes
+        })
+
+    seeder = Peer(seeder_id)
+    peers = [Peer(id) for id in downloader_ids]
+
+    # Every downloader starts at once, so at first only the seeder has chunks to offer
+    start = time.monotonic()
+    downloads = [peer.download(f'{FILENAME}.p2p') for peer in peers]
+
+    succeeded = sum(d.wait() for d in downloads)
+    makespan = time.monotonic() - start
+
+    completion = sorted(d.completion_time for d in downloads)
+    seeder_share = seeder.upload_bucket.total / (downloaders * size)
+
+    return succeeded, makespan, completion, seeder_share
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many in-process peers downloading one file from a single seeder at the same time, with and without serving and announcing the chunks of downloads in progress.')
+    parser.add_argument('--downloaders', type=int, default=50)
+    parser.add_argument('--size', type=int, default=1, help='file size in MB')
+    parser.add_argument('--chunks', type=int, default=16)
+    parser.add_argument('--speed', type=int, default=1024, help='upload speed of every peer in KB/s')
+    parser.add_argument('--slots', type=int, default=4, help='upload slots of every peer')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+
+    with quiet():
+        Constants.UDP_CLIENT_TIMEOUT = 2
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0.2
+        Constants.SOURCE_BUSY_BACKOFF = 0.2
+        Constants.MAX_UPLOAD_SLOTS = args.slots
+        Constants.KEEP_CHUNK_FILES = False
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, mode in enumerate(args.modes):
+                succeeded, makespan, completion, seeder_share = benchmark(Path(tmp), i * (args.downloaders + 1), mode, args.downloaders, size, args.chunks, args.speed * 1024)
+
+                median = completion[len(completion) // 2]
+
+                report(f'{mode:>15}: {succeeded}/{args.downloaders} downloads in {makespan:.1f}s, median download {median:.1f}s, slowest {completion[-1]:.1f}s, seeder sent {seeder_share:.0%} of the bytes')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+from models.tcpclient import TCPClient
+
+FILENAME = 'blob'
+
+def fetch(client_peer, server, size, sendfile):
+    Constants.TCP_SERVER_SENDFILE = sendfile
+
+    client = TCPClient(client_peer, server.address, server.port, None, FILENAME, [0])
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+
+    client.start()
+    client.join()
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    os.remove(Constants.FILES_PATH / str(client_peer.id) / f'{FILENAME}.ch0')
+
+    return {
+        'mode': 'sendfile' if sendfile else 'read/sendall',
+        'size': size,
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'throughput_bytes_per_second': size / elapsed
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare sendfile and read/sendall when serving chunk files.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 128, 1024], help='chunk sizes in MB')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads')
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.TRANSFER_MODE = args.mode
+        # Both modes read the chunk from disk; the hot cache would serve the second request from memory
+        Constants.HOT_CACHE_SIZE = 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            root = create_network(Path(tmp), {0: 10 ** 12, 1: 10 ** 12}, {0: [1], 1: [0]})
+
+            server_peer = Peer(0)
+            client_peer = Peer(1)
+            server = server_peer.create_tcp_server()
+
+            for size in args.sizes:
+                size *= 1024 * 1024
+                path = root / '0' / f'{FILENAME}.ch0'
+                write_random_file(path, size)
+                # Written after the peer indexed its folder, so it is added to the index directly
+                server_peer.file_index.add(path)
+
+                for sendfile in (False, True):
+                    r = fetch(client_peer, server, size, sendfile)
+
+                    report(f"{r['mode']:>12}: {r['size'] / 2 ** 20:.0f} MB in {r['elapsed']:.2f}s, CPU {r['cpu']:.2f}s, {r['throughput_bytes_per_second'] / 1e6:.1f} MB/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fixtures import create_network, mesh, write_random_file, quiet, report
+
+from utils.constants import Constants
+from utils.files_reader import write_file_metadata
+from utils.hashing import hash_and_split
+from models.peer import Peer
+
+FILENAME = 'blob'
+
+POLICIES = {
+    'fastest': {'CHUNK_SELECTION': 'sequential', 'LOAD_AWARE_SELECTION': False, 'MAX_UPLOAD_SLOTS': 0},
+    'rarest': {'CHUNK_SELECTION': 'rarest_first', 'LOAD_AWARE_SELECTION': True, 'MAX_UPLOAD_SLOTS': 0},
+    'rarest+slots': {'CHUNK_SELECTION': 'rarest_first', 'LOAD_AWARE_SELECTION': True, 'MAX_UPLOAD_SLOTS': 2}
+}
+
+def benchmark(root, base_id, policy, downloaders, size, chunks, speed, stagger):
+    for name, value in POLICIES[policy].items():
+        setattr(Constants, name, value)
+
+    seeder_id = base_id
+    downloader_ids = [base_id + 1 + i for i in range(downloaders)]
+    ids = [seeder_id, *downloader_ids]
+
+    create_network(root, {id: speed for id in ids}, mesh(ids))
+
+    write_random_file(root / str(seeder_id) / FILENAME, size)
+    file_size, chunk_size, file_hash, chunk_hashes = hash_and_split(root / str(seeder_id) / FILENAME, chunks)
+
+    for id in ids:
+        write_file_metadata(root / str(id) / f'{FILENAME}.p2p', {
+            'filename': FILENAME, 'chunks': chunks, 'ttl': 1, 'size': file_size, 'chunk_size': chunk_size, 'file_hash': file_hash, 'chunk_hashes': chunk_hashes
+        })
+
+    seeder = Peer(seeder_id)
+    seeder.create_tcp_server()
+    peers = [Peer(id) for id in downloader_ids]
+
+    # Downloaders join one after the other, so later ones can fetch from the chunks earlier ones already hold
+    start = time.monotonic()
+    downloads = []
+    for peer in peers:
+        downloads.append(peer.download(f'{FILENAME}.p2p'))
+        time.sleep(stagger)
+
+    succeeded = sum(d.wait() for d in downloads)
+    makespan = time.monotonic() - start
+
+    completion = sorted(d.completion_time for d in downloads)
+    seeder_share = seeder.upload_bucket.total / (downloaders * size)
+
+    return succeeded, makespan, completion, seeder_share
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a swarm of in-process peers downloading one file from a single seeder under different selection policies.')
+    parser.add_argument('--downloaders', type=int, default=8)
+    parser.add_argument('--size', type=int, default=4, help='file size in MB')
+    parser.add_argument('--chunks', type=int, default=32)
+    parser.add_argument('--speed', type=int, default=1024, help='upload speed of every peer in KB/s')
+    parser.add_argument('--stagger', type=float, default=0.5, help='seconds between downloaders joining')
+    parser.add_argument('--policies', nargs='+', choices=list(POLICIES), default=list(POLICIES))
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+
+    with quiet():
+        Constants.UDP_CLIENT_TIMEOUT = 2
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0.2
+        Constants.SOURCE_BUSY_BACKOFF = 0.2
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, policy in enumerate(args.policies):
+                succeeded, makespan, completion, seeder_share = benchmark(Path(tmp), i * (args.downloaders + 1), policy, args.downloaders, size, args.chunks, args.speed * 1024, args.stagger)
+
+                throughput = succeeded * size / makespan / 2 ** 20
+                median = completion[len(completion) // 2]
+
+                report(f'{policy:>12}: {succeeded}/{args.downloaders} downloads in {makespan:.1f}s, {throughput:.2f} MB/s aggregate, median download {median:.1f}s, seeder sent {seeder_share:.0%} of the bytes')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+
+FILENAME = 'blob'
+
+class FirstChunkWatcher(threading.Thread):
+    def __init__(self, peer, start):
+        super().__init__(daemon=True)
+
+        self._peer = peer
+        self._start = start
+        self.first_chunk = None
+
+    def run(self):
+        while self.first_chunk is None:
+            _, chunks = self._peer.file_index.lookup(FILENAME)
+            if chunks:
+                self.first_chunk = time.perf_counter() - self._start
+
+            time.sleep(0.005)
+
+def benchmark(root, base_id, seeders, chunks, chunk_size, speed):
+    downloader_id = base_id
+    seeder_ids = [base_id + 1 + i for i in range(seeders)]
+
+    create_network(
+        root,
+        {downloader_id: speed, **{s: speed for s in seeder_ids}},
+        {downloader_id: seeder_ids, **{s: [downloader_id] for s in seeder_ids}}
+    )
+
+    for i, s in enumerate(seeder_ids):
+        for c in range(i, chunks, seeders):
+            write_random_file(root / str(s) / f'{FILENAME}.ch{c}', chunk_size)
+
+    (root / str(downloader_id) / f'{FILENAME}.p2p').write_text(f'{FILENAME}\n{chunks}\n1\n')
+
+    downloader = Peer(downloader_id)
+    for s in seeder_ids:
+        Peer(s)
+
+    start = time.perf_counter()
+    watcher = FirstChunkWatcher(downloader, start)
+    watcher.start()
+
+    downloader.run(f'{FILENAME}.p2p')
+    total = time.perf_counter() - start
+
+    watcher.join(1)
+
+    return watcher.first_chunk, total
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure time to first byte with and without the event-driven search.')
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--chunks', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=256 * 1024)
+    parser.add_argument('--speed', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    with quiet():
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, event_driven in enumerate((False, True)):
+                Constants.UDP_CLIENT_EARLY_FINISH = event_driven
+                Constants.EARLY_FETCH = event_driven
+
+                first_chunk, total = benchmark(Path(tmp), i * (args.seeders + 1), args.seeders, args.chunks, args.chunk_size, args.speed)
+
+                name = 'event-driven' if event_driven else 'timeout'
+                report(f'{name:>12}: first chunk after {first_chunk:.2f}s, download complete after {total:.2f}s (search timeout {Constants.UDP_CLIENT_TIMEOUT}s)')
+
+if __name__ == '__main__':
+    main()
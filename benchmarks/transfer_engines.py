@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from fixtures import create_network, write_random_file, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+from models.tcpclient import TCPClient
+from models.asynctcpclient import AsyncTCPClient
+
+FILENAME = 'blob'
+
+def run_threads(client, server, connections):
+    clients = [TCPClient(client, server.address, server.port, None, FILENAME, [c]) for c in range(connections)]
+
+    for c in clients:
+        c.start()
+
+    for c in clients:
+        c.join()
+
+def run_asyncio(client, server, connections):
+    async def fetch_all():
+        clients = [AsyncTCPClient(client, server.address, server.port, None, FILENAME, [c]) for c in range(connections)]
+        await asyncio.gather(*(c.run() for c in clients))
+
+    client.event_loop().submit(fetch_all()).result()
+
+class ThreadCounter:
+    # Counts every thread started meanwhile, however short-lived, including the executor threads of the asyncio mode
+    def __enter__(self):
+        self.started = 0
+        self._lock = threading.Lock()
+        self._start = threading.Thread.start
+
+        counter = self
+        def start(thread):
+            with counter._lock:
+                counter.started += 1
+            counter._start(thread)
+
+        threading.Thread.start = start
+        return self
+
+    def __exit__(self, *exc):
+        threading.Thread.start = self._start
+
+def benchmark(mode, root, server_id, connections, chunk_size):
+    Constants.TRANSFER_MODE = mode
+
+    client_id = server_id + 1
+    create_network(root, {server_id: 10 ** 9, client_id: 10 ** 9}, {server_id: [client_id], client_id: [server_id]})
+
+    for c in range(connections):
+        write_random_file(root / str(server_id) / f'{FILENAME}.ch{c}', chunk_size)
+
+    server_peer = Peer(server_id)
+    client_peer = Peer(client_id)
+    server = server_peer.create_tcp_server()
+
+    with ThreadCounter() as threads:
+        start = time.perf_counter()
+
+        if mode == 'asyncio':
+            run_asyncio(client_peer, server, connections)
+        else:
+            run_threads(client_peer, server, connections)
+
+        elapsed = time.perf_counter() - start
+
+    return {
+        'mode': mode,
+        'connections': connections,
+        'elapsed': elapsed,
+        'connections_per_second': connections / elapsed,
+        'throughput_bytes_per_second': connections * chunk_size / elapsed,
+        'threads_started': threads.started
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the threaded and asyncio TCP transfer engines.')
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    # Chunk numbers are a single byte on the wire, so each connection fetches a distinct chunk below 256
+    if not 0 < args.connections <= 256:
+        parser.error('--connections must be between 1 and 256')
+
+    with quiet():
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+
+            for server_id, mode in ((0, 'threads'), (2, 'asyncio')):
+                results.append(benchmark(mode, root, server_id, args.connections, args.chunk_size))
+
+        for r in results:
+            report(f"{r['mode']:>8}: {r['connections']} connections in {r['elapsed']:.2f}s -> {r['connections_per_second']:.1f} conn/s, {r['throughput_bytes_per_second'] / 1e6:.2f} MB/s, {r['threads_started']} threads started")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import random
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from fixtures import create_network, mesh, quiet, report
+
+from utils.constants import Constants
+from utils.protocol import encode_query, response_query_id, ProtocolError
+from models.peer import Peer
+
+FILENAME = 'load'
+
+MODES = {
+    'inline': {'UDP_WORKERS': 0, 'UDP_SHED_POLICY': 'drop_oldest'},
+    'workers+drop_oldest': {'UDP_WORKERS': 4, 'UDP_SHED_POLICY': 'drop_oldest'},
+    'workers+lowest_ttl': {'UDP_WORKERS': 4, 'UDP_SHED_POLICY': 'lowest_ttl'}
+}
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else None
+
+def milliseconds(value):
+    return 'n/a' if value is None else f'{value * 1000:.1f} ms'
+
+def receive(sock, sent, answered, done):
+    # Only the first response to every query counts, it is when the requester learns about the peer
+    while not done.is_set():
+        try:
+            data = sock.recv(65535)
+        except socket.timeout:
+            continue
+
+        try:
+            query_id = response_query_id(data)
+        except ProtocolError:
+            continue
+
+        if query_id in sent and query_id not in answered:
+            answered[query_id] = time.perf_counter() - sent[query_id]
+
+def benchmark(root, base_id, mode, rate, duration, chunks, max_ttl, rng):
+    for name, value in MODES[mode].items():
+        setattr(Constants, name, value)
+
+    # The peer under load holds scattered chunks, so every response costs a chunk set to encode; its neighbor never runs
+    peer_id = base_id
+    create_network(root, {peer_id: 1 << 20, peer_id + 1: 1 << 20}, mesh([peer_id, peer_id + 1]))
+    for c in range(0, chunks * 2, 2):
+        (root / str(peer_id) / f'{FILENAME}.ch{c}').write_bytes(b'x' * 100)
+
+    peer = Peer(peer_id)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, Constants.UDP_RECV_BUFFER_SIZE)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.1)
+    address, port = sock.getsockname()
+
+    sent, answered = {}, {}
+    done = threading.Event()
+    receiver = threading.Thread(target=receive, args=(sock, sent, answered, done), daemon=True)
+    receiver.start()
+
+    # Open loop: queries go out on schedule whether or not the peer keeps up
+    start = time.perf_counter()
+    total = int(rate * duration)
+    for i in range(total):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        query_id = rng.getrandbits(32)
+        sent[query_id] = time.perf_counter()
+        sock.sendto(encode_query(rng.randint(1, max_ttl), 60000, query_id, address, port, FILENAME), peer.udp_server.address)
+
+    # Queries still waiting in the queue or the kernel are given a moment to be answered
+    time.sleep(1)
+    done.set()
+    receiver.join()
+    sock.close()
+
+    latencies = sorted(answered.values())
+    return total, len(answered) / duration, latencies, peer.udp_server.shed
+
+def main():
+    parser = argparse.ArgumentParser(description='Send queries to one peer at fixed rates, measuring the queries answered per second, the response latency and the queries shed with and without the UDP worker pool.')
+    parser.add_argument('--rates', type=int, nargs='+', default=[1000, 2000, 4000], help='queries per second')
+    parser.add_argument('--duration', type=float, default=3, help='seconds of load at every rate')
+    parser.add_argument('--chunks', type=int, default=200, help='scattered chunks announced in every response')
+    parser.add_argument('--max-ttl', type=int, default=1, help='queries get a TTL from 1 to this; above 1 they are also forwarded')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.REROUTE_DELAY = 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            base_id = 0
+            for rate in args.rates:
+                for mode in args.modes:
+                    total, answered_rate, latencies, shed = benchmark(Path(tmp), base_id, mode, rate, args.duration, args.chunks, args.max_ttl, random.Random(args.seed))
+                    base_id += 2
+
+                    report(f'{rate:>6} q/s {mode:>19}: {answered_rate:.0f} q/s answered ({len(latencies)}/{total}), p50 {milliseconds(percentile(latencies, 50))}, p99 {milliseconds(percentile(latencies, 99))}, {shed} shed')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import tempfile
+import time
+import threading
+from pathlib import Path
+
+from fixtures import create_network, chain, quiet, report
+
+from utils.constants import Constants
+from models.peer import Peer
+from models.availability import AvailabilityTable
+
+def benchmark(root, peers, queries, chunks):
+    ids = list(range(peers))
+    create_network(root, {id: 1000 for id in ids}, chain(ids))
+
+    for c in range(chunks):
+        (root / str(ids[-1]) / f'stress.ch{c}').write_bytes(b'x' * 100)
+
+    network = [Peer(id) for id in ids]
+    requester = network[0]
+
+    searches = []
+    for _ in range(queries):
+        availability = AvailabilityTable(chunks)
+        searches.append((availability, requester.search(peers - 1, 'stress', availability)))
+
+    latencies = [None] * queries
+    start = time.monotonic()
+
+    def run(i, client):
+        client.start()
+        client.join()
+        latencies[i] = time.monotonic() - start
+
+    threads = [threading.Thread(target=run, args=(i, client)) for i, (_, client) in enumerate(searches)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    succeeded = [latencies[i] for i, (availability, _) in enumerate(searches) if availability.all_located()]
+    dropped = sum(p.udp_server.forwards_dropped for p in network)
+
+    return len(succeeded), sorted(succeeded), dropped
+
+def main():
+    parser = argparse.ArgumentParser(description='Fire many concurrent searches from one peer through a chain of peers.')
+    parser.add_argument('--peers', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--chunks', type=int, default=4)
+    parser.add_argument('--reroute-delay', type=float, default=0.1)
+    args = parser.parse_args()
+
+    with quiet():
+        Constants.REROUTE_DELAY = args.reroute_delay
+        Constants.UDP_CLIENT_TIMEOUT = 5 + args.peers * args.reroute_delay
+        Constants.UDP_CLIENT_GRACE_PERIOD = 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            succeeded, latencies, dropped = benchmark(Path(tmp), args.peers, args.queries, args.chunks)
+
+        median = latencies[len(latencies) // 2] if latencies else 0
+        worst = latencies[-1] if latencies else 0
+
+        report(f'{args.queries} concurrent searches through {args.peers} peers: {succeeded} found every chunk, median {median * 1000:.0f} ms, worst {worst * 1000:.0f} ms, {dropped} forwards dropped')
+
+if __name__ == '__main__':
+    main()
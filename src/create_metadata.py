@@ -0,0 +1,46 @@
+import argparse
+from pathlib import Path
+
+from utils.constants import Constants
+from utils.files_reader import write_file_metadata
+from utils.hashing import hash_and_split
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the .p2p metadata file for a file, hashing it and optionally splitting it into chunks.')
+    parser.add_argument('file', type=Path)
+    parser.add_argument('chunks', type=int)
+    parser.add_argument('ttl', type=int)
+    parser.add_argument('--chunk-size', type=int, help='bytes per chunk, by default the file is split evenly')
+    parser.add_argument('--split', action='store_true', help='also write the <file>.chN chunk files')
+    args = parser.parse_args()
+
+    if args.chunks <= 0:
+        print('The number of chunks must be positive!')
+        return
+
+    if args.chunks > Constants.MAX_CHUNKS:
+        print(f'The number of chunks must be at most {Constants.MAX_CHUNKS}!')
+        return
+
+    try:
+        size, chunk_size, file_hash, chunk_hashes = hash_and_split(args.file, args.chunks, args.chunk_size, args.split)
+    except (OSError, ValueError) as e:
+        print(f'Could not create metadata file: {e}')
+        return
+
+    metadata_path = args.file.parent / f'{args.file.stem}.p2p'
+    write_file_metadata(metadata_path, {
+        'filename': args.file.name,
+        'chunks': args.chunks,
+        'ttl': args.ttl,
+        'size': size,
+        'chunk_size': chunk_size,
+        'file_hash': file_hash,
+        'chunk_hashes': chunk_hashes
+    })
+
+    print(f'Metadata file created: {metadata_path} ({Constants.HASH_ALGORITHM}, {args.chunks} chunks of {chunk_size} bytes)')
+
+if __name__ == '__main__':
+    main()
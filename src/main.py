@@ -14,7 +14,22 @@ def main():
     while True:
         metadata_file = input('Metadata file: ')
 
-        peer.run(metadata_file)
+        if not metadata_file:
+            for download in peer.downloads:
+                print(f'{download.metadata_file}: {download.state}, {download.progress():.0%}')
+
+            for (address, port), estimate in peer.estimator.estimates().items():
+                rtt = f"{estimate['rtt'] * 1000:.1f} ms" if estimate['rtt'] is not None else 'unknown'
+                throughput = f"{estimate['throughput']:.0f} B/s" if estimate['throughput'] is not None else 'unknown'
+                print(f'Source {address}:{port}: RTT {rtt}, throughput {throughput}')
+
+            stats = peer.content_store.stats()
+            quota = f"{stats['quota']} B" if stats['quota'] else 'no quota'
+            hit_rate = f"{stats['cache_hit_rate']:.0%}" if stats['cache_hit_rate'] is not None else 'n/a'
+            print(f"Store: {stats['used']} B ({quota}), {stats['evictions']} files removed, hot cache {stats['cached_chunks']} chunks, hit rate {hit_rate}")
+            continue
+
+        peer.download(metadata_file)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,428 @@
+import os
+import json
+import tempfile
+import threading
+import time
+
+from utils.constants import Constants
+from utils.hashing import new_hasher
+from utils.log import get_logger
+
+log = get_logger('assembler')
+
+class FileAssembler:
+    def __init__(self, folder, filename, size, chunk_size, file_hash = None, journal = False):
+        self._folder = folder
+        self._filename = filename
+        self._size = size
+        self._chunk_size = chunk_size
+        self._file_hash = file_hash
+
+        os.makedirs(folder / 'tmp', exist_ok=True)
+        self._path = folder / 'tmp' / f'{filename}.part'
+        self._journal_path = folder / 'tmp' / f'{filename}.journal' if journal else None
+
+        self._completed = set()
+        self._partial = {}
+        self._lock = threading.Lock()
+
+        # Chunks with a writer in their region, and a lock per chunk so a verified duplicate never interleaves with it
+        self._writing = set()
+        self._chunk_locks = {}
+        self._last_flush = 0
+
+        flags = os.O_RDWR | os.O_CREAT
+        if not self._load_journal():
+            flags |= os.O_TRUNC
+
+        self._fd = os.open(self._path, flags, 0o644)
+        self._preallocate()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def completed(self):
+        with self._lock:
+            return set(self._completed)
+
+    def is_complete(self, chunks):
+        # Chunks past the end of the file hold no bytes, so there is nothing to assemble for them
+        with self._lock:
+            return all(c in self._completed or not self.chunk_size(c) for c in range(chunks))
+
+    def chunk_size(self, chunk):
+        offset = chunk * self._chunk_size
+        return max(0, min(self._chunk_size, self._size - offset))
+
+    def position(self, chunk):
+        return chunk * self._chunk_size
+
+    def offset(self, chunk):
+        with self._lock:
+            if chunk in self._completed:
+                return self.chunk_size(chunk)
+
+            return self._partial.get(chunk, 0)
+
+    def resume_position(self):
+        # Where a full file transfer picks up: past the completed chunks at the start of the file and the bytes of the next one
+        with self._lock:
+            chunk = 0
+            while self.position(chunk) < self._size and chunk in self._completed:
+                chunk += 1
+
+            if self.position(chunk) >= self._size:
+                return self._size
+
+            # A chunk written to the end but not committed yet has its last byte fetched again, so it is still read back and verified
+            return self.position(chunk) + min(self._partial.get(chunk, 0), self.chunk_size(chunk) - 1)
+
+    def writer(self, chunk, size, tee = None, offset = 0, hasher = None):
+        if offset + size != self.chunk_size(chunk):
+            raise ValueError(f'Chunk {chunk} of {self._filename} has {offset + size} bytes, expected {self.chunk_size(chunk)}')
+
+        start = self.position(chunk)
+        tee = open(tee, 'wb') if tee else None
+
+        # Only one writer at a time owns the region of a chunk; a duplicate fetch of it is staged aside and copied in once verified
+        with self._lock:
+            staging = None
+            if chunk in self._writing:
+                staging = tempfile.TemporaryFile(dir=self._path.parent)
+            else:
+                self._writing.add(chunk)
+
+            lock = self._chunk_locks.setdefault(chunk, threading.Lock())
+
+        # A resumed chunk is only verified if the bytes already on disk go through the hash and into the chunk file too
+        position = 0
+        while position < offset:
+            block = os.pread(self._fd, min(Constants.TRANSFER_BLOCK_SIZE, offset - position), start + position)
+            if not block:
+                break
+
+            if hasher:
+                hasher.update(block)
+            if tee:
+                tee.write(block)
+            if staging:
+                staging.write(block)
+
+            position += len(block)
+
+        return ChunkWriter(self, chunk, start, offset, lock, tee, staging)
+
+    def stream(self, position, size, chunk_hashes = ()):
+        if position + size != self._size:
+            raise ValueError(f'Full file response of {self._filename} covers bytes {position} to {position + size}, expected up to {self._size}')
+
+        return StreamWriter(self, position, chunk_hashes)
+
+    def add_local(self, chunk, path):
+        writer = self.writer(chunk, os.stat(path).st_size)
+
+        with writer, open(path, 'rb') as f:
+            while block := f.read(Constants.TRANSFER_BLOCK_SIZE):
+                writer.write(block)
+
+        writer.completed()
+
+    def _commit(self, writer):
+        # Marked complete under the chunk lock, so a duplicate copied in is never overwritten by a slower writer of the region
+        with writer._lock:
+            if writer._staging and writer._chunk not in self.completed:
+                writer._staging.seek(0)
+                self._copy(writer._staging, writer._start)
+
+            with self._lock:
+                self._completed.add(writer._chunk)
+                self._partial.pop(writer._chunk, None)
+                self._release(writer)
+
+                self._flush()
+
+        if writer._staging:
+            writer._staging.close()
+
+    def _discard(self, writer):
+        if writer._staging:
+            writer._staging.close()
+            return
+
+        with self._lock:
+            self._release(writer)
+            if writer._chunk in self._completed:
+                return
+
+            self._partial.pop(writer._chunk, None)
+
+            self._flush()
+
+    def complete(self):
+        os.close(self._fd)
+        self._fd = None
+
+        destination = self._folder / self._filename
+        os.replace(self._path, destination)
+
+        if self._journal_path and os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+
+        return destination
+
+    def abort(self):
+        if self._fd is None:
+            return
+
+        os.close(self._fd)
+        self._fd = None
+
+        if self._journal_path:
+            with self._lock:
+                self._flush(force=True)
+
+            log.info('Keeping %s to resume %s later', self._path, self._filename)
+            return
+
+        os.remove(self._path)
+
+    def discard(self):
+        # The download finished without this file, e.g. from chunks already stored locally, so there is nothing to resume
+        if self._fd is None:
+            return
+
+        os.close(self._fd)
+        self._fd = None
+
+        os.remove(self._path)
+        if self._journal_path and os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+
+    def _advance(self, chunk, written):
+        with self._lock:
+            if chunk in self._completed or written <= self._partial.get(chunk, 0):
+                return
+
+            self._partial[chunk] = written
+
+            self._flush()
+
+    def _release(self, writer):
+        # Called with the lock held; the region is free again for the next fetch of the chunk
+        if not writer._staging and not writer._released:
+            writer._released = True
+            self._writing.discard(writer._chunk)
+
+    def _copy(self, source, position):
+        while block := source.read(Constants.TRANSFER_BLOCK_SIZE):
+            view = memoryview(block)
+            while view:
+                n = os.pwrite(self._fd, view, position)
+                position += n
+                view = view[n:]
+
+    def _load_journal(self):
+        if not self._journal_path or not os.path.exists(self._journal_path) or not os.path.exists(self._path):
+            return False
+
+        try:
+            with open(self._journal_path, 'r') as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if (journal.get('size'), journal.get('chunk_size'), journal.get('file_hash')) != (self._size, self._chunk_size, self._file_hash):
+            log.warning('Journal of %s does not match its metadata, starting over', self._filename)
+            return False
+
+        self._completed = set(journal['completed'])
+        self._partial = {int(c): written for c, written in journal['partial'].items()}
+
+        log.info('Resuming %s: %d chunks complete, %d bytes of partial chunks', self._filename, len(self._completed), sum(self._partial.values()))
+        return True
+
+    def _flush(self, force = False):
+        if not self._journal_path:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_flush < Constants.JOURNAL_FLUSH_INTERVAL:
+            return
+
+        self._last_flush = now
+
+        journal = {
+            'size': self._size,
+            'chunk_size': self._chunk_size,
+            'file_hash': self._file_hash,
+            'completed': sorted(self._completed),
+            'partial': self._partial
+        }
+
+        # Written aside and renamed, so a crash never leaves a half-written journal behind
+        path = self._journal_path.with_name(f'{self._journal_path.name}.new')
+        with open(path, 'w') as f:
+            json.dump(journal, f)
+
+        os.replace(path, self._journal_path)
+
+    def _preallocate(self):
+        os.ftruncate(self._fd, self._size)
+
+        # Reserve the blocks up front where supported, so chunks landing out of order do not fragment the file
+        if hasattr(os, 'posix_fallocate') and self._size:
+            try:
+                os.posix_fallocate(self._fd, 0, self._size)
+            except OSError:
+                pass
+
+class ChunkWriter:
+    def __init__(self, assembler, chunk, start, offset, lock, tee = None, staging = None):
+        self._assembler = assembler
+        self._chunk = chunk
+        self._start = start
+        self._written = offset
+        self._lock = lock
+        self._tee = tee
+        self._staging = staging
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if self._tee:
+            self._tee.close()
+
+        # An interrupted transfer keeps its partial progress, but leaves the region to the next fetch of the chunk
+        if exc_type is not None:
+            if self._staging:
+                self._staging.close()
+            else:
+                with self._assembler._lock:
+                    self._assembler._release(self)
+
+    def completed(self):
+        self._assembler._commit(self)
+
+    def failed(self):
+        self._assembler._discard(self)
+
+    def write(self, data):
+        if self._staging:
+            self._staging.write(data)
+        else:
+            with self._lock:
+                # A verified duplicate may have filled the chunk in the meantime, its content is kept
+                if self._chunk not in self._assembler._completed:
+                    view = memoryview(data)
+                    position = self._start + self._written
+
+                    while view:
+                        n = os.pwrite(self._assembler._fd, view, position)
+                        position += n
+                        view = view[n:]
+
+            self._written += len(data)
+
+        if self._tee:
+            self._tee.write(data)
+
+        if not self._staging:
+            self._assembler._advance(self._chunk, self._written)
+
+class StreamWriter:
+    # A full file response written chunk by chunk, so its progress is journaled and every chunk with a hash is verified on its own
+    def __init__(self, assembler, position, chunk_hashes):
+        self._assembler = assembler
+        self._position = position
+        self._chunk_hashes = chunk_hashes
+
+        self._chunk = None
+        self._writer = None
+        self._hasher = None
+        self._remaining = 0
+
+        # Chunks with no hash wait for the checksum of the whole response
+        self._unverified = []
+        self._mismatches = []
+
+    @property
+    def mismatches(self):
+        return list(self._mismatches)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            return
+
+        for writer in ([self._writer] if self._writer else []) + self._unverified:
+            writer.__exit__(exc_type, *exc)
+
+        self._writer = None
+        self._unverified = []
+
+    def completed(self):
+        for writer in self._unverified:
+            writer.completed()
+
+        self._unverified = []
+
+    def failed(self):
+        for writer in self._unverified:
+            writer.failed()
+
+        self._unverified = []
+
+    def write(self, data):
+        view = memoryview(data)
+
+        while view:
+            if not self._remaining:
+                self._open()
+
+            part = view[:self._remaining]
+            if self._writer:
+                if self._hasher:
+                    self._hasher.update(part)
+                self._writer.write(part)
+
+            self._position += len(part)
+            self._remaining -= len(part)
+            view = view[len(part):]
+
+            if not self._remaining:
+                self._close()
+
+    def _open(self):
+        assembler = self._assembler
+
+        self._chunk = self._position // assembler._chunk_size
+        offset = self._position - assembler.position(self._chunk)
+        self._remaining = assembler.chunk_size(self._chunk) - offset
+
+        # A chunk completed before, out of order, is received again but left as it is
+        if self._chunk in assembler.completed:
+            self._writer = self._hasher = None
+            return
+
+        expected = self._chunk_hashes[self._chunk] if self._chunk < len(self._chunk_hashes) else None
+        self._hasher = new_hasher() if expected else None
+        self._writer = assembler.writer(self._chunk, self._remaining, None, offset, self._hasher)
+
+    def _close(self):
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+
+        if self._hasher is None:
+            self._unverified.append(writer)
+        elif self._hasher.hexdigest() == self._chunk_hashes[self._chunk]:
+            writer.completed()
+        else:
+            self._mismatches.append(self._chunk)
+            writer.failed()
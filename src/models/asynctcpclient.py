@@ -0,0 +1,179 @@
+import asyncio
+import struct
+import time
+import zlib
+import concurrent.futures
+from contextlib import asynccontextmanager
+
+from utils.constants import Constants
+from models.tcpclient import ChunksTransfer
+from models.eventloop import blocking
+from utils.log import get_logger
+
+log = get_logger('asynctcpclient')
+
+class AsyncTCPClient:
+    def __init__(self, peer, address, port, semaphore, filename, chunks, assembler = None, metadata = None):
+        self._peer = peer
+
+        self._server_address = address
+        self._server_port = port
+
+        self._semaphore = semaphore
+
+        self._transfer = ChunksTransfer(peer, address, port, filename, chunks, assembler, metadata)
+
+        self._error = None
+        self._cancelled = False
+        self._future = None
+        self._writer = None
+
+    @property
+    def received(self):
+        return self._transfer.received
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def busy(self):
+        return self._transfer.busy
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def start(self):
+        self._future = self._peer.event_loop().submit(self.run())
+
+    def join(self):
+        try:
+            self._future.result()
+        except concurrent.futures.CancelledError:
+            pass
+
+    def cancel(self):
+        self._cancelled = True
+
+        # Like the threaded client shutting its socket down: the transfer fails at its next read, never in the middle of a disk write
+        if self._future:
+            self._peer.event_loop().loop.call_soon_threadsafe(self._abort)
+
+    def _abort(self):
+        if self._writer:
+            self._writer.transport.abort()
+
+    async def run(self):
+        try:
+            await self._fetch()
+        except Exception as e:
+            self._error = e
+
+            if not self._cancelled:
+                log.warning('Async TCP Client -> An error occurred: %s', e)
+        finally:
+            # Acquired by the caller, like for the threaded client; releasing a threading semaphore never blocks the loop
+            if self._semaphore:
+                self._semaphore.release()
+
+    async def _fetch(self):
+        if self._cancelled:
+            return
+
+        log.debug('Async TCP Client running...')
+
+        connection = self._peer.async_connection_pool.take(self._server_address, self._server_port)
+        reused = connection is not None
+
+        if not reused:
+            connection = await asyncio.open_connection(self._server_address, self._server_port, limit=Constants.RECV_BUFFER_SIZE)
+
+        reusable = False
+        try:
+            try:
+                await self._request(*connection)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server may have closed an idle pooled connection; that is only safe to retry before any data arrived
+                if not reused or self._transfer.received or self._cancelled:
+                    raise
+
+                log.debug('Async TCP Client -> Pooled connection was closed, reconnecting')
+                connection[1].close()
+                connection = await asyncio.open_connection(self._server_address, self._server_port, limit=Constants.RECV_BUFFER_SIZE)
+                await self._request(*connection)
+
+            reusable = True
+        finally:
+            # A late cancel must not abort the connection once another client may have taken it from the pool
+            self._writer = None
+
+            if reusable and not self._cancelled:
+                self._peer.async_connection_pool.put(self._server_address, self._server_port, connection)
+            else:
+                connection[1].close()
+
+    async def _request(self, reader, writer):
+        self._writer = writer
+        if self._cancelled:
+            return
+
+        transfer = self._transfer
+
+        writer.write(transfer.message)
+        await writer.drain()
+
+        await blocking(transfer.prepare)
+
+        for i in range(transfer.responses):
+            start = time.perf_counter()
+            header = await reader.readexactly(struct.calcsize(Constants.CHUNKS_RESPONSE_HEADER_FORMAT))
+
+            response = transfer.begin(i, header, start)
+            if response is None:
+                return
+
+            try:
+                async with open_async_destination(response) as f:
+                    checksum = await receive_payload(reader, f, response.size, response.hasher)
+                    transfer.transferred(response)
+
+                    expected_checksum = await reader.readexactly(4) if response.checksummed else None
+
+                await blocking(transfer.finish, response, f, checksum, expected_checksum)
+            except BaseException:
+                await blocking(response.abandon)
+                raise
+
+@asynccontextmanager
+async def open_async_destination(response):
+    f = await blocking(response.open)
+
+    try:
+        yield f
+    except BaseException as e:
+        await blocking(f.__exit__, type(e), e, e.__traceback__)
+        raise
+
+    await blocking(f.__exit__, None, None, None)
+
+async def receive_payload(reader, f, size, hasher = None):
+    checksum = 0
+
+    remaining = size
+    while remaining > 0:
+        data = await reader.read(min(remaining, Constants.RECV_BUFFER_SIZE))
+        if not data:
+            raise ConnectionError('Connection closed by the server')
+
+        checksum = await blocking(consume, f, data, checksum, hasher)
+        remaining -= len(data)
+
+    return checksum
+
+def consume(f, data, checksum, hasher):
+    if hasher:
+        hasher.update(data)
+    f.write(data)
+
+    return zlib.crc32(data, checksum)
@@ -0,0 +1,228 @@
+import os
+import asyncio
+import struct
+import time
+import zlib
+
+from utils.constants import Constants
+from utils.protocol import CHUNKS_REQUEST_PREFIX, chunks_request_length, decode_chunks_request
+from utils.log import get_logger
+from models.eventloop import blocking
+from models.tcpserver import build_busy_message, build_file_declaration_message, checksum_enabled, remaining_bytes, truncated_file_error, upload_metrics, log_sent
+
+log = get_logger('asynctcpserver')
+
+class AsyncTCPServer:
+    def __init__(self, address, port, peer, event_loop):
+        self._address = address
+        self._port = port
+        self._peer = peer
+        self._event_loop = event_loop
+
+        self._server = None
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def port(self):
+        return self._port
+
+    def start(self):
+        self._server = self._event_loop.submit(self._start_server()).result()
+
+        log.info('Async TCP Server (Address: %s, Port: %s) listening...', self._address, self._port)
+
+    def stop(self):
+        if self._server:
+            self._event_loop.loop.call_soon_threadsafe(self._server.close)
+
+    async def _start_server(self):
+        return await asyncio.start_server(self._handle_connection, self._address, self._port, backlog=Constants.TCP_SERVER_BACKLOG)
+
+    async def _handle_connection(self, reader, writer):
+        log.debug('Async TCP Server connected to: %s', writer.get_extra_info('peername'))
+        requests, bytes_sent, request_seconds = upload_metrics(self._peer)
+        client = writer.get_extra_info('peername')[0]
+
+        try:
+            # Connections are persistent: requests are served one after the other until the client closes or goes idle
+            while True:
+                request = await asyncio.wait_for(receive_chunks_request(reader, self._peer), Constants.TCP_SERVER_IDLE_TIMEOUT)
+                if request is None:
+                    return
+
+                if not self._peer.acquire_upload_slot():
+                    log.debug('Async TCP Server -> No upload slot left, rejecting request')
+                    requests.inc(1, 'busy')
+                    writer.write(build_busy_message())
+                    await writer.drain()
+                    continue
+
+                try:
+                    start = time.perf_counter()
+                    with self._peer.content_store.serving(request[1]):
+                        sent = await serve_request(writer, self._peer, *request)
+
+                    request_seconds.observe(time.perf_counter() - start)
+                    requests.inc(1, 'served')
+                    bytes_sent.inc(sent, client)
+                finally:
+                    self._peer.change_active_tcp_connections(-1)
+        except asyncio.TimeoutError:
+            log.debug('Async TCP Server -> Closing idle connection')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            log.debug('Async TCP Server -> Client disconnected')
+        except Exception as e:
+            requests.inc(1, 'failed')
+            log.exception('Async TCP Server -> An error occurred: %s', e)
+        finally:
+            writer.close()
+            log.debug('Async TCP Server -> Connection closed!')
+
+async def receive_chunks_request(reader, peer):
+    try:
+        prefix = await reader.readexactly(CHUNKS_REQUEST_PREFIX.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+
+        raise
+
+    number_of_chunks, filename, file_hash, ranges = decode_chunks_request(await reader.readexactly(chunks_request_length(prefix)))
+
+    return number_of_chunks, peer.file_index.resolve(filename, file_hash), ranges
+
+async def serve_request(writer, peer, number_of_chunks, filename, ranges):
+    if number_of_chunks == 0:
+        log.debug('Async TCP Server received request to send full file: Number of Chunks -> %s, Filename -> %s', number_of_chunks, filename)
+
+        filepath = Constants.FILES_PATH / str(peer.id) / filename
+        _, offset = ranges[0]
+        size = remaining_bytes(await blocking(os.path.getsize, filepath), offset)
+
+        writer.write(build_file_declaration_message(0, 1, size))
+
+        await send_range(writer, peer, filename, offset, size, 0, filename)
+
+        return size
+    else:
+        log.debug('Async TCP Server received request to send chunks: Number of Chunks -> %s, Filename -> %s, Ranges -> %s', number_of_chunks, filename, ranges)
+
+        sent = 0
+        for c, offset in ranges:
+            log.debug('Async TCP Server sending file: Filename -> %s, Chunk -> %s, Offset -> %s', filename, c, offset)
+
+            chunk_range = peer.file_index.chunk_range(filename, c)
+            if chunk_range is None:
+                raise FileNotFoundError(f'Chunk {c} of {filename} is not available')
+
+            source_filename, start, chunk_size = chunk_range
+            size = remaining_bytes(chunk_size, offset)
+
+            writer.write(build_file_declaration_message(c, 0, size))
+
+            try:
+                await send_range(writer, peer, source_filename, start, chunk_size, offset, f'{filename}.ch{c}')
+            except FileNotFoundError:
+                # The partial file of a download finishing meanwhile was renamed, the chunk is now read from the completed file
+                chunk_range = peer.file_index.chunk_range(filename, c)
+                if chunk_range is None or chunk_range[0] == source_filename:
+                    raise
+
+                source_filename, start, _ = chunk_range
+
+                await send_range(writer, peer, source_filename, start, chunk_size, offset, f'{filename}.ch{c}')
+
+            sent += size
+
+        return sent
+
+async def send_range(writer, peer, source_filename, start, size, offset, filename):
+    # Like the client, every disk access runs on the executor, so a cold page cache stalls only this transfer
+    cached = await blocking(peer.content_store.read, source_filename, start, size)
+    if cached is None:
+        await send_file(writer, peer, Constants.FILES_PATH / str(peer.id) / source_filename, filename, start + offset, size - offset)
+        return
+
+    content, checksum = cached
+    if offset:
+        content, checksum = memoryview(content)[offset:], None
+
+    await send_content(writer, peer, content, filename, checksum)
+
+async def send_content(writer, peer, content, filename, checksum = None):
+    bucket = peer.upload_bucket
+    block_size = min(Constants.TRANSFER_BLOCK_SIZE, bucket.capacity)
+    content = memoryview(content)
+
+    for position in range(0, len(content), block_size):
+        block = content[position:position + block_size]
+
+        await bucket.consume_async(len(block))
+        writer.write(block)
+        await writer.drain()
+
+    log_sent('Async TCP', filename, bucket)
+
+    if checksum_enabled():
+        if checksum is None:
+            checksum = zlib.crc32(content)
+
+        writer.write(struct.pack(Constants.CHUNKS_RESPONSE_CHECKSUM_FORMAT, checksum))
+        await writer.drain()
+
+async def send_file(writer, peer, filepath, filename, offset = 0, size = None):
+    bucket = peer.upload_bucket
+    block_size = min(Constants.TRANSFER_BLOCK_SIZE, bucket.capacity)
+    checksum = 0
+
+    f = await blocking(open, filepath, 'rb')
+    try:
+        if size is None:
+            size = (await blocking(os.fstat, f.fileno())).st_size - offset
+
+        end = offset + size
+
+        if Constants.TCP_SERVER_SENDFILE:
+            loop = asyncio.get_running_loop()
+            await writer.drain()
+
+            while offset < end:
+                count = min(block_size, end - offset)
+
+                await bucket.consume_async(count)
+                sent = await loop.sendfile(writer.transport, f, offset, count)
+
+                # A file truncated or evicted while being sent makes no progress, instead of being retried forever
+                if not sent:
+                    raise truncated_file_error(filename, end - offset)
+
+                offset += sent
+
+            log_sent('Async TCP', filename, bucket)
+            return
+
+        while offset < end:
+            content = await blocking(os.pread, f.fileno(), min(block_size, end - offset), offset)
+
+            if not content:
+                raise truncated_file_error(filename, end - offset)
+
+            offset += len(content)
+
+            if checksum_enabled():
+                checksum = zlib.crc32(content, checksum)
+
+            await bucket.consume_async(len(content))
+            writer.write(content)
+            await writer.drain()
+
+        log_sent('Async TCP', filename, bucket)
+    finally:
+        await blocking(f.close)
+
+    if checksum_enabled():
+        writer.write(struct.pack(Constants.CHUNKS_RESPONSE_CHECKSUM_FORMAT, checksum))
+        await writer.drain()
@@ -0,0 +1,183 @@
+import threading
+from array import array
+
+from utils import bitfield
+
+LOCAL = ('local', 'local')
+
+NO_TIME = 2 ** 64 - 1
+NO_SOURCE = -1
+LOCAL_SOURCE = -2
+
+class AvailabilityTable:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._all = bitfield.from_range(0, chunks)
+        self._lock = threading.Lock()
+
+        # One bitfield per source of the chunks it advertised, and one per advertised sending time
+        self._sources = []
+        self._indexes = {}
+        self._have = []
+        self._times = []
+
+        # Best time and source of every chunk, plus the chunks grouped by their best time, so a merge finds the chunks it improves with a few bitfield operations
+        self._best_time = array('Q', [NO_TIME]) * chunks
+        self._best_source = array('l', [NO_SOURCE]) * chunks
+        self._layers = {}
+        self._located = 0
+
+        # Number of sources of every chunk as bit slices: slice k holds bit k of every count, so counting and finding the rarest chunks are bitfield operations
+        self._counts = []
+
+        self._file_sources = {}
+        self._loads = {}
+
+    @property
+    def chunks(self):
+        return self._chunks
+
+    @property
+    def sources(self):
+        with self._lock:
+            return list(self._sources)
+
+    @property
+    def located(self):
+        return self._located
+
+    @property
+    def file_sources(self):
+        with self._lock:
+            return dict(self._file_sources)
+
+    def add_local(self, chunks):
+        with self._lock:
+            self._improve(LOCAL_SOURCE, 0, bitfield.from_chunks(c for c in chunks if c < self._chunks))
+
+    def merge(self, source, chunk_times, full_file_time = None, load = None):
+        with self._lock:
+            index = self._indexes.get(source)
+            if index is None:
+                index = len(self._sources)
+                self._indexes[source] = index
+                self._sources.append(source)
+                self._have.append(0)
+                self._times.append({})
+
+            times = self._times[index]
+
+            for time, chunks in sorted(chunk_times.items()):
+                chunks &= self._all
+                if not chunks:
+                    continue
+
+                # The latest advertisement of a source replaces its earlier time for the same chunks
+                for t in times:
+                    if t != time and times[t] & chunks:
+                        times[t] &= ~chunks
+
+                times[time] = times.get(time, 0) | chunks
+
+                self._count(chunks & ~self._have[index])
+                self._have[index] |= chunks
+
+                self._improve(index, time, chunks)
+
+            if full_file_time is not None:
+                self._file_sources[source] = full_file_time
+
+            if load is not None:
+                self._loads[source] = load
+
+    def all_located(self):
+        return self._located == self._all
+
+    def missing(self):
+        return bitfield.chunks(self._all & ~self._located)
+
+    def best(self, chunk):
+        with self._lock:
+            index = self._best_source[chunk]
+            if index == NO_SOURCE:
+                return None
+
+            source = LOCAL if index == LOCAL_SOURCE else self._sources[index]
+            return source, self._best_time[chunk]
+
+    def best_file_source(self):
+        with self._lock:
+            if not self._file_sources:
+                return None
+
+            source = min(self._file_sources, key=self._file_sources.get)
+            return source, self._file_sources[source]
+
+    def load(self, source):
+        with self._lock:
+            return self._loads.get(source, (0, 0))
+
+    def source_chunks(self, source):
+        with self._lock:
+            index = self._indexes.get(source)
+            return 0 if index is None else self._have[index]
+
+    def source_times(self, source):
+        with self._lock:
+            index = self._indexes.get(source)
+            return {} if index is None else dict(self._times[index])
+
+    def source_time(self, source, chunk):
+        with self._lock:
+            index = self._indexes.get(source)
+            if index is None:
+                return None
+
+            times = [t for t, chunks in self._times[index].items() if bitfield.contains(chunks, chunk)]
+            return min(times) if times else None
+
+    def availability(self, chunk):
+        with self._lock:
+            return sum(1 << k for k, counts in enumerate(self._counts) if bitfield.contains(counts, chunk))
+
+    def rarest(self, chunks):
+        with self._lock:
+            for counts in reversed(self._counts):
+                fewer = chunks & ~counts
+                if fewer:
+                    chunks = fewer
+
+            return chunks
+
+    def _count(self, chunks):
+        carry = chunks
+        for k, counts in enumerate(self._counts):
+            if not carry:
+                return
+
+            self._counts[k] = counts ^ carry
+            carry &= counts
+
+        if carry:
+            self._counts.append(carry)
+
+    def _improve(self, index, time, chunks):
+        covered = 0
+        for t, layer in self._layers.items():
+            if t <= time:
+                covered |= layer
+
+        better = chunks & ~covered
+        if not better:
+            return
+
+        for t in self._layers:
+            if t > time and self._layers[t] & better:
+                self._layers[t] &= ~better
+
+        self._layers[time] = self._layers.get(time, 0) | better
+        self._located |= better
+
+        for c in bitfield.chunks(better):
+            self._best_time[c] = time
+            self._best_source[c] = index
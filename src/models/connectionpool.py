@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import defaultdict
+
+from utils.constants import Constants
+
+class ConnectionPool:
+    def __init__(self, close, is_open = None):
+        self._close = close
+        self._is_open = is_open
+
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+        self._opened = 0
+        self._reused = 0
+
+    @property
+    def opened(self):
+        return self._opened
+
+    @property
+    def reused(self):
+        return self._reused
+
+    def take(self, address, port):
+        expired = []
+        connection = None
+
+        with self._lock:
+            idle = self._idle[(address, port)]
+            now = time.monotonic()
+
+            while idle:
+                candidate, released = idle.pop()
+
+                if now - released > Constants.TCP_POOL_IDLE_TIMEOUT or (self._is_open and not self._is_open(candidate)):
+                    expired.append(candidate)
+                    continue
+
+                connection = candidate
+                break
+
+            if connection is None:
+                self._opened += 1
+            else:
+                self._reused += 1
+
+        for c in expired:
+            self._close(c)
+
+        return connection
+
+    def put(self, address, port, connection):
+        if not Constants.TCP_CONNECTION_POOL:
+            self._close(connection)
+            return
+
+        with self._lock:
+            idle = self._idle[(address, port)]
+
+            if len(idle) < Constants.TCP_POOL_MAX_IDLE:
+                idle.append((connection, time.monotonic()))
+                return
+
+        self._close(connection)
+
+    def close_all(self):
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c, _ in idle]
+            self._idle.clear()
+
+        for c in connections:
+            self._close(c)
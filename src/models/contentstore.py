@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils.constants import Constants
+from utils.log import get_logger
+from models.fileindex import METADATA_EXTENSION
+
+log = get_logger('contentstore')
+
+# Files of the peer folder that describe the peer, not content it stores
+PEER_FILES = {'config.txt', 'topologia.txt'}
+
+class ContentStore:
+    def __init__(self, folder, file_index, metrics):
+        self._folder = folder
+        self._file_index = file_index
+
+        # Per file: last access (wall clock, so files not accessed yet can start from their modification time) and requests served
+        self._accesses = {}
+        # Per base filename: downloads and requests using it, none of its files is evicted meanwhile
+        self._pins = {}
+        # Chunk files of downloads whose full file was assembled, removed once nothing uses them
+        self._redundant = set()
+        self._lock = threading.Lock()
+
+        # Per chunk: the file identity it was read from (so a replaced file is read again), its content and CRC32, least recently used first
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        # Requests of chunks not cached yet, the least recent forgotten first
+        self._requests = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        self._cache_requests = metrics.counter('p2p_hot_cache_requests_total', 'Chunk reads by the TCP servers, by whether the hot cache had them', ('result',))
+        self._evictions = metrics.counter('p2p_store_evictions_total', 'Files deleted from the peer folder, by reason', ('reason',))
+        self._evicted_bytes = metrics.counter('p2p_store_evicted_bytes_total', 'Bytes of files deleted from the peer folder, by reason', ('reason',))
+
+    def pin(self, filename):
+        with self._lock:
+            self._pins[filename] = self._pins.get(filename, 0) + 1
+
+    def unpin(self, filename):
+        with self._lock:
+            if self._pins.get(filename, 0) <= 1:
+                self._pins.pop(filename, None)
+            else:
+                self._pins[filename] -= 1
+
+    @contextmanager
+    def serving(self, filename):
+        self.pin(filename)
+        try:
+            yield
+        finally:
+            self.unpin(filename)
+
+    def add(self, path):
+        self._file_index.add(path)
+        self._touch(path.name, 0)
+        self.reclaim()
+
+    def assembled(self, filename, chunks):
+        # The chunks of a full file are served from it when its metadata gives the chunk sizes, so their own files only take space
+        if not Constants.STORE_REMOVE_ASSEMBLED_CHUNKS or not self._file_index.serves_chunks(filename):
+            return
+
+        with self._lock:
+            self._redundant.update(f'{filename}.ch{c}' for c in range(chunks))
+
+    def reclaim(self):
+        files = self._file_index.files()
+
+        with self._lock:
+            for filename in list(self._redundant):
+                if self._pinned(filename):
+                    continue
+
+                self._redundant.discard(filename)
+                if filename in files:
+                    self._evict(filename, files.pop(filename), 'assembled')
+
+            if not Constants.STORE_QUOTA:
+                return
+
+            content = {f: size for f, size in files.items() if self._evictable(f)}
+            used = sum(content.values())
+            if used <= Constants.STORE_QUOTA:
+                return
+
+            for filename in sorted(content, key=self._eviction_key):
+                if used <= Constants.STORE_QUOTA:
+                    break
+
+                if self._pinned(filename):
+                    continue
+
+                if self._evict(filename, content[filename], 'quota'):
+                    used -= content[filename]
+
+            if used > Constants.STORE_QUOTA:
+                log.warning('Content Store -> %d bytes in use over a quota of %d, the rest is in use by downloads or uploads', used, Constants.STORE_QUOTA)
+
+            # Forget the accesses of files no longer in the folder
+            for filename in list(self._accesses):
+                if filename not in content:
+                    del self._accesses[filename]
+
+    def read(self, filename, offset, size):
+        # Content and CRC32 of a chunk served from memory, or None when it has to be read from disk
+        self._touch(filename, 1)
+
+        if not Constants.HOT_CACHE_SIZE or size > Constants.HOT_CACHE_MAX_CHUNK:
+            return None
+
+        path = self._folder / filename
+        stat = os.stat(path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        key = (filename, offset, size)
+
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == identity:
+                self._cache.move_to_end(key)
+                self._cache_requests.inc(1, 'hit')
+                return cached[1:]
+
+            self._cache_requests.inc(1, 'miss')
+
+            requests = self._requests.pop(key, 0) + 1
+            if requests < Constants.HOT_CACHE_MIN_REQUESTS:
+                self._requests[key] = requests
+                if len(self._requests) > Constants.HOT_CACHE_TRACKED_CHUNKS:
+                    self._requests.popitem(last=False)
+                return None
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            content = f.read(size)
+
+        if len(content) != size:
+            return None
+
+        checksum = zlib.crc32(content)
+
+        with self._cache_lock:
+            self._uncache(key)
+            self._cache[key] = (identity, content, checksum)
+            self._cached_bytes += size
+
+            while self._cached_bytes > Constants.HOT_CACHE_SIZE:
+                self._uncache(next(iter(self._cache)))
+
+        return content, checksum
+
+    def stats(self):
+        hits, misses = self._cache_requests.value('hit'), self._cache_requests.value('miss')
+        reasons = ('assembled', 'quota')
+
+        with self._cache_lock:
+            cached_chunks, cached_bytes = len(self._cache), self._cached_bytes
+
+        return {
+            'used': sum(size for f, size in self._file_index.files().items() if self._evictable(f)),
+            'quota': Constants.STORE_QUOTA,
+            'evictions': sum(self._evictions.value(r) for r in reasons),
+            'evicted_bytes': sum(self._evicted_bytes.value(r) for r in reasons),
+            'cache_hits': hits,
+            'cache_misses': misses,
+            'cache_hit_rate': hits / (hits + misses) if hits + misses else None,
+            'cached_chunks': cached_chunks,
+            'cached_bytes': cached_bytes
+        }
+
+    def _touch(self, filename, requests):
+        with self._lock:
+            _, served = self._accesses.get(filename, (None, 0))
+            self._accesses[filename] = (time.time(), served + requests)
+
+    def _eviction_key(self, filename):
+        last_access, requests = self._accesses.get(filename) or (self._modified(filename), 0)
+
+        if Constants.STORE_EVICTION == 'popularity':
+            return requests, last_access
+
+        return last_access
+
+    def _modified(self, filename):
+        try:
+            return os.stat(self._folder / filename).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def _evictable(self, filename):
+        return filename not in PEER_FILES and not filename.endswith(METADATA_EXTENSION)
+
+    def _pinned(self, filename):
+        base, _ = self._file_index.parse(filename)
+        return base in self._pins
+
+    def _evict(self, filename, size, reason):
+        # Removed from the index along with the file, so queries stop offering it at once
+        if not self._file_index.delete(filename):
+            return False
+
+        self._accesses.pop(filename, None)
+        self._evictions.inc(1, reason)
+        self._evicted_bytes.inc(size, reason)
+
+        with self._cache_lock:
+            for key in [k for k in self._cache if k[0] == filename]:
+                self._uncache(key)
+
+        log.debug('Content Store -> Removed %s (%d bytes, %s)', filename, size, reason)
+        return True
+
+    def _uncache(self, key):
+        cached = self._cache.pop(key, None)
+        if cached:
+            self._cached_bytes -= len(cached[1])
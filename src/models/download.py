@@ -0,0 +1,356 @@
+import threading
+import time
+
+from utils.files_reader import read_file_metadata
+from utils.constants import Constants
+from utils.log import get_logger
+from utils.protocol import decode_response, ProtocolError
+from utils import bitfield
+from models.scheduler import DownloadScheduler
+from models.assembler import FileAssembler
+from models.availability import AvailabilityTable
+from models.estimator import parallel_makespan
+
+log = get_logger('download')
+
+class Download(threading.Thread):
+    def __init__(self, peer, metadata_file):
+        super().__init__(daemon=True)
+
+        self._peer = peer
+        self._metadata_file = metadata_file
+
+        self._filename = None
+        self._metadata = None
+        self._chunks = 0
+        self._ttl = 0
+        self._availability = None
+        self._scheduler = None
+        self._assembler = None
+        self._query_id = None
+        self._search = None
+        self._file_sources = []
+        self._local_chunks = 0
+
+        self._state = 'pending'
+        self._succeeded = False
+        self._start_time = None
+        self._end_time = None
+        self._finished = threading.Event()
+
+    @property
+    def metadata_file(self):
+        return self._metadata_file
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def succeeded(self):
+        return self._succeeded
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    @property
+    def completion_time(self):
+        if self._end_time is None:
+            return None
+
+        return self._end_time - self._start_time
+
+    @property
+    def search_latency(self):
+        # Seconds from sending the query until every chunk, or the full file, had a source
+        return self._search.located_after if self._search else None
+
+    @property
+    def search_responses(self):
+        return self._search.responses if self._search else 0
+
+    def progress(self):
+        if self._succeeded:
+            return 1.0
+
+        if self._scheduler is None or not self._chunks:
+            return 0.0
+
+        return (self._local_chunks + self._scheduler.completed) / self._chunks
+
+    def wait(self, timeout = None):
+        self._finished.wait(timeout)
+
+        return self._succeeded
+
+    def start(self):
+        self._start_time = time.monotonic()
+        super().start()
+
+    def run(self):
+        try:
+            self._succeeded = self._download()
+        except Exception as e:
+            log.exception('Download %s -> An error occurred: %s', self._metadata_file, e)
+        finally:
+            self._end_time = time.monotonic()
+            self._state = 'completed' if self._succeeded else 'failed'
+            self._finished.set()
+
+            self._peer.download_finished(self)
+
+    def _download(self):
+        if not self._verify_metadata_file_validity():
+            return False
+
+        self._metadata = read_file_metadata(self._peer.id, self._metadata_file)
+        self._filename, self._chunks, self._ttl = self._metadata['filename'], self._metadata['chunks'], self._metadata['ttl']
+        if not self._verify_file_need():
+            return False
+
+        # None of the files of the download is evicted while it runs
+        self._peer.content_store.pin(self._filename)
+
+        succeeded = False
+        try:
+            self._create_availability_table()
+
+            if Constants.ASSEMBLY_MODE == 'positional' and self._metadata['size'] is not None and self._metadata['chunk_size'] is not None:
+                self._create_assembler(self._metadata['size'], self._metadata['chunk_size'])
+
+            if not self._fetch():
+                return False
+
+            self._peer.content_store.assembled(self._filename, self._chunks)
+            succeeded = True
+            return True
+        finally:
+            if self._query_id is not None:
+                self._peer.search_socket.unsubscribe(self._query_id)
+
+            self._peer.file_index.remove_partial(self._filename)
+
+            # A failed download keeps its partial file to resume later, a finished one that did not assemble into it leaves nothing behind
+            if self._assembler:
+                if succeeded:
+                    self._assembler.discard()
+                else:
+                    self._assembler.abort()
+
+            self._peer.content_store.unpin(self._filename)
+            self._peer.content_store.reclaim()
+
+    def _fetch(self):
+        if self._verify_all_chunks_present_locally():
+            return True
+
+        missing_chunks = self._availability.missing()
+        self._local_chunks = self._chunks - len(missing_chunks)
+        self._scheduler = DownloadScheduler(self._peer, self._filename, missing_chunks, self._availability, self._assembler, self._metadata)
+        early_fetch = Constants.EARLY_FETCH and Constants.CHUNK_SCHEDULER != 'static'
+
+        client = self._peer.search(self._ttl, self._filename, self._availability, self._scheduler.refresh_sources if early_fetch else None, self._metadata['file_hash'])
+        self._search = client
+
+        # Chunks announced by other peers after the search ended become new sources for the rest of the download
+        if Constants.ANNOUNCE_CHUNKS:
+            self._query_id = client.query_id
+            self._peer.search_socket.subscribe(self._query_id, self._on_announcement)
+
+        if early_fetch:
+            self._scheduler.start()
+
+        self._state = 'searching'
+        client.start()
+        client.join()
+
+        if self._verify_file_unretrievable():
+            self._scheduler.stop()
+            return False
+
+        self._state = 'fetching'
+
+        fetching_technique = self._choose_fetching_technique()
+        if fetching_technique == 'file':
+            self._scheduler.stop()
+            if self._fetch_full_file():
+                if self._assembler:
+                    self._create_full_file()
+
+                log.info('File %s downloaded!', self._filename)
+                return True
+
+            # The full file source may stay busy with other downloaders, while the chunks can still be spread over every source
+            if not self._availability.all_located():
+                return False
+
+            # Chunks the full file transfer already assembled are not fetched again
+            remaining = bitfield.chunks(self._scheduler.remaining)
+            if self._assembler:
+                completed = self._assembler.completed
+                remaining = [c for c in remaining if c not in completed]
+
+            log.info('Could not fetch the full file %s, fetching its chunks instead', self._filename)
+            self._scheduler = DownloadScheduler(self._peer, self._filename, remaining, self._availability, self._assembler, self._metadata)
+
+        log.info('Waiting for all chunks of %s to be fetched!', self._filename)
+        self._scheduler.finish_search()
+        if not self._scheduler.wait():
+            log.warning('Could not fetch all chunks of %s!', self._filename)
+            return False
+
+        self._create_full_file()
+
+        return True
+
+    def _on_announcement(self, data):
+        try:
+            response = decode_response(data)
+        except ProtocolError as e:
+            log.warning('Download %s -> Dropping malformed announcement: %s', self._metadata_file, e)
+            return
+
+        self._availability.merge((response['address'], response['port']), response['chunks'], None, response['load'])
+        self._scheduler.refresh_sources()
+
+    def _verify_metadata_file_validity(self):
+        if not self._peer.file_index.contains(self._metadata_file):
+            log.warning('Peer does not have this metadata file. Please save it locally and try again!')
+            return False
+
+        return True
+
+    def _verify_file_need(self):
+        if self._peer.file_index.contains(self._filename):
+            log.info('Peer already has this file!')
+            return False
+
+        return True
+
+    def _create_availability_table(self):
+        _, local_chunks = self._peer.file_index.lookup(self._filename)
+
+        self._availability = AvailabilityTable(self._chunks)
+        self._availability.add_local(local_chunks)
+
+    def _verify_all_chunks_present_locally(self):
+        if self._availability.all_located():
+            log.info('Peer has all chunks locally')
+            self._create_full_file()
+            return True
+
+        return False
+
+    def _create_assembler(self, size, chunk_size):
+        peer_folder = Constants.FILES_PATH / str(self._peer.id)
+        _, local_chunks = self._peer.file_index.lookup(self._filename)
+
+        self._assembler = FileAssembler(peer_folder, self._filename, size, chunk_size, self._metadata['file_hash'], Constants.RESUME_DOWNLOADS)
+        completed = self._assembler.completed
+
+        if Constants.SEED_WHILE_DOWNLOADING:
+            self._peer.file_index.add_partial(self._filename, self._assembler)
+
+        for c in local_chunks:
+            if c < self._chunks and c not in completed:
+                self._assembler.add_local(c, peer_folder / f'{self._filename}.ch{c}')
+
+        self._availability.add_local(completed)
+
+    def _create_full_file(self):
+        peer_folder = Constants.FILES_PATH / str(self._peer.id)
+
+        if self._assembler:
+            self._peer.file_index.complete_partial(self._filename, self._assembler)
+            self._assembler = None
+
+            log.info('Full file %s assembled!', self._filename)
+            return
+
+        with open(peer_folder / self._filename, 'wb') as of:
+            for chunk in range(self._chunks):
+                with open(peer_folder / f'{self._filename}.ch{chunk}', 'rb') as cf:
+                    of.write(cf.read())
+
+        self._peer.content_store.add(peer_folder / self._filename)
+        log.info('Full file %s created!', self._filename)
+
+    def _full_file_fetched(self, tcp_client):
+        if self._assembler:
+            return self._assembler.is_complete(self._chunks)
+
+        return bool(tcp_client.received)
+
+    def _verify_file_unretrievable(self):
+        if self._availability.all_located() or self._availability.best_file_source() is not None:
+            return False
+
+        log.warning('Cannot find full file %s!', self._filename)
+        return True
+
+    def _choose_fetching_technique(self):
+        # Chunks are fetched in parallel, so the chunks time is the makespan of spreading them over their sources, not the sum of their times
+        chunks_time = self._chunks_makespan() if self._availability.all_located() else float('inf')
+
+        self._file_sources = self._ranked_file_sources()
+        file_time = self._file_sources[0][1] if self._file_sources else float('inf')
+
+        log.debug('Estimated %.3fs to fetch the chunks of %s and %.3fs to fetch the full file', chunks_time, self._filename, file_time)
+
+        if chunks_time > file_time:
+            return 'file'
+
+        return 'chunks'
+
+    def _chunks_makespan(self):
+        # Chunks fetched early, while the search was running, are no longer part of it
+        missing = self._scheduler.remaining
+        chunk_size = self._metadata['chunk_size']
+        estimator = self._peer.estimator
+
+        chunk_times = {}
+        for source in self._availability.sources:
+            for advertised, chunks in self._availability.source_times(source).items():
+                for c in bitfield.chunks(chunks & missing):
+                    chunk_times.setdefault(c, {})[source] = estimator.transfer_time(source, chunk_size, advertised / 1000)
+
+        return parallel_makespan(chunk_times.values(), Constants.MAX_TCP_CLIENTS)
+
+    def _ranked_file_sources(self):
+        # Every full file source with its estimated transfer time, the fastest first
+        estimator = self._peer.estimator
+
+        sources = {s: estimator.transfer_time(s, self._metadata['size'], advertised / 1000) for s, advertised in self._availability.file_sources.items()}
+
+        return sorted(sources.items(), key=lambda source: source[1])
+
+    def _fetch_full_file(self):
+        sources = [source for source, _ in self._file_sources]
+
+        # Every source is tried in turn before backing off; a busy one is tried again in the next round, a failed one is not
+        for _ in range(Constants.MAX_SOURCE_FAILURES):
+            for address, port in list(sources):
+                # Through the assembler, a transfer cut short resumes from where it stopped, with the same or the next source
+                with self._peer.connection_budget:
+                    tcp_client = self._peer.create_tcp_client(address, port, self._filename, [], assembler=self._assembler, metadata=self._metadata)
+
+                    tcp_client.start()
+                    tcp_client.join()
+
+                if self._full_file_fetched(tcp_client):
+                    return True
+
+                if not tcp_client.busy:
+                    sources.remove((address, port))
+
+            if not sources:
+                break
+
+            time.sleep(Constants.SOURCE_BUSY_BACKOFF)
+
+        return False
@@ -0,0 +1,74 @@
+import threading
+
+from utils.constants import Constants
+
+class SourceEstimator:
+    def __init__(self):
+        # Per source: smoothed round trip time (s) and throughput (B/s) of past transfers, and how many samples they hold
+        self._estimates = {}
+        self._lock = threading.Lock()
+
+    def record_rtt(self, source, rtt):
+        with self._lock:
+            estimate = self._estimate(source)
+            estimate['rtt'] = _smooth(estimate['rtt'], rtt)
+            estimate['rtt_samples'] += 1
+
+    def record_transfer(self, source, size, duration):
+        # Payloads received almost at once (a few segments) say more about buffering than about the link
+        if duration < Constants.ESTIMATE_MIN_TRANSFER_TIME:
+            return
+
+        with self._lock:
+            estimate = self._estimate(source)
+            estimate['throughput'] = _smooth(estimate['throughput'], size / duration)
+            estimate['throughput_samples'] += 1
+
+    def estimate(self, source):
+        with self._lock:
+            estimate = self._estimates.get(source)
+            return dict(estimate) if estimate else None
+
+    def estimates(self):
+        with self._lock:
+            return {source: dict(estimate) for source, estimate in self._estimates.items()}
+
+    def transfer_time(self, source, size, advertised):
+        # Seconds to fetch size bytes from the source: measured when there are samples, otherwise its advertised sending time plus a default round trip
+        with self._lock:
+            estimate = self._estimates.get(source)
+
+            rtt = Constants.ESTIMATE_DEFAULT_RTT
+            if estimate and estimate['rtt'] is not None:
+                rtt = estimate['rtt']
+
+            if size is None or not estimate or estimate['throughput'] is None:
+                return rtt + advertised
+
+            return rtt + size / estimate['throughput']
+
+    def _estimate(self, source):
+        return self._estimates.setdefault(source, {'rtt': None, 'throughput': None, 'rtt_samples': 0, 'throughput_samples': 0})
+
+def parallel_makespan(chunk_times, parallelism):
+    # Chunks with the fewest sources are placed first, each on the source that would finish it earliest; a source serves one request at a time,
+    # and at most `parallelism` requests run at once, so the makespan is bounded by both the busiest source and the total work spread over the connections
+    finish = {}
+
+    for times in sorted(chunk_times, key=len):
+        if not times:
+            return float('inf')
+
+        source = min(times, key=lambda s: finish.get(s, 0) + times[s])
+        finish[source] = finish.get(source, 0) + times[source]
+
+    if not finish:
+        return 0
+
+    return max(max(finish.values()), sum(finish.values()) / max(1, parallelism))
+
+def _smooth(current, sample):
+    if current is None:
+        return sample
+
+    return current + Constants.ESTIMATE_SMOOTHING * (sample - current)
@@ -0,0 +1,33 @@
+import asyncio
+import functools
+import threading
+
+class EventLoop(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def start(self):
+        super().start()
+        self._ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(self._ready.set)
+        self._loop.run_forever()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+async def blocking(function, *args, **kwargs):
+    # Disk I/O and hashing run on the default executor, so the other transfers multiplexed on the loop keep going meanwhile
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
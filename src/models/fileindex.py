@@ -0,0 +1,243 @@
+import os
+import re
+import threading
+import time
+
+from utils.constants import Constants
+from utils.files_reader import parse_file_metadata
+
+CHUNK_FILENAME = re.compile(r'^(.*)\.ch(\d+)$')
+METADATA_EXTENSION = '.p2p'
+
+class FileIndex(threading.Thread):
+    def __init__(self, folder, metrics = None):
+        super().__init__(daemon=True)
+
+        self._folder = folder
+        self._lock = threading.Lock()
+        self._scan_seconds = metrics.histogram('p2p_directory_scan_seconds', 'Duration of full scans of the peer folder') if metrics else None
+
+        self._files = {}
+        self._entries = {}
+        self._layouts = {}
+        self._partial = {}
+        self._folder_mtime = None
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self._files)
+
+    def contains(self, filename):
+        return filename in self._files
+
+    def lookup(self, filename):
+        with self._lock:
+            entry = self._entries.get(filename)
+            assembler = self._partial.get(filename)
+            if not entry and not assembler:
+                return None, {}
+
+            chunks = {}
+            if assembler:
+                chunks.update((c, assembler.chunk_size(c)) for c in assembler.completed)
+
+            if not entry:
+                return None, chunks
+
+            chunks.update((c, size) for c, (_, size) in self._ranges(filename, entry['size']).items())
+            chunks.update(entry['chunks'])
+
+            return entry['size'], chunks
+
+    def resolve(self, filename, file_hash = None):
+        # A file is known by its content hash when a metadata file here lists it, whatever name the requester gave it
+        if file_hash:
+            with self._lock:
+                for target, layout in self._layouts.items():
+                    if layout['file_hash'] == file_hash:
+                        return target
+
+        return filename
+
+    def chunk_range(self, filename, chunk):
+        with self._lock:
+            entry = self._entries.get(filename) or {'size': None, 'chunks': {}}
+
+            if chunk in entry['chunks']:
+                return f'{filename}.ch{chunk}', 0, entry['chunks'][chunk]
+
+            byte_range = self._ranges(filename, entry['size']).get(chunk)
+            if byte_range is not None:
+                return filename, *byte_range
+
+            # Completed chunks of a download in progress are read from its partial file
+            assembler = self._partial.get(filename)
+            if assembler and chunk in assembler.completed:
+                return os.path.relpath(assembler.path, self._folder), assembler.position(chunk), assembler.chunk_size(chunk)
+
+            return None
+
+    def add_partial(self, filename, assembler):
+        with self._lock:
+            self._partial[filename] = assembler
+
+    def remove_partial(self, filename):
+        with self._lock:
+            self._partial.pop(filename, None)
+
+    def complete_partial(self, filename, assembler):
+        # Renamed and indexed under the lock, so no chunk resolves to the partial file once it is gone
+        with self._lock:
+            self._partial.pop(filename, None)
+
+            path = assembler.complete()
+            self._add(path.name, os.stat(path).st_size, self._read_layout(path.name, path))
+            self._folder_mtime = os.stat(self._folder).st_mtime_ns
+
+        return path
+
+    def add(self, path):
+        size = os.stat(path).st_size
+        layout = self._read_layout(path.name, path)
+
+        with self._lock:
+            self._add(path.name, size, layout)
+
+            # The folder changed because of this file, so the next poll does not need a full rescan
+            self._folder_mtime = os.stat(self._folder).st_mtime_ns
+
+    def files(self):
+        with self._lock:
+            return dict(self._files)
+
+    def serves_chunks(self, filename):
+        # Chunks are read from the full file only when its metadata file gives the chunk size, so the ranges are exactly those of the chunk files
+        with self._lock:
+            return bool(self._ranges(filename, self._files.get(filename)))
+
+    def delete(self, filename):
+        # Deleted and removed from the index under the lock, so no request resolves to it once it is gone
+        with self._lock:
+            try:
+                os.remove(os.path.join(self._folder, filename))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                return False
+
+            self._remove(filename)
+            self._folder_mtime = os.stat(self._folder).st_mtime_ns
+
+        return True
+
+    def remove(self, filename):
+        with self._lock:
+            self._remove(filename)
+
+    def parse(self, filename):
+        match = CHUNK_FILENAME.match(filename)
+        if not match:
+            return filename, None
+
+        return match.group(1), int(match.group(2))
+
+    def refresh(self):
+        start = time.perf_counter()
+        folder_mtime = os.stat(self._folder).st_mtime_ns
+
+        files = {}
+        with os.scandir(self._folder) as it:
+            for entry in it:
+                if entry.is_file():
+                    files[entry.name] = (entry.stat().st_size, self._read_layout(entry.name, entry.path))
+
+        with self._lock:
+            self._files = {}
+            self._entries = {}
+            self._layouts = {}
+
+            for filename, (size, layout) in files.items():
+                self._add(filename, size, layout)
+
+            self._folder_mtime = folder_mtime
+
+        if self._scan_seconds:
+            self._scan_seconds.observe(time.perf_counter() - start)
+
+    def run(self):
+        while True:
+            time.sleep(Constants.FILE_INDEX_POLL_INTERVAL)
+
+            try:
+                if os.stat(self._folder).st_mtime_ns != self._folder_mtime:
+                    self.refresh()
+            except FileNotFoundError:
+                continue
+
+    def _remove(self, filename):
+        self._files.pop(filename, None)
+
+        for target, layout in list(self._layouts.items()):
+            if layout['metadata'] == filename:
+                del self._layouts[target]
+
+        base, chunk = self.parse(filename)
+        entry = self._entries.get(base)
+        if not entry:
+            return
+
+        if chunk is None:
+            entry['size'] = None
+        else:
+            entry['chunks'].pop(chunk, None)
+
+        if entry['size'] is None and not entry['chunks']:
+            del self._entries[base]
+
+    def _add(self, filename, size, layout = None):
+        self._files[filename] = size
+
+        if layout:
+            self._layouts[layout['target']] = layout
+
+        base, chunk = self.parse(filename)
+        entry = self._entries.setdefault(base, {'size': None, 'chunks': {}})
+
+        if chunk is None:
+            entry['size'] = size
+        else:
+            entry['chunks'][chunk] = size
+
+    def _ranges(self, filename, size):
+        layout = self._layouts.get(filename)
+        if size is None or not layout or (layout['size'] is not None and layout['size'] != size):
+            return {}
+
+        # Without an explicit chunk size the ranges could differ from those of the chunk files other peers hold, and nothing would catch the mix
+        chunk_size = layout['chunk_size']
+        if not chunk_size:
+            return {}
+
+        ranges = {}
+        for c in range(layout['chunks']):
+            offset = c * chunk_size
+            if offset < size:
+                ranges[c] = (offset, min(chunk_size, size - offset))
+
+        return ranges
+
+    def _read_layout(self, filename, path):
+        if not filename.endswith(METADATA_EXTENSION):
+            return None
+
+        try:
+            metadata = parse_file_metadata(path)
+        except (OSError, ValueError, IndexError):
+            return None
+
+        if not metadata['chunks'] or metadata['chunks'] <= 0:
+            return None
+
+        return {'metadata': filename, 'target': metadata['filename'], 'chunks': metadata['chunks'], 'size': metadata['size'], 'chunk_size': metadata['chunk_size'], 'file_hash': metadata['file_hash']}
+
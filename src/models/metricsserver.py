@@ -0,0 +1,41 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils.log import get_logger
+
+log = get_logger('metrics')
+
+class MetricsServer(threading.Thread):
+    def __init__(self, address, port, metrics):
+        super().__init__(daemon=True)
+
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = metrics_server._metrics.render().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug('Metrics Server -> ' + format, *args)
+
+        self._metrics = metrics
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def run(self):
+        log.info('Metrics Server (Address: %s, Port: %s) listening...', *self.address)
+        self._server.serve_forever()
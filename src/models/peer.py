@@ -1,28 +1,72 @@
-import struct
-import socket
 import threading
 import math
+import random
 
 from utils.files_reader import read_topology_file, read_config_file, read_file_metadata
 from utils.constants import Constants
+from utils.protocol import encode_query
 from models.neighbor import Neighbor
 from models.udpserver import UDPServer
 from models.tcpserver import TCPServer
 from models.udpclient import UDPClient
+from models.searchsocket import SearchSocket
 from models.tcpclient import TCPClient
+from models.eventloop import EventLoop
+from models.asynctcpserver import AsyncTCPServer
+from models.asynctcpclient import AsyncTCPClient
+from models.download import Download
+from models.fileindex import FileIndex
+from models.contentstore import ContentStore
+from models.connectionpool import ConnectionPool
+from models.estimator import SourceEstimator
+from models.metricsserver import MetricsServer
+from utils.token_bucket import TokenBucket
+from utils.seen_cache import SeenCache
+from utils.metrics import Metrics
+from utils.log import get_logger, configure as configure_logging
+
+log = get_logger('peer')
 
 class Peer:
     def __init__(self, id):
         self._id = id
+        configure_logging()
+
+        self._metrics = Metrics()
+        self._downloads_finished = self._metrics.counter('p2p_downloads_total', 'Downloads finished, by result', ('result',))
+        self._download_seconds = self._metrics.histogram('p2p_download_seconds', 'Duration of downloads, from the metadata file to the assembled file', ('result',))
 
         neighbors_ids = read_topology_file(id)
         config_components = read_config_file([id, *neighbors_ids])
 
         self._fetch_config_info_and_create_neighbors(config_components)
-        self._create_udp_server()
+        # A peer configured with no upload speed only downloads, it has nothing to shape
+        self._upload_bucket = TokenBucket(self._speed) if self._speed > 0 else None
+        self._create_file_index()
+        self._seen_queries = SeenCache(Constants.SEEN_QUERY_CACHE_SIZE, Constants.SEEN_QUERY_CACHE_TIMEOUT)
 
         self._tcp_server = None
-        print(self)
+        self._tcp_server_lock = threading.Lock()
+        self._event_loop = None
+        if Constants.TCP_SERVER_AT_STARTUP:
+            self.create_tcp_server()
+
+        self._create_udp_server()
+        self._create_search_socket()
+
+        self._downloads = {}
+        self._downloads_lock = threading.Lock()
+        self._connection_budget = threading.Semaphore(Constants.MAX_TCP_CLIENTS)
+        self._estimator = SourceEstimator()
+        self._connection_pool = ConnectionPool(lambda c: c.close())
+        self._async_connection_pool = ConnectionPool(lambda c: c[1].close(), lambda c: not c[1].is_closing())
+
+        self._metrics_server = None
+        if Constants.METRICS_ENDPOINT:
+            self._metrics_server = MetricsServer(self._address, Constants.METRICS_PORT + self._id, self._metrics)
+            self._metrics_server.start()
+
+        log.info('%s', self)
 
     def __str__(self):
         neighbors = '. '.join([str(n) for n in self._neighbors])
@@ -36,10 +80,62 @@ class Peer:
     def neighbors(self):
         return self._neighbors
 
+    @property
+    def metrics(self):
+        return self._metrics
+
     @property
     def udp_server(self):
         return self._udp_server
 
+    @property
+    def search_socket(self):
+        return self._search_socket
+
+    @property
+    def seen_queries(self):
+        return self._seen_queries
+
+    @property
+    def file_index(self):
+        return self._file_index
+
+    @property
+    def content_store(self):
+        return self._content_store
+
+    @property
+    def connection_budget(self):
+        return self._connection_budget
+
+    @property
+    def connection_pool(self):
+        return self._connection_pool
+
+    @property
+    def async_connection_pool(self):
+        return self._async_connection_pool
+
+    @property
+    def downloads(self):
+        with self._downloads_lock:
+            return list(self._downloads.values())
+
+    @property
+    def estimator(self):
+        return self._estimator
+
+    @property
+    def upload_bucket(self):
+        return self._upload_bucket
+
+    @property
+    def uploads(self):
+        return self._upload_bucket is not None
+
+    def upload_rate(self):
+        return self._upload_bucket.achieved_rate() if self._upload_bucket else 0
+
     def speed(self):
         with self._active_tcp_connections_lock:
             if self._active_tcp_connections == 0:
@@ -58,191 +154,129 @@ class Peer:
             del comp['speed']
             self._neighbors.append(Neighbor(*comp.values()))
 
+    def _create_file_index(self):
+        self._file_index = FileIndex(Constants.FILES_PATH / str(self._id), self._metrics)
+        self._file_index.start()
+
+        self._content_store = ContentStore(Constants.FILES_PATH / str(self._id), self._file_index, self._metrics)
+        self._content_store.reclaim()
+
     def _create_udp_server(self):
         self._udp_server = UDPServer(self._address, self._udp_port, self)
         self._udp_server.start()
 
-    def run(self, metadata_file):
-        if not self._verify_metadata_file_validity(metadata_file):
-            return
-
-        requested_file, chunks, ttl = read_file_metadata(self._id, metadata_file)
-        if not self._verify_file_need(requested_file):
-            return
-
-        self._create_file_buffer(chunks, requested_file)
-
-        if self._verify_all_chunks_present_locally(requested_file):
-            return
+    def _create_search_socket(self):
+        self._search_socket = SearchSocket(self._address, Constants.UDP_CLIENT_PORT + self._id)
+        self._search_socket.start()
 
-        client = self._flooding_client(ttl, requested_file)
-        client.start()
-        client.join()
+    def download(self, metadata_file):
+        target = self._download_target(metadata_file)
 
-        if self._verify_file_unretrievable():
-            return
+        with self._downloads_lock:
+            download = self._downloads.get(target)
+            if download:
+                log.info('Download of %s already in progress from %s', target, download.metadata_file)
+                return download
 
-        fetching_technique = self._choose_fetching_technique()
-        if fetching_technique == 'chunks':
-            grouped_chunks = self._group_chunks_by_address_and_port()
+            download = Download(self, metadata_file)
+            self._downloads[target] = download
 
-            semaphore = threading.Semaphore(Constants.MAX_TCP_CLIENTS)
-            clients = []
+        download.start()
 
-            for address_and_port, chunks in grouped_chunks.items():
-                print('Waiting for all chunks to be fetched!')
+        return download
 
-                semaphore.acquire()
+    def download_finished(self, download):
+        result = 'completed' if download.succeeded else 'failed'
+        self._downloads_finished.inc(1, result)
+        self._download_seconds.observe(download.completion_time, result)
 
-                tcp_client = self._create_tcp_client(address_and_port, requested_file, chunks, semaphore)
-                clients.append(tcp_client)
-                tcp_client.start()
+        with self._downloads_lock:
+            for target, active in list(self._downloads.items()):
+                if active is download:
+                    del self._downloads[target]
 
-            for client in clients:
-                client.join()
+    def _download_target(self, metadata_file):
+        # Downloads are keyed by the file they write, as two metadata files naming it would share its .part and .journal in tmp
+        try:
+            return read_file_metadata(self._id, metadata_file)['filename']
+        except (OSError, ValueError, IndexError):
+            # The download fails on its own, and is only told apart from others by its metadata file
+            return metadata_file
 
-            self._create_full_file(requested_file)
-        else:
-            self._fetch_full_file(requested_file)
+    def run(self, metadata_file):
+        return self.download(metadata_file).wait()
 
-            print('File downloaded!')
+    def search(self, ttl, requested_file, availability, on_response = None, file_hash = None):
+        client_address, client_port = self._search_socket.address
 
-    def _verify_metadata_file_validity(self, metadata_file):
-        peer_folder = Constants.FILES_PATH / str(self._id)
-        filenames = [f.name for f in peer_folder.iterdir() if f.is_file()]
+        query_id = random.getrandbits(32)
+        self._seen_queries.add((self._id, query_id))
 
-        if metadata_file not in filenames:
-            print('Peer does not have this metadata file. Please save it locally and try again!')
-            return False
+        message = encode_query(ttl, self._id, query_id, client_address, client_port, requested_file, file_hash)
 
-        return True
+        return UDPClient(self._search_socket, query_id, self._neighbors, availability, message, requested_file, on_response = on_response, metrics = self._metrics)
 
-    def _verify_file_need(self, requested_file):
-        peer_folder = Constants.FILES_PATH / str(self._id)
-        filenames = [f.name for f in peer_folder.iterdir() if f.is_file()]
+    def create_tcp_client(self, address, port, filename, chunks, semaphore = None, assembler = None, metadata = None):
+        if Constants.TRANSFER_MODE == 'asyncio':
+            return AsyncTCPClient(self, address, port, semaphore, filename, chunks, assembler, metadata)
 
-        if requested_file in filenames:
-            print('Peer already has this file!')
-            return False
+        return TCPClient(self, address, port, semaphore, filename, chunks, assembler, metadata)
 
-        return True
+    def event_loop(self):
+        if not self._event_loop:
+            self._event_loop = EventLoop()
+            self._event_loop.start()
 
-    def _create_file_buffer(self, chunks, requested_file):
-        peer_folder = Constants.FILES_PATH / str(self._id)
-        filenames = [f.name for f in peer_folder.iterdir() if f.is_file()]
+        return self._event_loop
 
-        self._buffer = [None] * (chunks + 1)
+    def reroute(self, ttl, client_id, query_id, client_address, client_port, filename, file_hash = None):
+        message = encode_query(ttl, client_id, query_id, client_address, client_port, filename, file_hash)
 
-        for c in range(chunks):
-            chunk_name = requested_file + f'.ch{c}'
-
-            if chunk_name in filenames:
-                self._buffer[c] = {
-                    'chunk': c,
-                    'address': 'local',
-                    'port': 'local',
-                    'time': 0
-                }
+        neighbors = [n for n in self._neighbors if n.id != client_id]
 
-    def _verify_all_chunks_present_locally(self, requested_filename):
-        if all(c is not None for c in self._buffer[:-1]):
-            print('Peer has all chunks locally')
-            self._create_full_file(requested_filename)
-            return True
+        self._udp_server.forward(message, neighbors)
 
-        return False
+    def announce(self, filename, chunk):
+        if Constants.ANNOUNCE_CHUNKS and self.uploads:
+            self._udp_server.announce(filename, chunk)
 
-    def _flooding_client(self, ttl, requested_file):
-        client_address = self._address
-        client_port = Constants.UDP_CLIENT_PORT + self._id
-        message = self._build_flooding_request(self._id, ttl, client_address, client_port, requested_file)
+    def create_tcp_server(self):
+        # The UDP server workers call it on every query they answer, the first ones at the same time
+        with self._tcp_server_lock:
+            if not self._tcp_server:
+                self._tcp_port = Constants.TCP_SERVER_PORT + self._id
+                self._active_tcp_connections = 0
+                self._active_tcp_connections_lock = threading.Lock()
 
-        return UDPClient(client_address, client_port, self._neighbors, self._buffer, message, requested_file, blocking = True)
+                if Constants.TRANSFER_MODE == 'asyncio':
+                    self._tcp_server = AsyncTCPServer(self._address, self._tcp_port, self, self.event_loop())
+                else:
+                    self._tcp_server = TCPServer(self._address, self._tcp_port, self)
 
-    def _create_full_file(self, output_filename):
-        peer_folder = Constants.FILES_PATH / str(self._id)
+                self._tcp_server.start()
 
-        with open(peer_folder / output_filename, 'wb') as of:
-            for chunk in self._buffer[:-1]:
-                with open(peer_folder / f"{output_filename}.ch{chunk['chunk']}", 'rb') as cf:
-                    of.write(cf.read())
+            return self._tcp_server
 
-        print('Full file created!')
+    def sending_time(self, size):
+        # Milliseconds, rounded up so a small chunk never looks free; a peer with no upload speed left is as slow as it gets, not a division by zero
+        return math.ceil(size * 1000 / max(1, self.speed()))
 
-    def _build_flooding_request(self, id, ttl, client_address, client_port, filename):
-        return struct.pack(Constants.FLOODING_REQUEST_FORMAT, ttl, id, socket.inet_aton(client_address), client_port, filename.encode('utf-8'))
+    def change_active_tcp_connections(self, change):
+        with self._active_tcp_connections_lock:
+            self._active_tcp_connections += change
 
-    def _verify_file_unretrievable(self):
-        if all(c is not None for c in self._buffer[:-1]) or self._buffer[-1] is not None:
+    def acquire_upload_slot(self):
+        # Every request to a peer without upload speed is answered busy, like one with all its slots taken
+        if not self.uploads:
             return False
 
-        print('Cannot find full file!')
-        return True
-
-    def _choose_fetching_technique(self):
-        chunk_fetching_time = float('inf')
-        if all(c is not None for c in self._buffer[:-1]):
-            chunk_fetching_time = sum(c['time'] for c in self._buffer[:-1])
-
-        file_fetching_time = float('inf')
-        if self._buffer[-1] is not None:
-            file_fetching_time = self._buffer[-1]['time']
-
-        if chunk_fetching_time > file_fetching_time:
-            return 'file'
-
-        return 'chunks'
-
-    def _group_chunks_by_address_and_port(self):
-        grouped_chunks = {}
-
-        for c in self._buffer[:-1]:
-            if c['address'] == 'local':
-                continue
-
-            address_and_port = f"{c['address']} {c['port']}"
-            if address_and_port in grouped_chunks:
-                grouped_chunks[address_and_port].append(c['chunk'])
-            else:
-                grouped_chunks[address_and_port] = [c['chunk']]
-
-        return grouped_chunks
-
-    def _fetch_full_file(self, filename):
-        info = self._buffer[-1]
-
-        tcp_client = self._create_tcp_client(f"{info['address']} {info['port']}", filename, [])
-
-        tcp_client.start()
-        tcp_client.join()
-
-    def _create_tcp_client(self, address_and_port, filename, chunks, semaphore = None):
-        address, port = address_and_port.split(' ')
-        port = int(port)
-
-        return TCPClient(self, address, port, semaphore, filename, chunks)
-
-    def reroute(self, ttl, client_id, client_address, client_port, filename):
-        message = self._build_flooding_request(client_id, ttl, client_address, client_port, filename)
-
-        neighbors = [n for n in self._neighbors if n.id != client_id]
-
-        client = UDPClient(self._address, Constants.UDP_REROUTE_PORT + self._id, neighbors, None, message, filename)
-        client.start()
-
-    def create_tcp_server(self):
-        if not self._tcp_server:
-            self._tcp_port = Constants.TCP_SERVER_PORT + self._id
-            self._active_tcp_connections = 0
-            self._active_tcp_connections_lock = threading.Lock()
-            self._tcp_server = TCPServer(self._address, self._tcp_port, self)
-            self._tcp_server.start()
-
-        return self._tcp_server
+        with self._active_tcp_connections_lock:
+            if Constants.MAX_UPLOAD_SLOTS and self._active_tcp_connections >= Constants.MAX_UPLOAD_SLOTS:
+                return False
 
-    def sending_time(self, size):
-        return size // self.speed()
+            self._active_tcp_connections += 1
+            return True
 
-    def change_active_tcp_connections(self, change):
+    def load(self):
         with self._active_tcp_connections_lock:
-            self._active_tcp_connections += change
+            return self._active_tcp_connections, Constants.MAX_UPLOAD_SLOTS
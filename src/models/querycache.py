@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+from utils.constants import Constants
+
+class QueryCache:
+    def __init__(self):
+        # Per query forwarded by this peer: when it expires, where its responses go and the file they are cached under
+        self._relays = OrderedDict()
+        # Per file: when it expires, the TTL the query that filled it was forwarded with, and the latest response of every holder
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def relay(self, query_id, upstream, key, reach):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            # Responses go back to the peer the query first came from; relays set up by later copies of it could point at each other
+            if query_id not in self._relays:
+                self._relays[query_id] = {'expires': now + Constants.QUERY_RELAY_TIMEOUT, 'upstream': upstream, 'key': key}
+                if len(self._relays) > Constants.QUERY_RELAY_SIZE:
+                    self._relays.popitem(last=False)
+
+            # A query reaching further than the cached one refills it from scratch
+            entry = self._results.get(key)
+            if entry is None or entry['reach'] < reach:
+                self._results.pop(key, None)
+                self._results[key] = {'expires': now + Constants.QUERY_CACHE_TIMEOUT, 'reach': reach, 'holders': {}}
+                if len(self._results) > Constants.QUERY_CACHE_SIZE:
+                    self._results.popitem(last=False)
+
+    def upstream(self, query_id):
+        with self._lock:
+            self._expire(time.monotonic())
+
+            relay = self._relays.get(query_id)
+            return (relay['upstream'], relay['key']) if relay else None
+
+    def record(self, key, response):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return
+
+            holder = entry['holders'].get(response['peer_id'])
+
+            # Large chunk sets arrive split over several responses, and announcements add chunks to the ones already known
+            if holder is None or (holder['address'], holder['port']) != (response['address'], response['port']):
+                holder = entry['holders'][response['peer_id']] = {
+                    'address': response['address'], 'port': response['port'], 'full_file': False, 'full_file_time': 0, 'chunks': {}
+                }
+
+            if response['full_file']:
+                holder['full_file'], holder['full_file_time'] = True, response['full_file_time']
+
+            for sending_time, chunks in response['chunks'].items():
+                holder['chunks'][sending_time] = holder['chunks'].get(sending_time, 0) | chunks
+
+            holder['load'] = response['load']
+
+    def lookup(self, key, reach):
+        # The holders known for a file, when a query forwarded at least as far found some of them
+        with self._lock:
+            self._expire(time.monotonic())
+
+            entry = self._results.get(key)
+            if entry is None or entry['reach'] < reach or not entry['holders']:
+                return None
+
+            return {peer_id: dict(holder) for peer_id, holder in entry['holders'].items()}
+
+    def _expire(self, now):
+        for entries in (self._relays, self._results):
+            while entries:
+                key, value = next(iter(entries.items()))
+                if value['expires'] > now:
+                    break
+
+                del entries[key]
@@ -0,0 +1,354 @@
+import threading
+import time
+import random
+from collections import deque
+
+from utils.constants import Constants
+from utils.log import get_logger
+from utils import bitfield
+
+log = get_logger('scheduler')
+
+class DownloadScheduler:
+    def __init__(self, peer, filename, chunks, availability, assembler = None, metadata = None):
+        self._peer = peer
+        self._filename = filename
+        self._availability = availability
+        self._assembler = assembler
+        self._metadata = metadata
+
+        self._pending = bitfield.from_chunks(chunks)
+        self._requeued = deque()
+        self._in_flight = {}
+        self._done = set()
+        self._remaining = bitfield.from_chunks(chunks)
+
+        self._sources = {}
+        self._stats = {}
+        self._backoff = {}
+        self._workers = []
+        self._working = set()
+        self._searching = True
+        self._stopped = False
+
+        self._condition = threading.Condition()
+        self._semaphore = peer.connection_budget
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def completed(self):
+        return len(self._done)
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+    def refresh_sources(self):
+        with self._condition:
+            for source in self._availability.sources:
+                chunks = self._availability.source_chunks(source) & self._remaining
+                if chunks:
+                    self._add_source(source, chunks)
+
+            self._condition.notify_all()
+
+    def _add_source(self, source, chunks):
+        if source not in self._sources:
+            self._sources[source] = 0
+            self._stats[source] = {'chunks': 0, 'bytes': 0, 'time': 0, 'failures': 0, 'busy': 0}
+
+        self._sources[source] |= chunks
+
+        # A source whose worker ran out of chunks gets a new one when it announces more
+        if source not in self._working and not self._stopped and self._stats[source]['failures'] < Constants.MAX_SOURCE_FAILURES:
+            self._working.add(source)
+
+            worker = threading.Thread(target=self._worker, args=(source,))
+            self._workers.append(worker)
+            worker.start()
+
+    def _assign_to_best_sources(self):
+        if Constants.LOAD_AWARE_SELECTION:
+            self._assign_by_load()
+            return
+
+        sources = {s: self._availability.source_chunks(s) & self._remaining for s in self._availability.sources}
+
+        assigned = {}
+        for c in bitfield.chunks(self._remaining):
+            options = [s for s, chunks in sources.items() if bitfield.contains(chunks, c)]
+            if options:
+                assigned.setdefault(min(options, key=lambda s: self._transfer_time(s, c)), []).append(c)
+
+        for source, chunks in assigned.items():
+            self._add_source(source, bitfield.from_chunks(chunks))
+
+    def _assign_by_load(self):
+        sources = {s: self._availability.source_chunks(s) & self._remaining for s in self._availability.sources}
+        queued = {s: 0 for s in sources}
+
+        def cost(source, chunk):
+            active_uploads, upload_slots = self._availability.load(source)
+            load = 1 + active_uploads / upload_slots if upload_slots else 1
+
+            return queued[source] + self._transfer_time(source, chunk) * load
+
+        # Rarest chunks first, as they have the fewest sources to choose from; each goes to the source expected to finish it first
+        assigned = {}
+        for c in self._by_rarity(self._remaining):
+            options = [s for s, chunks in sources.items() if bitfield.contains(chunks, c)]
+            if not options:
+                continue
+
+            source = min(options, key=lambda s: cost(s, c))
+            queued[source] = cost(source, c)
+            assigned.setdefault(source, []).append(c)
+
+        for source, chunks in assigned.items():
+            self._add_source(source, bitfield.from_chunks(chunks))
+
+    def _transfer_time(self, source, chunk):
+        # Measured round trip and throughput of the source when known, its advertised sending time otherwise
+        chunk_size = self._metadata['chunk_size'] if self._metadata else None
+        if self._assembler:
+            chunk_size = self._assembler.chunk_size(chunk)
+
+        return self._peer.estimator.transfer_time(source, chunk_size, self._availability.source_time(source, chunk) / 1000)
+
+    def _by_rarity(self, chunks, limit = None):
+        ordered = []
+        while chunks and (limit is None or len(ordered) < limit):
+            rarest = self._availability.rarest(chunks)
+
+            # Ties are broken at random, so downloaders of the same file start from different chunks
+            if limit is None:
+                level = bitfield.chunks(rarest)
+                random.shuffle(level)
+            else:
+                # A few picks are sampled from the tier instead of listing and shuffling all of it
+                count = rarest.bit_count()
+                level = [bitfield.nth(rarest, i) for i in random.sample(range(count), min(count, limit - len(ordered)))]
+
+            ordered.extend(level)
+
+            chunks &= ~rarest
+
+        return ordered[:limit]
+
+    def start(self):
+        self.refresh_sources()
+
+    def finish_search(self):
+        if Constants.CHUNK_SCHEDULER != 'static':
+            self.refresh_sources()
+
+        with self._condition:
+            if Constants.CHUNK_SCHEDULER == 'static':
+                self._assign_to_best_sources()
+
+            self._searching = False
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+
+            for fetches in self._in_flight.values():
+                for client, _ in fetches.values():
+                    if client:
+                        client.cancel()
+
+            self._condition.notify_all()
+
+        self.wait()
+
+    def wait(self):
+        joined = 0
+        while True:
+            with self._condition:
+                if joined == len(self._workers):
+                    break
+
+                worker = self._workers[joined]
+
+            worker.join()
+            joined += 1
+
+        self._print_stats()
+
+        return not self._remaining
+
+    def run(self):
+        self.finish_search()
+
+        return self.wait()
+
+    def _worker(self, source):
+        while True:
+            self._semaphore.acquire()
+
+            chunks = self._next_chunks(source)
+            if chunks is None:
+                self._semaphore.release()
+                return
+
+            if not chunks:
+                self._semaphore.release()
+
+                with self._condition:
+                    self._condition.wait(Constants.SCHEDULER_POLL_INTERVAL)
+
+                continue
+
+            try:
+                self._fetch(source, chunks)
+            finally:
+                self._semaphore.release()
+
+    def _next_chunks(self, source):
+        with self._condition:
+            served = self._sources[source]
+
+            if self._stopped or self._stats[source]['failures'] >= Constants.MAX_SOURCE_FAILURES:
+                return self._retire(source)
+
+            if not self._remaining & served:
+                return [] if self._searching and self._remaining else self._retire(source)
+
+            if self._backoff.get(source, 0) > time.monotonic():
+                return []
+
+            if Constants.CHUNK_SCHEDULER == 'static':
+                chunks = self._pending_served(served)
+                for c in chunks:
+                    self._start(source, c)
+
+                return chunks
+
+            chunks = self._pending_served(served, Constants.REQUEST_PIPELINE_DEPTH)
+            if chunks:
+                for c in chunks:
+                    self._start(source, c)
+
+                return chunks
+
+            straggler = self._straggler(source)
+            if straggler is not None:
+                log.debug('Scheduler re-issuing chunk %s to %s:%s', straggler, *source)
+                self._start(source, straggler)
+                return [straggler]
+
+            return []
+
+    def _retire(self, source):
+        self._working.discard(source)
+
+    def _pending_served(self, served, limit = None):
+        if Constants.CHUNK_SELECTION == 'rarest_first':
+            return self._by_rarity(served & self._pending, limit)
+
+        # Chunks handed back by a failed fetch go first, then the others in order; entries already started again are dropped lazily
+        while self._requeued and not bitfield.contains(self._pending, self._requeued[0]):
+            self._requeued.popleft()
+
+        candidates = served & self._pending
+
+        chunks = []
+        for c in self._requeued:
+            if len(chunks) == limit:
+                return chunks
+
+            if bitfield.contains(candidates, c):
+                chunks.append(c)
+                candidates &= ~(1 << c)
+
+        return chunks + bitfield.lowest(candidates, None if limit is None else limit - len(chunks))
+
+    def _straggler(self, source):
+        candidates = [
+            (len(fetches), min(started for _, started in fetches.values()), chunk)
+            for chunk, fetches in self._in_flight.items()
+            if bitfield.contains(self._sources[source], chunk) and source not in fetches and len(fetches) < Constants.MAX_CHUNK_DUPLICATES
+        ]
+
+        if not candidates:
+            return None
+
+        return min(candidates)[2]
+
+    def _start(self, source, chunk):
+        self._pending &= ~(1 << chunk)
+
+        self._in_flight.setdefault(chunk, {})[source] = (None, time.monotonic())
+
+    def _fetch(self, source, chunks):
+        address, port = source
+
+        with self._condition:
+            chunks = [c for c in chunks if c in self._in_flight]
+            if not chunks:
+                return
+
+            client = self._peer.create_tcp_client(address, port, self._filename, chunks, assembler=self._assembler, metadata=self._metadata)
+            started = time.monotonic()
+
+            for c in chunks:
+                self._in_flight[c][source] = (client, started)
+
+        client.start()
+        client.join()
+
+        elapsed = time.monotonic() - started
+
+        with self._condition:
+            stats = self._stats[source]
+            stats['time'] += elapsed
+
+            # A busy source rejected the request before sending anything; it is asked again after a while, and other sources may take the chunks meanwhile
+            if client.busy:
+                stats['busy'] += 1
+                self._backoff[source] = time.monotonic() + Constants.SOURCE_BUSY_BACKOFF
+
+            missing = [c for c in chunks if c not in client.received]
+            if missing and not client.cancelled and not client.busy:
+                stats['failures'] += 1
+
+            for c in chunks:
+                fetches = self._in_flight.get(c, {})
+                fetches.pop(source, None)
+
+                if c in client.received:
+                    stats['chunks'] += 1
+                    stats['bytes'] += client.received[c]
+
+                    if bitfield.contains(self._remaining, c):
+                        self._complete(c, fetches)
+                elif not client.cancelled:
+                    if not client.busy:
+                        self._sources[source] &= ~(1 << c)
+
+                    if bitfield.contains(self._remaining, c) and not fetches:
+                        self._in_flight.pop(c, None)
+                        self._pending |= 1 << c
+                        self._requeued.appendleft(c)
+
+            self._condition.notify_all()
+
+    def _complete(self, chunk, fetches):
+        self._done.add(chunk)
+        self._remaining &= ~(1 << chunk)
+        self._in_flight.pop(chunk, None)
+
+        self._peer.announce(self._filename, chunk)
+
+        for duplicate, _ in fetches.values():
+            if duplicate:
+                duplicate.cancel()
+
+    def _print_stats(self):
+        for (address, port), stats in self._stats.items():
+            throughput = stats['bytes'] / stats['time'] if stats['time'] else 0
+            log.info('Source %s:%s -> Chunks: %s, Bytes: %s, Throughput: %.0f B/s, Failures: %s, Busy: %s', address, port, stats['chunks'], stats['bytes'], throughput, stats['failures'], stats['busy'])
@@ -0,0 +1,75 @@
+import threading
+import socket
+import queue
+
+from utils.constants import Constants
+from utils.protocol import response_query_id, split_responses, ProtocolError
+from utils.log import get_logger
+
+log = get_logger('searchsocket')
+
+class SearchSocket(threading.Thread):
+    def __init__(self, address, port):
+        super().__init__(daemon=True)
+
+        self._address = address
+        self._port = port
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, Constants.UDP_RECV_BUFFER_SIZE)
+        self._socket.bind((self._address, self._port))
+
+        self._searches = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def address(self):
+        return (self._address, self._port)
+
+    def register(self, query_id):
+        responses = queue.Queue()
+
+        with self._lock:
+            self._searches[query_id] = responses
+
+        return responses
+
+    def unregister(self, query_id):
+        with self._lock:
+            self._searches.pop(query_id, None)
+
+    def subscribe(self, query_id, callback):
+        with self._lock:
+            self._subscribers[query_id] = callback
+
+    def unsubscribe(self, query_id):
+        with self._lock:
+            self._subscribers.pop(query_id, None)
+
+    def send(self, message, address):
+        self._socket.sendto(message, address)
+
+    def run(self):
+        while True:
+            data, _ = self._socket.recvfrom(65535)
+
+            try:
+                query_id = response_query_id(data)
+                messages = split_responses(data)
+            except ProtocolError as e:
+                log.warning('Search socket dropping malformed response: %s', e)
+                continue
+
+            with self._lock:
+                responses = self._searches.get(query_id)
+                subscriber = self._subscribers.get(query_id)
+
+            # Messages go to the search while it runs, and afterwards to the download it belongs to
+            for message in messages:
+                if responses is not None:
+                    responses.put(message)
+                elif subscriber is not None:
+                    subscriber(message)
+                else:
+                    log.debug('Search socket dropping response for unknown query %s', query_id)
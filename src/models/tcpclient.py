@@ -2,79 +2,360 @@ import os
 import threading
 import socket
 import struct
-import shutil
+import time
+import zlib
 
 from utils.constants import Constants
+from utils.hashing import new_hasher
+from utils.protocol import encode_chunks_request
+from utils.log import get_logger
+
+log = get_logger('tcpclient')
 
 class TCPClient(threading.Thread):
-    def __init__(self, peer, address, port, semaphore, filename, chunks):
+    def __init__(self, peer, address, port, semaphore, filename, chunks, assembler = None, metadata = None):
         super().__init__()
-        
+
         self._peer = peer
 
         self._server_address = address
         self._server_port = port
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket = None
+        self._reusable = False
 
         self._semaphore = semaphore
 
-        self._filename = filename
-        self._message = self._build_chunks_request(chunks)
+        self._transfer = ChunksTransfer(peer, address, port, filename, chunks, assembler, metadata)
 
-    def _build_chunks_request(self, chunks):
-        self._number_of_chunks = len(chunks)
+        self._error = None
+        self._cancelled = False
 
-        if self._number_of_chunks == 0:
-            message_format = Constants.CHUNKS_REQUEST_INITIAL_FORMAT
-            return struct.pack(message_format, self._number_of_chunks, self._filename.encode('utf-8').ljust(255, b'\x00'))
-        
-        message_format = Constants.CHUNKS_REQUEST_INITIAL_FORMAT + f'{self._number_of_chunks}I'
-        return struct.pack(message_format, self._number_of_chunks, self._filename.encode('utf-8').ljust(255, b'\x00'), *chunks)
+    @property
+    def received(self):
+        return self._transfer.received
 
-    def run(self):
-        print('TCP Client running...')
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def busy(self):
+        return self._transfer.busy
 
-        self._socket.connect((self._server_address, self._server_port))
-        self._socket.sendall(self._message)
+    @property
+    def cancelled(self):
+        return self._cancelled
 
-        created_files = {}
+    def cancel(self):
+        self._cancelled = True
 
-        dirname = Constants.FILES_PATH / str(self._peer.id) / 'tmp'
-        os.makedirs(dirname, exist_ok=True)
+        try:
+            if self._socket:
+                self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-        files_to_fetch = max(1, self._number_of_chunks)
-        for _ in range(files_to_fetch):
-            data = self._socket.recv(2)
+    def run(self):
+        try:
+            self._fetch()
+        except Exception as e:
+            self._error = e
+
+            if not self._cancelled:
+                log.warning('TCP Client -> An error occurred: %s', e)
+        finally:
+            if self._socket:
+                if self._reusable and not self._cancelled:
+                    self._peer.connection_pool.put(self._server_address, self._server_port, self._socket)
+                else:
+                    self._socket.close()
+
+            if self._semaphore:
+                self._semaphore.release()
 
-            chunk_number, full_file = struct.unpack(Constants.CHUNKS_RESPONSE_FILE_SPECIFICATION_FORMAT, data)
+    def _fetch(self):
+        if self._cancelled:
+            return
 
-            if full_file:
-                print(f'TCP Client received specification: Full file')
-                file = self._filename
-            else:
-                print(f'TCP Client received specification: Chunk number -> {chunk_number}')
-                file = f'{self._filename}.ch{chunk_number}'
+        log.debug('TCP Client running...')
 
-            filepath = dirname / file
-            if chunk_number not in created_files.keys():
-                created_files[chunk_number] = filepath
+        self._socket = self._peer.connection_pool.take(self._server_address, self._server_port)
+        reused = self._socket is not None
 
-            with open(created_files[chunk_number], 'wb') as f:
-                while True:
-                    data = self._socket.recv(1024)
-                    if data == b'\x00':
-                        print('TCP Client received EOF')
-                        break
+        if not reused:
+            self._socket = self._connect()
 
-                    print(f'TCP Client received: File Content -> {data}')
+        if self._cancelled:
+            return
 
-                    print('TCP Client saving content to file')
-                    f.write(data)
+        try:
+            self._request()
+        except ConnectionError:
+            # The server may have closed an idle pooled connection; that is only safe to retry before any data arrived
+            if not reused or self._transfer.received or self._cancelled:
+                raise
 
-        for filepath in created_files.values():
-            print(f'TCP Client moving file {filepath} out of tmp directory')
-            shutil.move(filepath, Constants.FILES_PATH / str(self._peer.id))
+            log.debug('TCP Client -> Pooled connection was closed, reconnecting')
             self._socket.close()
+            self._socket = self._connect()
+            self._request()
 
-            if self._semaphore:
-                self._semaphore.release()
+        self._reusable = True
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            connection.connect((self._server_address, self._server_port))
+        except OSError:
+            connection.close()
+            raise
+
+        return connection
+
+    def _request(self):
+        transfer = self._transfer
+
+        self._socket.sendall(transfer.message)
+        transfer.prepare()
+
+        buffer = memoryview(bytearray(Constants.RECV_BUFFER_SIZE))
+
+        for i in range(transfer.responses):
+            start = time.perf_counter()
+            header = recv_exactly(self._socket, struct.calcsize(Constants.CHUNKS_RESPONSE_HEADER_FORMAT))
+
+            response = transfer.begin(i, header, start)
+            if response is None:
+                return
+
+            try:
+                with response.open() as f:
+                    checksum = receive_payload(self._socket, f, response.size, buffer, response.hasher)
+                    transfer.transferred(response)
+
+                    expected_checksum = recv_exactly(self._socket, 4) if response.checksummed else None
+
+                transfer.finish(response, f, checksum, expected_checksum)
+            except BaseException:
+                response.abandon()
+                raise
+
+class ChunksTransfer:
+    # Everything of a chunks request but the reads from the connection, shared by the threaded and the asyncio client
+    def __init__(self, peer, address, port, filename, chunks, assembler = None, metadata = None):
+        self._peer = peer
+        self._server = (address, port)
+        self._source = f'{address}:{port}'
+
+        self._filename = filename
+        self._assembler = assembler
+        self._metadata = metadata
+        self._offsets = request_offsets(assembler, chunks)
+        self._message = encode_chunks_request(filename, chunks, self._offsets, metadata['file_hash'] if metadata else None)
+        self._number_of_chunks = len(chunks)
+
+        self._dirname = Constants.FILES_PATH / str(peer.id) / 'tmp'
+        self._outcomes, self._bytes_received, self._fetch_seconds = download_metrics(peer)
+
+        self._received = {}
+        self._busy = False
+
+    @property
+    def message(self):
+        return self._message
+
+    @property
+    def responses(self):
+        return max(1, self._number_of_chunks)
+
+    @property
+    def received(self):
+        return self._received
+
+    @property
+    def busy(self):
+        return self._busy
+
+    def prepare(self):
+        os.makedirs(self._dirname, exist_ok=True)
+
+    def begin(self, index, header, start):
+        received = time.perf_counter()
+
+        # Only the first response of a pipelined request waits for the round trip, the others follow the previous payload
+        if index == 0:
+            self._peer.estimator.record_rtt(self._server, received - start)
+
+        chunk_number, flags, size = struct.unpack(Constants.CHUNKS_RESPONSE_HEADER_FORMAT, header)
+
+        if flags & Constants.CHUNKS_RESPONSE_BUSY:
+            log.debug('TCP Client -> Server has no upload slot left')
+            self._outcomes.inc(1, 'busy')
+            self._busy = True
+            return None
+
+        full_file = bool(flags & Constants.CHUNKS_RESPONSE_FULL_FILE)
+        if full_file:
+            log.debug('TCP Client received specification: Full file, Size -> %s', size)
+            file = self._filename
+        else:
+            log.debug('TCP Client received specification: Chunk number -> %s, Size -> %s', chunk_number, size)
+            file = f'{self._filename}.ch{chunk_number}'
+
+        return ChunkResponse(self, chunk_number, flags, size, file, full_file, start, received)
+
+    def transferred(self, response):
+        self._bytes_received.inc(response.size, self._source)
+        self._peer.estimator.record_transfer(self._server, response.size, time.perf_counter() - response.received)
+
+    def finish(self, response, f, checksum, expected_checksum):
+        file = response.file
+
+        if expected_checksum is not None and checksum != struct.unpack(Constants.CHUNKS_RESPONSE_CHECKSUM_FORMAT, expected_checksum)[0]:
+            log.warning('TCP Client -> Checksum mismatch for %s, discarding it', file)
+            self._outcomes.inc(1, 'checksum_mismatch')
+            self._discard(response, f)
+            return
+
+        if response.hasher and response.hasher.hexdigest() != response.expected_hash:
+            log.warning('TCP Client -> Hash mismatch for %s, discarding it', file)
+            self._outcomes.inc(1, 'hash_mismatch')
+            self._discard(response, f)
+            return
+
+        if response.assembled:
+            f.completed()
+
+            # Chunks of a full file failing their hash were discarded, the rest of it is kept
+            if response.full_file and f.mismatches:
+                log.warning('TCP Client -> Hash mismatch for chunks %s of %s, discarding them', f.mismatches, file)
+                self._outcomes.inc(1, 'hash_mismatch')
+                return
+
+        log.debug('TCP Client received %s', file)
+        self._outcomes.inc(1, 'completed')
+        self._fetch_seconds.observe(time.perf_counter() - response.start)
+
+        if response.keep_file:
+            log.debug('TCP Client moving file %s out of tmp directory', response.filepath)
+            destination = Constants.FILES_PATH / str(self._peer.id) / file
+            os.replace(response.filepath, destination)
+            self._peer.content_store.add(destination)
+
+        self._received[response.chunk] = response.size
+
+    def _discard(self, response, f):
+        if response.assembled:
+            f.failed()
+
+        response.abandon()
+
+class ChunkResponse:
+    def __init__(self, transfer, chunk, flags, size, file, full_file, start, received):
+        self.chunk = chunk
+        self.size = size
+        self.file = file
+        self.full_file = full_file
+        self.checksummed = bool(flags & Constants.CHUNKS_RESPONSE_CHECKSUM)
+        self.start = start
+        self.received = received
+
+        self.assembled = transfer._assembler is not None
+        self.keep_file = not self.assembled or (Constants.KEEP_CHUNK_FILES and not full_file)
+        # Named after the transfer, so duplicate fetches of the same chunk never share a file in tmp
+        self.filepath = transfer._dirname / f'{file}.{id(transfer)}'
+
+        # A full file written through the assembler is verified chunk by chunk instead
+        self.expected_hash = None if self.assembled and full_file else expected_file_hash(transfer._metadata, chunk, full_file)
+        self.hasher = new_hasher() if self.expected_hash else None
+
+        self._transfer = transfer
+        self._offset = transfer._offsets.get(chunk, 0) if self.assembled else 0
+
+    def open(self):
+        transfer = self._transfer
+
+        return open_destination(transfer._assembler, self.chunk, self.size, self.filepath if self.keep_file else None, self._offset, self.hasher, self.full_file, transfer._metadata)
+
+    def abandon(self):
+        # A file of tmp that was not moved out is removed, whether its transfer failed, was cancelled or did not verify
+        if not self.keep_file:
+            return
+
+        try:
+            os.remove(self.filepath)
+        except FileNotFoundError:
+            pass
+
+def download_metrics(peer):
+    metrics = peer.metrics
+
+    return (
+        metrics.counter('p2p_chunks_received_total', 'Chunk and file responses received by TCP clients, by outcome', ('outcome',)),
+        metrics.counter('p2p_bytes_received_total', 'Payload bytes received by TCP clients, by source', ('source',)),
+        metrics.histogram('p2p_chunk_fetch_seconds', 'Time from waiting for a chunk or file response until its payload is verified')
+    )
+
+def expected_file_hash(metadata, chunk, full_file):
+    if not metadata:
+        return None
+
+    if full_file:
+        return metadata['file_hash']
+
+    if chunk < len(metadata['chunk_hashes']):
+        return metadata['chunk_hashes'][chunk]
+
+    return None
+
+def request_offsets(assembler, chunks):
+    if assembler is None:
+        return {}
+
+    # A full file request carries a single offset, resuming after the bytes already assembled
+    if not chunks:
+        return {0: assembler.resume_position()}
+
+    return {c: assembler.offset(c) for c in chunks}
+
+def open_destination(assembler, chunk, size, filepath, offset = 0, hasher = None, full_file = False, metadata = None):
+    if assembler is None:
+        return open(filepath, 'wb')
+
+    if full_file:
+        return assembler.stream(offset, size, metadata['chunk_hashes'] if metadata else ())
+
+    return assembler.writer(chunk, size, filepath, offset, hasher)
+
+def recv_exactly(connection, size):
+    data = bytearray(size)
+    view = memoryview(data)
+
+    received = 0
+    while received < size:
+        n = connection.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('Connection closed by the server')
+
+        received += n
+
+    return bytes(data)
+
+def receive_payload(connection, f, size, buffer, hasher = None):
+    checksum = 0
+
+    remaining = size
+    while remaining > 0:
+        n = connection.recv_into(buffer, min(remaining, len(buffer)))
+        if n == 0:
+            raise ConnectionError('Connection closed by the server')
+
+        checksum = zlib.crc32(buffer[:n], checksum)
+        if hasher:
+            hasher.update(buffer[:n])
+        f.write(buffer[:n])
+        remaining -= n
+
+    return checksum
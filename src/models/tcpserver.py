@@ -1,20 +1,27 @@
 import os
+import logging
 import threading
 import socket
 import struct
 import time
-import traceback
+import zlib
 
 from utils.constants import Constants
+from utils.protocol import CHUNKS_REQUEST_PREFIX, chunks_request_length, decode_chunks_request
+from utils.log import get_logger
+from models.tcpclient import recv_exactly
+
+log = get_logger('tcpserver')
 
 class TCPServer(threading.Thread):
     def __init__(self, address, port, peer):
-        super().__init__()
+        super().__init__(daemon=True)
         self._address = address
         self._port = port
         self._peer = peer
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._socket.bind((self._address, self._port))
 
     @property
@@ -26,75 +33,231 @@ class TCPServer(threading.Thread):
         return self._port
 
     def run(self):
-        self._socket.listen(3)
+        self._socket.listen(Constants.TCP_SERVER_BACKLOG)
+        log.info('TCP Server (Address: %s, Port: %s) listening...', self._address, self._port)
 
         while True:
-            print(f'TCP Server (Address: {self._address}, Port: {self._port}) listening...')
-
             connection, address = self._socket.accept()
-            
-            print(f'TCP Server connected to: {address}')
 
-            self._peer.change_active_tcp_connections(1)
+            log.debug('TCP Server connected to: %s', address)
 
-            threading.Thread(target=transfer_files, args=(connection, self._peer, self._socket)).start()
+            threading.Thread(target=transfer_files, args=(connection, self._peer), daemon=True).start()
 
-def transfer_files(connection, peer, socket):
-    print('TCP Server ready to send files...')
+def transfer_files(connection, peer):
+    log.debug('TCP Server ready to send files...')
+    requests, bytes_sent, request_seconds = upload_metrics(peer)
 
     with connection:
         try:
-            data, _ = connection.recvfrom(4096)
-            number_of_chunks, filename = struct.unpack(Constants.CHUNKS_REQUEST_INITIAL_FORMAT, data[:256])
-            filename = filename.rstrip(b'\x00').decode('utf-8')
-
-            if number_of_chunks == 0:
-                print(f'TCP Server received request to send full file: Number of Chunks -> {number_of_chunks}, Filename -> {filename}')
-
-                connection.sendall(build_file_declaration_message(0, 1))
-                time.sleep(1)
+            client = connection.getpeername()[0]
 
-                filepath = Constants.FILES_PATH / str(peer.id) / filename
+            # Headers and small chunks must not wait for the previous response to be acknowledged
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-                send_file(connection, peer, filepath, filename)
-            else:
-                chunks = list(struct.unpack(f'>{number_of_chunks}I', data[256:]))
-                print(f'TCP Server received request to send chunks: Number of Chunks -> {number_of_chunks}, Filename -> {filename}, Chunks -> {chunks}')
+            # Connections are persistent: requests are served one after the other until the client closes or goes idle
+            connection.settimeout(Constants.TCP_SERVER_IDLE_TIMEOUT)
 
-                for c in chunks:
-                    print(f'TCP Server sending file: Filename -> {filename}, Chunk -> {c}')
+            while True:
+                request = receive_chunks_request(connection, peer)
+                if request is None:
+                    return
 
-                    connection.sendall(build_file_declaration_message(c, 0))
-                    time.sleep(1)
+                if not peer.acquire_upload_slot():
+                    log.debug('TCP Server -> No upload slot left, rejecting request')
+                    requests.inc(1, 'busy')
+                    connection.sendall(build_busy_message())
+                    continue
 
-                    chunk_filename = f'{filename}.ch{c}'
-                    filepath = Constants.FILES_PATH / str(peer.id) / chunk_filename
+                try:
+                    start = time.perf_counter()
+                    with peer.content_store.serving(request[1]):
+                        sent = serve_request(connection, peer, *request)
 
-                    send_file(connection, peer, filepath, chunk_filename)
+                    request_seconds.observe(time.perf_counter() - start)
+                    requests.inc(1, 'served')
+                    bytes_sent.inc(sent, client)
+                finally:
+                    peer.change_active_tcp_connections(-1)
+        except socket.timeout:
+            log.debug('TCP Server -> Closing idle connection')
+        except ConnectionError:
+            log.debug('TCP Server -> Client disconnected')
         except Exception as e:
-            print(f'TCP Server -> An error occurred: {e}')
-            traceback.print_exc()
+            requests.inc(1, 'failed')
+            log.exception('TCP Server -> An error occurred: %s', e)
         finally:
-            socket.close()
-            peer.change_active_tcp_connections(-1)
-            print('TCP Server -> Connection closed!')
+            log.debug('TCP Server -> Connection closed!')
+
+def serve_request(connection, peer, number_of_chunks, filename, ranges):
+    if number_of_chunks == 0:
+        log.debug('TCP Server received request to send full file: Number of Chunks -> %s, Filename -> %s', number_of_chunks, filename)
+
+        filepath = Constants.FILES_PATH / str(peer.id) / filename
+        _, offset = ranges[0]
+        size = remaining_bytes(os.path.getsize(filepath), offset)
+
+        connection.sendall(build_file_declaration_message(0, 1, size))
+
+        send_range(connection, peer, filename, offset, size, 0, filename)
+
+        return size
+    else:
+        log.debug('TCP Server received request to send chunks: Number of Chunks -> %s, Filename -> %s, Ranges -> %s', number_of_chunks, filename, ranges)
+
+        sent = 0
+        for c, offset in ranges:
+            log.debug('TCP Server sending file: Filename -> %s, Chunk -> %s, Offset -> %s', filename, c, offset)
+
+            chunk_range = peer.file_index.chunk_range(filename, c)
+            if chunk_range is None:
+                raise FileNotFoundError(f'Chunk {c} of {filename} is not available')
+
+            source_filename, start, chunk_size = chunk_range
+            size = remaining_bytes(chunk_size, offset)
+
+            connection.sendall(build_file_declaration_message(c, 0, size))
+
+            try:
+                send_range(connection, peer, source_filename, start, chunk_size, offset, f'{filename}.ch{c}')
+            except FileNotFoundError:
+                # The partial file of a download finishing meanwhile was renamed, the chunk is now read from the completed file
+                chunk_range = peer.file_index.chunk_range(filename, c)
+                if chunk_range is None or chunk_range[0] == source_filename:
+                    raise
+
+                source_filename, start, _ = chunk_range
+
+                send_range(connection, peer, source_filename, start, chunk_size, offset, f'{filename}.ch{c}')
+
+            sent += size
+
+        return sent
+
+def receive_chunks_request(connection, peer):
+    first = connection.recv(1)
+    if not first:
+        return None
+
+    prefix = first + recv_exactly(connection, CHUNKS_REQUEST_PREFIX.size - 1)
+
+    number_of_chunks, filename, file_hash, ranges = decode_chunks_request(recv_exactly(connection, chunks_request_length(prefix)))
+
+    return number_of_chunks, peer.file_index.resolve(filename, file_hash), ranges
+
+def upload_metrics(peer):
+    metrics = peer.metrics
+
+    return (
+        metrics.counter('p2p_upload_requests_total', 'Chunk and file requests received by the TCP server, by outcome', ('outcome',)),
+        metrics.counter('p2p_bytes_sent_total', 'Payload bytes sent by the TCP server, by client address', ('client',)),
+        metrics.histogram('p2p_upload_request_seconds', 'Time to serve a chunk or file request')
+    )
+
+def log_sent(server, filename, bucket):
+    # The achieved rate walks the recent history of the bucket, so it is only computed when the record is kept
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('%s reached EOF for file: %s. Upload rate -> %.0f/%s B/s', server, filename, bucket.achieved_rate(), bucket.rate)
+
+def truncated_file_error(filename, missing):
+    # The header already promised the whole size, so a short payload would leave the client waiting until the idle timeout
+    return EOFError(f'{filename} ended {missing} bytes before the size declared to the client')
+
+def remaining_bytes(size, offset):
+    if offset > size:
+        raise ValueError(f'Offset {offset} is past the end of a {size} bytes file')
 
-def build_file_declaration_message(number, full_file):
-    return struct.pack(Constants.CHUNKS_RESPONSE_FILE_SPECIFICATION_FORMAT, number, full_file)
+    return size - offset
+
+def build_busy_message():
+    return struct.pack(Constants.CHUNKS_RESPONSE_HEADER_FORMAT, 0, Constants.CHUNKS_RESPONSE_BUSY, 0)
+
+def build_file_declaration_message(number, full_file, size):
+    flags = Constants.CHUNKS_RESPONSE_FULL_FILE if full_file else 0
+    if checksum_enabled():
+        flags |= Constants.CHUNKS_RESPONSE_CHECKSUM
+
+    return struct.pack(Constants.CHUNKS_RESPONSE_HEADER_FORMAT, number, flags, size)
+
+def checksum_enabled():
+    # With sendfile the payload never reaches userspace, so there is nothing to checksum
+    return Constants.TRANSFER_CHECKSUM and not Constants.TCP_SERVER_SENDFILE
+
+def send_range(connection, peer, source_filename, start, size, offset, filename):
+    # Chunks requested often are sent from the hot cache of the content store, the rest is read from disk
+    cached = peer.content_store.read(source_filename, start, size)
+    if cached is None:
+        send_file(connection, peer, Constants.FILES_PATH / str(peer.id) / source_filename, filename, start + offset, size - offset)
+        return
+
+    # The cached checksum covers the whole chunk, a resumed request needs one of its remainder
+    content, checksum = cached
+    if offset:
+        content, checksum = memoryview(content)[offset:], None
+
+    send_content(connection, peer, content, filename, checksum)
+
+def send_content(connection, peer, content, filename, checksum = None):
+    bucket = peer.upload_bucket
+    block_size = min(Constants.TRANSFER_BLOCK_SIZE, bucket.capacity)
+    content = memoryview(content)
+
+    for position in range(0, len(content), block_size):
+        block = content[position:position + block_size]
+
+        bucket.consume(len(block))
+        connection.sendall(block)
+
+    log_sent('TCP', filename, bucket)
+
+    if checksum_enabled():
+        if checksum is None:
+            checksum = zlib.crc32(content)
+
+        connection.sendall(struct.pack(Constants.CHUNKS_RESPONSE_CHECKSUM_FORMAT, checksum))
+
+def send_file(connection, peer, filepath, filename, offset = 0, size = None):
+    bucket = peer.upload_bucket
+    block_size = min(Constants.TRANSFER_BLOCK_SIZE, bucket.capacity)
+    checksum = 0
 
-def send_file(connection, peer, filepath, filename):
     with open(filepath, 'rb') as f:
-        while True:
-            bytes_to_read = peer.speed()
-            content = f.read(bytes_to_read)
+        if size is None:
+            size = os.fstat(f.fileno()).st_size - offset
+
+        end = offset + size
+
+        if Constants.TCP_SERVER_SENDFILE:
+
+            while offset < end:
+                count = min(block_size, end - offset)
+
+                bucket.consume(count)
+                sent = connection.sendfile(f, offset, count)
+
+                # A file truncated or evicted while being sent makes no progress, instead of being retried forever
+                if not sent:
+                    raise truncated_file_error(filename, end - offset)
+
+                offset += sent
+
+            log_sent('TCP', filename, bucket)
+            return
+
+        f.seek(offset)
+
+        while f.tell() < end:
+            content = f.read(min(block_size, end - f.tell()))
 
             if not content:
-                print(f'TCP reached EOF for file: {filename}.')
-                connection.sendall(b'\x00')
-                time.sleep(1)
-                break
+                raise truncated_file_error(filename, end - f.tell())
+
+            if checksum_enabled():
+                checksum = zlib.crc32(content, checksum)
 
-            print(f'TCP Server sending message: {content}')
+            bucket.consume(len(content))
             connection.sendall(content)
 
-            time.sleep(1)
+        log_sent('TCP', filename, bucket)
+
+    if checksum_enabled():
+        connection.sendall(struct.pack(Constants.CHUNKS_RESPONSE_CHECKSUM_FORMAT, checksum))
@@ -1,69 +1,108 @@
+import logging
 import threading
-import socket
-import struct
-import re
+import time
+import queue
 
 from utils.constants import Constants
+from utils.protocol import decode_response, ProtocolError
+from utils.log import get_logger
+
+log = get_logger('udpclient')
 
 class UDPClient(threading.Thread):
-    def __init__(self, client_address, client_udp_port, servers, buffer, message, filename, blocking = False):
+    def __init__(self, search_socket, query_id, servers, availability, message, filename, on_response = None, metrics = None):
         super().__init__()
 
-        self._address = client_address
-        self._port = client_udp_port
+        self._search_socket = search_socket
+        self._query_id = query_id
         self._servers = servers
-        self._buffer = buffer
+        self._availability = availability
         self._message = message
         self._filename = filename
-        self._blocking = blocking
+        self._on_response = on_response
+
+        self._responses = 0
+        self._located_after = None
+
+        self._metrics = None
+        if metrics:
+            self._metrics = (
+                metrics.counter('p2p_search_responses_total', 'Flooding responses received by searches'),
+                metrics.histogram('p2p_search_seconds', 'Duration of the search phase, by whether every chunk or the full file was located', ('outcome',)),
+                metrics.histogram('p2p_search_locate_seconds', 'Time from sending a query until every chunk or the full file had a source')
+            )
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.bind((self._address, self._port))
-        self._socket.settimeout(Constants.UDP_CLIENT_TIMEOUT)
+    @property
+    def query_id(self):
+        return self._query_id
+
+    @property
+    def responses(self):
+        return self._responses
+
+    @property
+    def located_after(self):
+        return self._located_after
 
     def run(self):
+        responses = self._search_socket.register(self._query_id)
+
         for s in self._servers:
-            self._socket.sendto(self._message, s.address)
-
-        if self._blocking:
-            try:
-                while True:
-                    data, _ = self._socket.recvfrom(4096)
-
-                    peer_id, tcp_address, tcp_port, full_file_present, full_file_time, number_of_chunks, filename = struct.unpack(Constants.FLOODING_RESPONSE_INITIAL_FORMAT, data[:267])
-                    filename = filename.rstrip(b'\x00').decode('utf-8')
-
-                    tcp_address = socket.inet_ntoa(tcp_address)
-
-                    chunks = {}
-                    chunks_data = data[267:]
-                    for i in range(0, len(chunks_data), 8):
-                        chunk_time, chunk_number = struct.unpack(Constants.FLOODING_RESPONSE_CHUNK_FORMAT, chunks_data[i:i+8])
-                        chunk_time = int(chunk_time)
-                        chunk_number = int(chunk_number)
-
-                        chunks[chunk_number] = chunk_time
-
-                    print(f'Received response from ID -> {peer_id}: TCP address -> {tcp_address}, TCP port -> {tcp_port}, Full file present -> {full_file_present}, Full file time -> {full_file_time}, Number of chunks -> {number_of_chunks}, Filename -> {filename}, Chunks -> {list(chunks.keys())}')
-            
-                    for chunk_number, chunk_time in chunks.items():
-                        if not self._buffer[chunk_number] or self._buffer[chunk_number]['time'] > chunk_time:
-                            self._buffer[chunk_number] = {
-                                'chunk': chunk_number,
-                                'address': tcp_address,
-                                'port': tcp_port,
-                                'time': chunk_time
-                            }
-
-                    if full_file_present:
-                        if not self._buffer[-1] or self._buffer[-1]['time'] > full_file_time:
-                            self._buffer[-1] = {
-                                'chunk': filename,
-                                'address': tcp_address,
-                                'port': tcp_port,
-                                'time': full_file_time
-                            }
-            except socket.timeout:
-                print('UDP Client timed out!')
-            finally:
-                self._socket.close()
+            self._search_socket.send(self._message, s.address)
+
+        start = time.monotonic()
+        grace_deadline = None
+        timeout = Constants.UDP_CLIENT_TIMEOUT
+
+        try:
+            while True:
+                if grace_deadline is not None:
+                    timeout = max(0, grace_deadline - time.monotonic())
+
+                data = responses.get(timeout=timeout)
+
+                try:
+                    response = decode_response(data)
+                except ProtocolError as e:
+                    log.warning('UDP Client -> Dropping malformed response: %s', e)
+                    continue
+
+                self._responses += 1
+
+                peer_id, tcp_address, tcp_port = response['peer_id'], response['address'], response['port']
+                full_file_present, full_file_time, chunks = response['full_file'], response['full_file_time'], response['chunks']
+
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('Received response from ID -> %s: TCP address -> %s, TCP port -> %s, Full file present -> %s, Full file time -> %s, Load -> %s, Number of chunks -> %d, Filename -> %s',
+                              peer_id, tcp_address, tcp_port, full_file_present, full_file_time, response['load'], sum(c.bit_count() for c in chunks.values()), self._filename)
+
+                self._availability.merge((tcp_address, tcp_port), chunks, full_file_time if full_file_present else None, response['load'])
+
+                if self._on_response:
+                    self._on_response()
+
+                if self._located_after is None and self._all_sources_located():
+                    self._located_after = time.monotonic() - start
+
+                if Constants.UDP_CLIENT_EARLY_FINISH and grace_deadline is None and self._all_sources_located():
+                    log.debug('UDP Client located every chunk, waiting for better offers')
+                    grace_deadline = time.monotonic() + Constants.UDP_CLIENT_GRACE_PERIOD
+        except queue.Empty:
+            if grace_deadline is None:
+                log.info('UDP Client timed out!')
+        finally:
+            self._search_socket.unregister(self._query_id)
+
+            if self._metrics:
+                self._observe(time.monotonic() - start)
+
+    def _observe(self, duration):
+        responses, search_seconds, locate_seconds = self._metrics
+
+        responses.inc(self._responses)
+        search_seconds.observe(duration, 'timeout' if self._located_after is None else 'located')
+        if self._located_after is not None:
+            locate_seconds.observe(self._located_after)
+
+    def _all_sources_located(self):
+        return self._availability.best_file_source() is not None or self._availability.all_located()
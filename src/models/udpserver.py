@@ -1,78 +1,308 @@
 import threading
 import socket
-import struct
-import re
-from time import sleep
+import queue
+import time
 
 from utils.constants import Constants
+from utils.protocol import decode_query, decode_response, encode_responses, encode_batches, split_responses, message_kind, response_query_id, query_ttl, ProtocolError, QUERY, HAVE
+from utils.seen_cache import SeenCache
+from utils.shedding_queue import SheddingQueue
+from utils.log import get_logger
+from utils import bitfield
+from models.querycache import QueryCache
+
+log = get_logger('udpserver')
 
 class UDPServer(threading.Thread):
     def __init__(self, address, port, peer):
-        super().__init__()
+        super().__init__(daemon=True)
 
         self._peer = peer
         self._address = address
         self._port = port
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, Constants.UDP_RECV_BUFFER_SIZE)
         self._socket.bind((self._address, self._port))
 
+        self._requests_received = 0
+
+        # Received datagrams wait here for the workers, so the socket is drained while they are handled
+        self._received = SheddingQueue(Constants.UDP_QUEUE_SIZE, 'lowest' if Constants.UDP_SHED_POLICY == 'lowest_ttl' else 'oldest')
+        self._workers = [threading.Thread(target=self._work_loop, daemon=True) for _ in range(Constants.UDP_WORKERS)]
+        self._shed = 0
+
+        metrics = peer.metrics
+        self._queries = metrics.counter('p2p_queries_received_total', 'Flooding queries and relayed responses received, by outcome', ('outcome',))
+        self._query_seconds = metrics.histogram('p2p_query_handling_seconds', 'Time to answer and forward a flooding query')
+        self._queue_seconds = metrics.histogram('p2p_udp_queue_seconds', 'Time received queries and responses wait for a worker')
+        self._shed_total = metrics.counter('p2p_udp_shed_total', 'Queries and responses dropped because the receive queue was full, by kind', ('kind',))
+        self._forwards_dropped_total = metrics.counter('p2p_forwards_dropped_total', 'Queries not forwarded because the forward queue was full')
+        self._datagrams_sent = metrics.counter('p2p_udp_datagrams_sent_total', 'Datagrams sent by the UDP server, by kind', ('kind',))
+
+        self._forward_queue = queue.Queue(Constants.UDP_FORWARD_QUEUE_SIZE)
+        self._forwards_dropped = 0
+        self._forwarder = threading.Thread(target=self._forward_loop, daemon=True)
+
+        # Queries per file, whose requesters are told about the chunks of it this peer acquires
+        self._interest = SeenCache(Constants.INTEREST_CACHE_SIZE, Constants.INTEREST_TIMEOUT)
+        self._announcements = {}
+        self._announcements_lock = threading.Lock()
+        self._announcer = threading.Thread(target=self._announce_loop, daemon=True)
+
+        # Responses to the queries this peer forwarded come back through it, are cached per file and sent on, by batches when aggregating
+        self._query_cache = QueryCache()
+        self._relayed = {}
+        self._relayed_lock = threading.Lock()
+        self._aggregator = threading.Thread(target=self._aggregate_loop, daemon=True)
+
     @property
-    def address(self):
-        return self._address
+    def requests_received(self):
+        return self._requests_received
+
+    @property
+    def forwards_dropped(self):
+        return self._forwards_dropped
+
+    @property
+    def shed(self):
+        return self._shed
+
+    @property
+    def queue_depth(self):
+        return len(self._received)
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+        self._forwarder.start()
+        self._announcer.start()
+        if Constants.QUERY_AGGREGATION_WINDOW:
+            self._aggregator.start()
+        super().start()
+
+    def forward(self, message, neighbors):
+        try:
+            self._forward_queue.put_nowait((time.monotonic() + Constants.REROUTE_DELAY, message, neighbors))
+        except queue.Full:
+            self._forwards_dropped += 1
+            self._forwards_dropped_total.inc()
+            log.warning('UDP Server -> Forward queue full, dropping query')
+
+    def _forward_loop(self):
+        while True:
+            due, message, neighbors = self._forward_queue.get()
+
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            for n in neighbors:
+                try:
+                    self._socket.sendto(message, n.address)
+                    self._datagrams_sent.inc(1, 'forward')
+                except OSError as e:
+                    log.warning('UDP Server -> Could not forward query to %s: %s', n, e)
+
+    def announce(self, filename, chunk):
+        with self._announcements_lock:
+            self._announcements[filename] = self._announcements.get(filename, 0) | 1 << chunk
+
+    def _announce_loop(self):
+        while True:
+            time.sleep(Constants.ANNOUNCE_INTERVAL)
+
+            with self._announcements_lock:
+                announcements, self._announcements = self._announcements, {}
+
+            if not announcements:
+                continue
+
+            interest = self._interest.keys()
+
+            for filename, chunks in announcements.items():
+                requesters = [(address, port, query_id) for f, address, port, query_id in interest if f == filename]
+                if requesters:
+                    self._send_announcements(filename, chunks, requesters)
+
+    def _send_announcements(self, filename, chunks, requesters):
+        _, sizes = self._peer.file_index.lookup(filename)
+        chunk_times = {c: self._peer.sending_time(sizes[c]) for c in bitfield.chunks(chunks) if c in sizes}
+        if not chunk_times:
+            return
+
+        tcp_server = self._peer.create_tcp_server()
+        load = self._peer.load()
+
+        for address, port, query_id in requesters:
+            log.debug('UDP Server -> Announcing %d chunks of %s to %s:%s', len(chunk_times), filename, address, port)
+
+            for message in encode_responses(self._peer.id, query_id, tcp_server.address, tcp_server.port, False, 0, chunk_times, load, kind=HAVE):
+                try:
+                    self._socket.sendto(message, (address, port))
+                    self._datagrams_sent.inc(1, 'announcement')
+                except OSError as e:
+                    log.warning('UDP Server -> Could not announce chunks to %s:%s: %s', address, port, e)
 
     @property
     def address(self):
         return (self._address, self._port)
 
     def run(self):
-        while True:
-            print(f'UDP Server (Address: {self._address}, Port: {self._port}) listening...')
+        log.info('UDP Server (Address: %s, Port: %s) listening...', self._address, self._port)
 
+        while True:
             data = self._socket.recv(4096)
+            received = time.monotonic()
 
-            ttl, requester_id, requester_address, requester_port, requested_file = struct.unpack(Constants.FLOODING_REQUEST_FORMAT, data)
-            requested_file = requested_file.rstrip(b'\x00').decode('utf-8')
-            requester_address = socket.inet_ntoa(requester_address)
-            print(f'Received request from ID -> {requester_id}, ADDRESS -> {requester_address}, PORT -> {requester_port}: TTL -> {ttl}, FILENAME -> {requested_file}')
+            self._requests_received += 1
 
-            peer_folder = Constants.FILES_PATH / str(self._peer.id)
-            files = [f for f in peer_folder.iterdir() if f.is_file()]
-            chunks = {}
-            entire_file = False
-            entire_file_size = 0
+            if not self._workers:
+                self._process(received, data)
+                continue
+
+            # Queries with fewer hops left reach fewer peers, relayed responses are only shed when no query is left
+            ttl = query_ttl(data)
+            shed = self._received.put((received, data), 0x100 if ttl is None else ttl)
+
+            if shed is not None:
+                kind = 'response' if query_ttl(shed[1]) is None else 'query'
+                self._shed += 1
+                self._shed_total.inc(1, kind)
+                log.debug('UDP Server -> Receive queue full, dropping a %s', kind)
+
+    def _work_loop(self):
+        while True:
+            self._process(*self._received.get())
 
-            for f in files:
-                filename = f.name
-                if filename.startswith(requested_file):
-                    size = f.stat().st_size
-                    if filename == requested_file:
-                        entire_file = True
-                        entire_file_size = size
+    def _process(self, received, data):
+        self._queue_seconds.observe(time.monotonic() - received)
 
-                        continue
+        with self._query_seconds.time():
+            try:
+                outcome = self._handle(data)
+            except Exception as e:
+                log.exception('UDP Server -> An error occurred: %s', e)
+                outcome = 'failed'
 
-                    chunks[int(re.search(r'\.ch(\d+)', filename).group(1))] = size
+            self._queries.inc(1, outcome)
 
+    def _handle(self, data):
+        try:
+            relayed = message_kind(data) != QUERY
+            query = None if relayed else decode_query(data)
+        except ProtocolError as e:
+            log.warning('UDP Server -> Dropping malformed message: %s', e)
+            return 'malformed'
+
+        if relayed:
+            return self._relay(data)
+
+        ttl, requester_id, query_id = query['ttl'], query['peer_id'], query['query_id']
+        requester_address, requester_port = query['address'], query['port']
+        log.debug('Received request from ID -> %s, QUERY -> %s, ADDRESS -> %s, PORT -> %s: TTL -> %s, FILENAME -> %s, HASH -> %s', requester_id, query_id, requester_address, requester_port, ttl, query['filename'], query['file_hash'])
+
+        if Constants.DUPLICATE_QUERY_SUPPRESSION and not self._peer.seen_queries.add((requester_id, query_id)):
+            log.debug('Dropping duplicate query %s from ID -> %s', query_id, requester_id)
+            return 'duplicate'
+
+        requested_file = self._peer.file_index.resolve(query['filename'], query['file_hash'])
+        self._interest.add((requested_file, requester_address, requester_port, query_id))
+
+        entire_file_size, chunks = self._peer.file_index.lookup(requested_file)
+        entire_file = entire_file_size is not None
+        entire_file_size = entire_file_size or 0
+
+        # A peer without upload speed would answer every request for them busy, so it only forwards the query
+        if self._peer.uploads:
             tcp_server = self._peer.create_tcp_server()
-            response = self._flooding_response(tcp_server, chunks, entire_file, entire_file_size, requested_file)
-            self._socket.sendto(response, (requester_address, requester_port))
+            for response in self._flooding_responses(tcp_server, query_id, chunks, entire_file, entire_file_size):
+                self._socket.sendto(response, (requester_address, requester_port))
+                self._datagrams_sent.inc(1, 'response')
+
+        ttl -= 1
+        if ttl <= 0:
+            return 'answered'
 
-            ttl -= 1
-            if ttl > 0:
-                sleep(1)
-                self._peer.reroute(ttl, requester_id, requester_address, requester_port, requested_file)
+        if not Constants.QUERY_RESULT_CACHE:
+            self._peer.reroute(ttl, requester_id, query_id, requester_address, requester_port, query['filename'], query['file_hash'])
+            return 'answered'
 
-    def _flooding_response(self, tcp_server, chunks, entire_file, entire_file_size, filename):
-        chunk_number = len(chunks)
+        # Files are cached by what was asked for, the same for every requester whatever this peer calls them
+        key = query['file_hash'] or query['filename']
+
+        holders = self._query_cache.lookup(key, ttl)
+        if holders:
+            self._send_cached(holders, requester_id, query_id, (requester_address, requester_port))
+            return 'cached'
+
+        self._query_cache.relay(query_id, (requester_address, requester_port), key, ttl)
+        self._peer.reroute(ttl, requester_id, query_id, self._address, self._port, query['filename'], query['file_hash'])
+
+        return 'answered'
+
+    def _send_cached(self, holders, requester_id, query_id, requester):
+        responses = []
+        for peer_id, holder in holders.items():
+            # The requester may have answered an earlier query for the file itself
+            if peer_id == requester_id:
+                continue
+
+            chunk_times = {c: sending_time for sending_time, chunks in holder['chunks'].items() for c in bitfield.chunks(chunks)}
+            responses.extend(encode_responses(peer_id, query_id, holder['address'], holder['port'], holder['full_file'], holder['full_file_time'], chunk_times, holder['load']))
+
+        log.debug('UDP Server -> Answering query %s with %d cached responses', query_id, len(responses))
+
+        for message in encode_batches(query_id, responses):
+            self._socket.sendto(message, requester)
+            self._datagrams_sent.inc(1, 'cached')
+
+    def _relay(self, data):
+        # Every response of a batch answers the same query; all of them are decoded before any is cached, so a malformed datagram is dropped whole
+        try:
+            query_id = response_query_id(data)
+            responses = split_responses(data)
+
+            relay = self._query_cache.upstream(query_id)
+            if relay is None:
+                log.debug('UDP Server -> Dropping response to unknown query %s', query_id)
+                return 'unknown'
+
+            decoded = [decode_response(message) for message in responses]
+        except ProtocolError as e:
+            log.warning('UDP Server -> Dropping malformed message: %s', e)
+            return 'malformed'
+
+        upstream, key = relay
+        for response in decoded:
+            self._query_cache.record(key, response)
+
+        if Constants.QUERY_AGGREGATION_WINDOW:
+            with self._relayed_lock:
+                self._relayed.setdefault((upstream, query_id), []).extend(responses)
+        else:
+            self._socket.sendto(data, upstream)
+            self._datagrams_sent.inc(1, 'relay')
+
+        return 'relayed'
+
+    def _aggregate_loop(self):
+        while True:
+            time.sleep(Constants.QUERY_AGGREGATION_WINDOW)
 
-        response_message = struct.pack(
-            Constants.FLOODING_RESPONSE_INITIAL_FORMAT, self._peer.id, socket.inet_aton(tcp_server.address), tcp_server.port, entire_file, self._peer.sending_time(entire_file_size), chunk_number, filename.encode('utf-8').ljust(255, b'\x00')
-        )
+            with self._relayed_lock:
+                relayed, self._relayed = self._relayed, {}
 
-        for chunk_number, chunk_size in chunks.items():
-            chunk_data = struct.pack(Constants.FLOODING_RESPONSE_CHUNK_FORMAT, self._peer.sending_time(chunk_size), chunk_number)
+            for (upstream, query_id), responses in relayed.items():
+                for message in encode_batches(query_id, responses):
+                    try:
+                        self._socket.sendto(message, upstream)
+                        self._datagrams_sent.inc(1, 'relay')
+                    except OSError as e:
+                        log.warning('UDP Server -> Could not relay responses to %s:%s: %s', *upstream, e)
 
-            response_message += chunk_data
+    def _flooding_responses(self, tcp_server, query_id, chunks, entire_file, entire_file_size):
+        chunk_times = {chunk_number: self._peer.sending_time(chunk_size) for chunk_number, chunk_size in chunks.items()}
 
-        return response_message
+        return encode_responses(self._peer.id, query_id, tcp_server.address, tcp_server.port, entire_file, self._peer.sending_time(entire_file_size), chunk_times, self._peer.load())
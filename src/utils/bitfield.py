@@ -0,0 +1,58 @@
+import re
+
+# Chunk sets are Python ints with bit c set for chunk c: unions, intersections and counts run over whole machine words
+
+NONZERO_BYTE = re.compile(b'[^\x00]')
+BYTE_BITS = [tuple(b for b in range(8) if value >> b & 1) for value in range(256)]
+
+def from_chunks(chunks):
+    chunks = list(chunks)
+    if not chunks:
+        return 0
+
+    data = bytearray(max(chunks) // 8 + 1)
+    for c in chunks:
+        data[c >> 3] |= 1 << (c & 7)
+
+    return int.from_bytes(data, 'little')
+
+def from_range(start, length):
+    return ((1 << length) - 1) << start
+
+def chunks(bitfield):
+    data = bitfield.to_bytes((bitfield.bit_length() + 7) // 8, 'little')
+
+    result = []
+    for match in NONZERO_BYTE.finditer(data):
+        base = match.start() * 8
+        result.extend(base + b for b in BYTE_BITS[data[match.start()]])
+
+    return result
+
+def lowest(bitfield, limit = None):
+    if limit is None:
+        return chunks(bitfield)
+
+    # Peels the lowest set bit off one at a time, without listing the whole set for a few chunks
+    result = []
+    while bitfield and len(result) < limit:
+        low = bitfield & -bitfield
+        result.append(low.bit_length() - 1)
+        bitfield ^= low
+
+    return result
+
+def nth(bitfield, n):
+    # Bisects on the number of set bits below a position, so picking one chunk of a large set never lists all of them
+    low, high = 0, bitfield.bit_length()
+    while high - low > 1:
+        middle = (low + high) // 2
+        if (bitfield & ((1 << middle) - 1)).bit_count() > n:
+            high = middle
+        else:
+            low = middle
+
+    return low
+
+def contains(bitfield, chunk):
+    return bitfield >> chunk & 1 == 1
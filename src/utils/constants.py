@@ -4,24 +4,180 @@ class Constants:
     FILES_PATH = Path('example')
 
     TCP_SERVER_PORT = 4000
-    UDP_REROUTE_PORT = 4100
     UDP_CLIENT_PORT = 5000
 
+    # Start the TCP server with the peer instead of on the first query it answers
+    TCP_SERVER_AT_STARTUP = True
+
     MAX_TCP_CLIENTS = 2
 
+    # Keep client connections open for reuse, at most MAX_IDLE per server for IDLE_TIMEOUT seconds
+    # Servers close connections that stay idle for longer than TCP_SERVER_IDLE_TIMEOUT, so it must be the larger one
+    TCP_CONNECTION_POOL = True
+    TCP_POOL_MAX_IDLE = 4
+    TCP_POOL_IDLE_TIMEOUT = 20
+    TCP_SERVER_IDLE_TIMEOUT = 30
+
+    # 'work_stealing' (sources pull outstanding chunks) or 'static' (every chunk fetched from its fastest source)
+    CHUNK_SCHEDULER = 'work_stealing'
+    MAX_CHUNK_DUPLICATES = 2
+    MAX_SOURCE_FAILURES = 3
+    # Chunks the work stealing scheduler requests from a source at once, served back to back on one connection
+    REQUEST_PIPELINE_DEPTH = 1
+    SCHEDULER_POLL_INTERVAL = 0.5
+    # 'rarest_first' (chunks advertised by the fewest sources first) or 'sequential' (in chunk order)
+    CHUNK_SELECTION = 'rarest_first'
+    # Spread the chunks of the static scheduler over sources by their advertised load and the chunks already assigned to them, instead of always the fastest
+    LOAD_AWARE_SELECTION = True
+
+    # Weight of a new sample in the round trip time and throughput estimated for every source, the round trip assumed for sources without samples,
+    # and the shortest payload transfer (in seconds) taken as a throughput sample
+    ESTIMATE_SMOOTHING = 0.25
+    ESTIMATE_DEFAULT_RTT = 0.02
+    ESTIMATE_MIN_TRANSFER_TIME = 0.01
+
+    # Requests a peer serves at once; further requests are rejected as busy so downloaders move to other sources (0 for no limit)
+    MAX_UPLOAD_SLOTS = 8
+    # Seconds a downloader waits before asking a busy source again
+    SOURCE_BUSY_BACKOFF = 1
+    TCP_SERVER_BACKLOG = 128
+
+    # 'threads' (one thread per connection) or 'asyncio' (one event loop per peer)
+    TRANSFER_MODE = 'threads'
+
     UDP_CLIENT_TIMEOUT = 20
 
-    # TTL (1B), Peer ID (2B), Address (4B String), Port (2B), Filename (255B String)
-    FLOODING_REQUEST_FORMAT = '!BH4sH255s'
+    # Stop searching once every chunk (or the full file) has a source, after a grace period for better offers
+    UDP_CLIENT_EARLY_FINISH = True
+    UDP_CLIENT_GRACE_PERIOD = 0.5
+
+    # Start fetching located chunks while the search is still running
+    EARLY_FETCH = True
+
+    # Assemble the full file by writing each chunk at its offset as it arrives ('positional') or by concatenating the chunk files at the end ('concatenate')
+    # Positional assembly needs the file and chunk sizes in the metadata file, otherwise it falls back to concatenation
+    ASSEMBLY_MODE = 'positional'
+
+    # Also store every fetched chunk as its own file, so it can be served to other peers
+    KEEP_CHUNK_FILES = True
+
+    # Bytes of chunks and full files a peer keeps (0 for no limit); beyond it the least recently used ('lru') or least requested ('popularity') ones are deleted,
+    # never those of a download in progress or of a file being served
+    STORE_QUOTA = 0
+    STORE_EVICTION = 'lru'
+
+    # Delete the chunk files of a download once its full file is assembled, its chunks are then served from the full file (needs the chunk size in the metadata file)
+    STORE_REMOVE_ASSEMBLED_CHUNKS = True
+
+    # Keep chunks of at most MAX_CHUNK bytes requested at least MIN_REQUESTS times in memory, up to SIZE bytes in all (0 to disable), so serving them reads no disk;
+    # requests are counted for at most TRACKED_CHUNKS chunks not cached yet
+    HOT_CACHE_SIZE = 16 * 1024 * 1024
+    HOT_CACHE_MAX_CHUNK = 1024 * 1024
+    HOT_CACHE_MIN_REQUESTS = 2
+    HOT_CACHE_TRACKED_CHUNKS = 4096
+
+    # Keep a journal of the chunks (and bytes of partial chunks) already assembled, so a failed or restarted download resumes where it stopped
+    # Needs positional assembly; the journal is saved at most every FLUSH_INTERVAL seconds while data arrives
+    RESUME_DOWNLOADS = True
+    JOURNAL_FLUSH_INTERVAL = 0.5
+
+    # Serve the chunks already completed (and verified) by a download while it is still in progress
+    SEED_WHILE_DOWNLOADING = True
+
+    # Send the chunks a download acquires, every ANNOUNCE_INTERVAL seconds, to the peers whose queries for the file arrived in the last INTEREST_TIMEOUT seconds
+    ANNOUNCE_CHUNKS = True
+    ANNOUNCE_INTERVAL = 0.2
+    INTEREST_CACHE_SIZE = 4096
+    INTEREST_TIMEOUT = 60
+
+    # Forward queries with this peer as the reply address, so the responses come back through it and are cached per file for CACHE_TIMEOUT seconds;
+    # repeat queries reaching no further are answered from the cache instead of flooding again. Forwarded queries are remembered for RELAY_TIMEOUT seconds,
+    # so chunk announcements still reach the requester
+    QUERY_RESULT_CACHE = True
+    QUERY_CACHE_SIZE = 1024
+    QUERY_CACHE_TIMEOUT = 30
+    QUERY_RELAY_SIZE = 4096
+    QUERY_RELAY_TIMEOUT = 60
+    # Seconds relayed responses are held to be sent upstream together in batches (0 to relay every response at once)
+    QUERY_AGGREGATION_WINDOW = 0
+
+    # Threads handling received queries and responses (0 to handle them on the receiving thread), and how many may wait for them;
+    # when the queue is full the oldest message ('drop_oldest') or the query with the fewest hops left ('lowest_ttl', relayed responses last) is dropped
+    UDP_WORKERS = 4
+    UDP_QUEUE_SIZE = 1024
+    UDP_SHED_POLICY = 'drop_oldest'
+
+    # Seconds a query waits before being forwarded to neighbors, and how many forwards may be waiting
+    REROUTE_DELAY = 1
+    UDP_FORWARD_QUEUE_SIZE = 1024
+
+    # Bytes of kernel receive buffer requested for UDP sockets, so bursts of queries and responses are not dropped
+    UDP_RECV_BUFFER_SIZE = 1024 * 1024
+
+    # Drop flooding requests already seen, remembering at most SIZE queries for TIMEOUT seconds
+    DUPLICATE_QUERY_SUPPRESSION = True
+    SEEN_QUERY_CACHE_SIZE = 4096
+    SEEN_QUERY_CACHE_TIMEOUT = 60
+
+    # Seconds between checks of the peer folder for files added or removed outside the peer
+    FILE_INDEX_POLL_INTERVAL = 2
+
+    # Largest block handed to the socket at once; smaller when the token bucket burst is smaller
+    TRANSFER_BLOCK_SIZE = 64 * 1024
+
+    # Seconds of upload allowance a peer can burst, and window used to report its achieved rate
+    TOKEN_BUCKET_BURST = 0.1
+    TOKEN_BUCKET_RATE_WINDOW = 5
+
+    # Size of the preallocated buffer chunk payloads are received into
+    RECV_BUFFER_SIZE = 256 * 1024
+
+    # Append a CRC32 trailer to every chunk response (not available with sendfile)
+    TRANSFER_CHECKSUM = True
+
+    # Serve files with zero-copy sendfile instead of read/sendall
+    TCP_SERVER_SENDFILE = False
+
+    # 'debug' (every request, response and chunk), 'info', 'warning', 'error' or 'critical'; records below it are never formatted
+    LOG_LEVEL = 'info'
+
+    # Serve the metrics of every peer in Prometheus text format over HTTP, on METRICS_PORT plus the peer ID
+    METRICS_ENDPOINT = False
+    METRICS_PORT = 9000
+
+    # hashlib algorithm used for the chunk and file hashes in metadata files
+    HASH_ALGORITHM = 'sha256'
+
+    # Version of the wire protocol, the first byte of every message; messages of other versions are rejected
+    PROTOCOL_VERSION = 4
+
+    # Most chunks a file may have; chunk sets reaching past it are rejected, so a few bytes from another peer never decode into a huge bitfield
+    MAX_CHUNKS = 1 << 20
+
+    # Largest flooding response datagram; responses announcing more chunks are split into several datagrams
+    UDP_MAX_DATAGRAM_SIZE = 1400
+
+    # Version (1B), Type (1B), TTL (1B), Peer ID (2B), Query ID (4B), Address (4B String), Port (2B), followed by the file identifier
+    FLOODING_REQUEST_FORMAT = '!BBBHI4sH'
+
+    # Version (1B), Type (1B), Query ID (4B), Peer ID (2B), Address (4B String), Port (2B), Flags (1B), Active uploads (2B), Upload slots (2B),
+    # followed by the full file time (varint) when the full file flag is set, then the chunk set; sending times are in milliseconds
+    FLOODING_RESPONSE_FORMAT = '!BBIH4sHBHH'
+    FLOODING_RESPONSE_FULL_FILE = 0x01
 
-    # Peer ID (2B), Address (4B String), Port (2B), Full File (1B), Full File Time (2B), Number of Chunks (1B), Filename (255B String)
-    FLOODING_RESPONSE_INITIAL_FORMAT = '!H4sHBHB255s'
+    # Version (1B), Type (1B), Query ID (4B), followed by every response relayed together (varint length + response)
+    RESPONSE_BATCH_FORMAT = '!BBI'
 
-    # Chunk time (4B), Chunk number (4B)
-    FLOODING_RESPONSE_CHUNK_FORMAT = 'II'
+    # Version (1B), Body length (4B), followed by the body: file identifier, number of chunks (varint) and one chunk number and offset (varints) per chunk,
+    # or just the offset into the full file when no chunks are requested
+    CHUNKS_REQUEST_PREFIX_FORMAT = '!BI'
 
-    # Number of Chunks (1B), Filename (255B String)
-    CHUNKS_REQUEST_INITIAL_FORMAT = '!B255s'
+    # Chunk number (4B), Flags (1B), Payload length (8B), counted from the requested offset
+    CHUNKS_RESPONSE_HEADER_FORMAT = '!IBQ'
+    CHUNKS_RESPONSE_FULL_FILE = 0x01
+    CHUNKS_RESPONSE_CHECKSUM = 0x02
+    # Sent alone, without payload, when the server has no upload slot left for the request
+    CHUNKS_RESPONSE_BUSY = 0x04
 
-    # Chunk number (1B), Full file (1B)
-    CHUNKS_RESPONSE_FILE_SPECIFICATION_FORMAT = '!BB'
+    # CRC32 of the payload (4B), sent after the payload when the checksum flag is set
+    CHUNKS_RESPONSE_CHECKSUM_FORMAT = '!I'
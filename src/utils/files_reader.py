@@ -42,14 +42,28 @@ def read_config_file(ids: list[int]) -> list[dict]:
 
     return components
 
-def read_file_metadata(id, metadata_filename):
-    contents = []
+def read_file_metadata(id: int, metadata_filename: str) -> dict:
+    return parse_file_metadata(Constants.FILES_PATH / str(id) / f'{metadata_filename}')
 
-    with open(Constants.FILES_PATH / str(id) / f'{metadata_filename}', 'r') as f:
-        for i, l in enumerate(f.readlines()):
-            if i == 0:
-                contents.append(l.strip())
-            else:
-                contents.append(int(l))
+def parse_file_metadata(path) -> dict:
+    with open(path, 'r') as f:
+        lines = [l.strip() for l in f if l.strip()]
 
-    return contents
+    numbers = [int(l) for l in lines[1:5]]
+    numbers += [None] * (4 - len(numbers))
+
+    return {
+        'filename': lines[0],
+        'chunks': numbers[0],
+        'ttl': numbers[1],
+        'size': numbers[2],
+        'chunk_size': numbers[3],
+        'file_hash': lines[5] if len(lines) > 5 else None,
+        'chunk_hashes': lines[6:]
+    }
+
+def write_file_metadata(path, metadata: dict):
+    lines = [metadata['filename'], metadata['chunks'], metadata['ttl'], metadata['size'], metadata['chunk_size'], metadata['file_hash'], *metadata['chunk_hashes']]
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(str(l) for l in lines) + '\n')
@@ -0,0 +1,42 @@
+import hashlib
+
+from utils.constants import Constants
+
+def new_hasher():
+    return hashlib.new(Constants.HASH_ALGORITHM)
+
+def hash_and_split(path, chunks, chunk_size = None, write_chunks = False):
+    size = path.stat().st_size
+    chunk_size = chunk_size or -(-size // chunks)
+
+    if chunk_size * chunks < size:
+        raise ValueError(f'{chunks} chunks of {chunk_size} bytes cannot hold {size} bytes')
+
+    file_hasher = new_hasher()
+    chunk_hashes = []
+
+    with open(path, 'rb') as f:
+        for c in range(chunks):
+            chunk_hasher = new_hasher()
+            chunk_file = open(path.parent / f'{path.name}.ch{c}', 'wb') if write_chunks else None
+
+            try:
+                remaining = min(chunk_size, max(0, size - c * chunk_size))
+                while remaining > 0:
+                    block = f.read(min(Constants.TRANSFER_BLOCK_SIZE, remaining))
+                    if not block:
+                        raise EOFError(f'{path} changed while it was being hashed')
+
+                    file_hasher.update(block)
+                    chunk_hasher.update(block)
+                    if chunk_file:
+                        chunk_file.write(block)
+
+                    remaining -= len(block)
+            finally:
+                if chunk_file:
+                    chunk_file.close()
+
+            chunk_hashes.append(chunk_hasher.hexdigest())
+
+    return size, chunk_size, file_hasher.hexdigest(), chunk_hashes
@@ -0,0 +1,23 @@
+import logging
+import sys
+
+from utils.constants import Constants
+
+class _StdoutHandler(logging.Handler):
+    # Looks up sys.stdout on every record, so output redirected by the caller (the benchmarks silence it) is honoured
+    def emit(self, record):
+        try:
+            print(self.format(record), file=sys.stdout)
+        except Exception:
+            self.handleError(record)
+
+_root = logging.getLogger('p2p')
+_root.addHandler(_StdoutHandler())
+_root.propagate = False
+
+def get_logger(name):
+    return _root.getChild(name)
+
+def configure(level = None):
+    # Records below the level are dropped before their message is formatted, so callers pass arguments instead of f-strings
+    _root.setLevel((level or Constants.LOG_LEVEL).upper())
@@ -0,0 +1,119 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a local chunk fetch to a search waiting out its timeout
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Counter:
+    def __init__(self, name, description, labels):
+        self._name = name
+        self._description = description
+        self._labels = labels
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f'# HELP {self._name} {self._description}', f'# TYPE {self._name} counter']
+
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self._name}{_labels(self._labels, label_values)} {value}')
+
+        return lines
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets = DEFAULT_BUCKETS):
+        self._name = name
+        self._description = description
+        self._labels = labels
+        self._buckets = buckets
+
+        # Per label values: a count per bucket (the last one is +Inf), the sum and the number of observations
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self._buckets, value)
+
+        with self._lock:
+            counts, total, observations = self._values.get(label_values) or ([0] * (len(self._buckets) + 1), 0, 0)
+            counts[index] += 1
+            self._values[label_values] = counts, total + value, observations + 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values):
+        with self._lock:
+            values = self._values.get(label_values)
+            return values[2] if values else 0
+
+    def render(self):
+        lines = [f'# HELP {self._name} {self._description}', f'# TYPE {self._name} histogram']
+
+        with self._lock:
+            for label_values, (counts, total, observations) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip((*self._buckets, '+Inf'), counts):
+                    cumulative += count
+                    lines.append(f'{self._name}_bucket{_labels((*self._labels, "le"), (*label_values, bound))} {cumulative}')
+
+                lines.append(f'{self._name}_sum{_labels(self._labels, label_values)} {total}')
+                lines.append(f'{self._name}_count{_labels(self._labels, label_values)} {observations}')
+
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, description, labels = ()):
+        return self._register(Counter, name, description, labels)
+
+    def histogram(self, name, description, labels = (), buckets = DEFAULT_BUCKETS):
+        return self._register(Histogram, name, description, labels, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, kind, name, *args):
+        # Components register the metrics they update when created, and several of them share the same ones
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = kind(name, *args)
+            elif not isinstance(metric, kind):
+                raise ValueError(f'Metric {name} is already registered as a {type(metric).__name__}')
+
+            return metric
+
+def _labels(names, values):
+    if not names:
+        return ''
+
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
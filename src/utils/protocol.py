@@ -0,0 +1,411 @@
+import socket
+import struct
+
+from utils.constants import Constants
+from utils import bitfield
+
+QUERY = 1
+RESPONSE = 2
+# Laid out as a response, sent to peers still downloading a file when chunks of it are acquired
+HAVE = 3
+# Responses to one query relayed together by an intermediate peer
+BATCH = 4
+
+# File identifier: Flags (1B), the content hash (varint length + bytes) when the hash flag is set, then the filename (varint length + UTF-8)
+# Peers that know the file by its hash serve it under their own name for it; the name is the fallback for peers without its metadata
+IDENTIFIER_HASH = 0x01
+
+# Chunk set: Encoding (1B), then either runs of consecutive chunks sharing a sending time (number of runs, then gap, length and time per run),
+# or a bitmap of the chunks from the first one (first chunk, bitmap length, bitmap) followed by runs of times over its set bits
+CHUNK_SET_RUNS = 0
+CHUNK_SET_BITMAP = 1
+
+FLOODING_REQUEST = struct.Struct(Constants.FLOODING_REQUEST_FORMAT)
+FLOODING_RESPONSE = struct.Struct(Constants.FLOODING_RESPONSE_FORMAT)
+RESPONSE_BATCH = struct.Struct(Constants.RESPONSE_BATCH_FORMAT)
+CHUNKS_REQUEST_PREFIX = struct.Struct(Constants.CHUNKS_REQUEST_PREFIX_FORMAT)
+
+class ProtocolError(ValueError):
+    pass
+
+def encode_varint(value, out):
+    if value < 0:
+        raise ProtocolError(f'Cannot encode negative value {value}')
+
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+def decode_varint(data, position):
+    value = 0
+    shift = 0
+
+    while True:
+        if position >= len(data):
+            raise ProtocolError('Truncated varint')
+
+        byte = data[position]
+        position += 1
+
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+
+        shift += 7
+        if shift > 63:
+            raise ProtocolError('Varint too long')
+
+def encode_query(ttl, peer_id, query_id, address, port, filename, file_hash = None):
+    out = bytearray(FLOODING_REQUEST.pack(Constants.PROTOCOL_VERSION, QUERY, ttl, peer_id, query_id, socket.inet_aton(address), port))
+    _encode_identifier(filename, file_hash, out)
+
+    return bytes(out)
+
+def decode_query(data):
+    version, kind, ttl, peer_id, query_id, address, port = _unpack(FLOODING_REQUEST, data, (QUERY,))
+    filename, file_hash, _ = _decode_identifier(data, FLOODING_REQUEST.size)
+
+    return {
+        'ttl': ttl,
+        'peer_id': peer_id,
+        'query_id': query_id,
+        'address': socket.inet_ntoa(address),
+        'port': port,
+        'filename': filename,
+        'file_hash': file_hash
+    }
+
+def encode_responses(peer_id, query_id, address, port, full_file, full_file_time, chunks, load = (0, 0), max_size = None, kind = RESPONSE):
+    max_size = max_size or Constants.UDP_MAX_DATAGRAM_SIZE
+
+    # Every datagram is a complete response for a part of the chunks, the full file is only announced in the first one
+    header = _response_header(kind, peer_id, query_id, address, port, full_file, full_file_time, load)
+    parts = _split_chunks(sorted(chunks.items()), max_size - len(header))
+
+    responses = []
+    for i, part in enumerate(parts):
+        message = _response_header(kind, peer_id, query_id, address, port, full_file and i == 0, full_file_time, load)
+        message += _encode_chunk_set(part)
+
+        responses.append(bytes(message))
+
+    return responses
+
+def decode_response(data):
+    version, kind, query_id, peer_id, address, port, flags, active_uploads, upload_slots = _unpack(FLOODING_RESPONSE, data, (RESPONSE, HAVE))
+    position = FLOODING_RESPONSE.size
+
+    full_file = bool(flags & Constants.FLOODING_RESPONSE_FULL_FILE)
+    full_file_time = 0
+    if full_file:
+        full_file_time, position = decode_varint(data, position)
+
+    chunks, _ = _decode_chunk_set(data, position)
+
+    return {
+        'kind': kind,
+        'query_id': query_id,
+        'peer_id': peer_id,
+        'address': socket.inet_ntoa(address),
+        'port': port,
+        'full_file': full_file,
+        'full_file_time': full_file_time,
+        'load': (active_uploads, upload_slots),
+        'chunks': chunks
+    }
+
+def response_query_id(data):
+    # Responses and batches start alike, the query ID following the version and type
+    return _unpack(RESPONSE_BATCH, data, (RESPONSE, HAVE, BATCH))[2]
+
+def query_ttl(data):
+    # Read from the header without decoding the query, None for other messages
+    if len(data) < 3 or data[1] != QUERY:
+        return None
+
+    return data[2]
+
+def message_kind(data):
+    if len(data) < 2:
+        raise ProtocolError(f'Message of {len(data)} bytes has no type')
+
+    _check_version(data[0])
+    return data[1]
+
+def encode_batches(query_id, responses, max_size = None):
+    max_size = max_size or Constants.UDP_MAX_DATAGRAM_SIZE
+
+    # As many responses as fit go in every batch; a response alone in its datagram is sent as it is
+    groups = []
+    size = 0
+    for response in responses:
+        length = _varint_size(len(response)) + len(response)
+
+        if groups and size + length <= max_size:
+            groups[-1].append(response)
+            size += length
+        else:
+            groups.append([response])
+            size = RESPONSE_BATCH.size + length
+
+    messages = []
+    for group in groups:
+        if len(group) == 1:
+            messages.append(group[0])
+            continue
+
+        batch = bytearray(RESPONSE_BATCH.pack(Constants.PROTOCOL_VERSION, BATCH, query_id))
+        for response in group:
+            _encode_bytes(response, batch)
+
+        messages.append(bytes(batch))
+
+    return messages
+
+def split_responses(data):
+    # The responses carried by a datagram, a batch or a single one
+    if message_kind(data) != BATCH:
+        return [data]
+
+    _unpack(RESPONSE_BATCH, data, (BATCH,))
+    position = RESPONSE_BATCH.size
+
+    responses = []
+    while position < len(data):
+        response, position = _decode_bytes(data, position)
+        responses.append(response)
+
+    return responses
+
+def encode_chunks_request(filename, chunks, offsets = None, file_hash = None):
+    offsets = offsets or {}
+
+    body = bytearray()
+    _encode_identifier(filename, file_hash, body)
+
+    encode_varint(len(chunks), body)
+    for c in chunks:
+        encode_varint(c, body)
+        encode_varint(offsets.get(c, 0), body)
+
+    # A full file request still carries the offset into the file
+    if not chunks:
+        encode_varint(offsets.get(0, 0), body)
+
+    return CHUNKS_REQUEST_PREFIX.pack(Constants.PROTOCOL_VERSION, len(body)) + body
+
+def chunks_request_length(prefix):
+    version, length = CHUNKS_REQUEST_PREFIX.unpack(prefix)
+    _check_version(version)
+
+    return length
+
+def decode_chunks_request(body):
+    filename, file_hash, position = _decode_identifier(body, 0)
+
+    number_of_chunks, position = decode_varint(body, position)
+
+    ranges = []
+    for _ in range(max(1, number_of_chunks)):
+        chunk = 0
+        if number_of_chunks:
+            chunk, position = decode_varint(body, position)
+
+        offset, position = decode_varint(body, position)
+        ranges.append((chunk, offset))
+
+    return number_of_chunks, filename, file_hash, ranges
+
+def _check_chunk_limit(end):
+    if end > Constants.MAX_CHUNKS:
+        raise ProtocolError(f'Chunk set reaches chunk {end}, past the limit of {Constants.MAX_CHUNKS}')
+
+def _check_version(version):
+    if version != Constants.PROTOCOL_VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}, expected {Constants.PROTOCOL_VERSION}')
+
+def _unpack(fmt, data, kinds):
+    if len(data) < fmt.size:
+        raise ProtocolError(f'Message of {len(data)} bytes is shorter than its {fmt.size} bytes header')
+
+    fields = fmt.unpack_from(data)
+    _check_version(fields[0])
+
+    if fields[1] not in kinds:
+        raise ProtocolError(f'Unexpected message type {fields[1]}, expected one of {kinds}')
+
+    return fields
+
+def _varint_size(value):
+    return max(1, -(-value.bit_length() // 7))
+
+def _encode_bytes(value, out):
+    encode_varint(len(value), out)
+    out += value
+
+def _decode_bytes(data, position):
+    length, position = decode_varint(data, position)
+    if position + length > len(data):
+        raise ProtocolError('Truncated field')
+
+    return bytes(data[position:position + length]), position + length
+
+def _encode_identifier(filename, file_hash, out):
+    out.append(IDENTIFIER_HASH if file_hash else 0)
+
+    if file_hash:
+        _encode_bytes(bytes.fromhex(file_hash), out)
+
+    _encode_bytes(filename.encode('utf-8'), out)
+
+def _decode_identifier(data, position):
+    if position >= len(data):
+        raise ProtocolError('Missing file identifier')
+
+    flags = data[position]
+    position += 1
+
+    file_hash = None
+    if flags & IDENTIFIER_HASH:
+        file_hash, position = _decode_bytes(data, position)
+        file_hash = file_hash.hex()
+
+    filename, position = _decode_bytes(data, position)
+
+    try:
+        filename = filename.decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f'File name is not valid UTF-8: {e}') from e
+
+    return filename, file_hash, position
+
+def _response_header(kind, peer_id, query_id, address, port, full_file, full_file_time, load):
+    flags = Constants.FLOODING_RESPONSE_FULL_FILE if full_file else 0
+    active_uploads, upload_slots = (min(value, 0xffff) for value in load)
+
+    header = bytearray(FLOODING_RESPONSE.pack(Constants.PROTOCOL_VERSION, kind, query_id, peer_id, socket.inet_aton(address), port, flags, active_uploads, upload_slots))
+    if full_file:
+        encode_varint(full_file_time, header)
+
+    return header
+
+def _split_chunks(items, max_size):
+    # Halve the announced chunks until each part fits; a single chunk is always sent, however large its encoding
+    if len(items) <= 1 or len(_encode_chunk_set(items)) <= max_size:
+        return [items]
+
+    middle = len(items) // 2
+    return _split_chunks(items[:middle], max_size) + _split_chunks(items[middle:], max_size)
+
+def _time_runs(items):
+    runs = []
+    for chunk, time in items:
+        if runs and runs[-1][0] + runs[-1][1] == chunk and runs[-1][2] == time:
+            runs[-1][1] += 1
+        else:
+            runs.append([chunk, 1, time])
+
+    return runs
+
+def _encode_chunk_set(items):
+    runs = _time_runs(items)
+
+    encoded = bytearray([CHUNK_SET_RUNS])
+    encode_varint(len(runs), encoded)
+
+    end = 0
+    for start, length, time in runs:
+        encode_varint(start - end, encoded)
+        encode_varint(length, encoded)
+        encode_varint(time, encoded)
+        end = start + length
+
+    if len(runs) <= 1:
+        return encoded
+
+    # Scattered chunks with the same times are smaller as a bitmap
+    first = items[0][0]
+    bitmap = bytearray((items[-1][0] - first) // 8 + 1)
+    for chunk, _ in items:
+        bit = chunk - first
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+
+    times = []
+    for _, time in items:
+        if times and times[-1][1] == time:
+            times[-1][0] += 1
+        else:
+            times.append([1, time])
+
+    candidate = bytearray([CHUNK_SET_BITMAP])
+    encode_varint(first, candidate)
+    _encode_bytes(bitmap, candidate)
+
+    encode_varint(len(times), candidate)
+    for count, time in times:
+        encode_varint(count, candidate)
+        encode_varint(time, candidate)
+
+    return candidate if len(candidate) < len(encoded) else encoded
+
+def _decode_chunk_set(data, position):
+    # Decoded into one bitfield of chunks per sending time, without a Python object per chunk
+    if position >= len(data):
+        raise ProtocolError('Missing chunk set')
+
+    encoding = data[position]
+    position += 1
+
+    chunks = {}
+
+    if encoding == CHUNK_SET_RUNS:
+        number_of_runs, position = decode_varint(data, position)
+
+        end = 0
+        for _ in range(number_of_runs):
+            gap, position = decode_varint(data, position)
+            length, position = decode_varint(data, position)
+            time, position = decode_varint(data, position)
+
+            start = end + gap
+            _check_chunk_limit(start + length)
+            chunks[time] = chunks.get(time, 0) | bitfield.from_range(start, length)
+
+            end = start + length
+
+        return chunks, position
+
+    if encoding != CHUNK_SET_BITMAP:
+        raise ProtocolError(f'Unknown chunk set encoding {encoding}')
+
+    first, position = decode_varint(data, position)
+    bitmap, position = _decode_bytes(data, position)
+    present = int.from_bytes(bitmap, 'little')
+    if present:
+        _check_chunk_limit(first + present.bit_length())
+    present <<= first
+
+    number_of_runs, position = decode_varint(data, position)
+
+    runs = []
+    for _ in range(number_of_runs):
+        count, position = decode_varint(data, position)
+        time, position = decode_varint(data, position)
+        runs.append((count, time))
+
+    if sum(count for count, _ in runs) != present.bit_count():
+        raise ProtocolError('Chunk set times do not match its chunks')
+
+    if len(runs) == 1:
+        chunks[runs[0][1]] = present
+        return chunks, position
+
+    index = 0
+    ordered = bitfield.chunks(present)
+    for count, time in runs:
+        chunks[time] = chunks.get(time, 0) | bitfield.from_chunks(ordered[index:index + count])
+        index += count
+
+    return chunks, position
@@ -0,0 +1,42 @@
+import threading
+import time
+from collections import OrderedDict
+
+class SeenCache:
+    def __init__(self, capacity, timeout):
+        self._capacity = capacity
+        self._timeout = timeout
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            if key in self._entries:
+                return False
+
+            self._entries[key] = now
+            if len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+            return True
+
+    def keys(self):
+        with self._lock:
+            self._expire(time.monotonic())
+
+            return list(self._entries)
+
+    def _expire(self, now):
+        while self._entries:
+            key, timestamp = next(iter(self._entries.items()))
+            if now - timestamp < self._timeout:
+                break
+
+            del self._entries[key]
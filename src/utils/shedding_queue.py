@@ -0,0 +1,62 @@
+import itertools
+import threading
+from collections import deque
+
+class SheddingQueue:
+    def __init__(self, capacity, policy = 'oldest'):
+        # A full queue sheds an entry to make room for the new one, so it must be able to hold at least one
+        if capacity < 1:
+            raise ValueError(f'Queue capacity must be at least 1, got {capacity}')
+
+        self._capacity = capacity
+        self._policy = policy
+
+        # One FIFO per priority, entries numbered so they still come out in arrival order
+        self._buckets = {}
+        self._length = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return self._length
+
+    def put(self, item, priority = 0):
+        # Never blocks: when full, the oldest entry ('oldest') or the oldest one of the lowest priority ('lowest') makes room, and is returned
+        with self._condition:
+            shed = None
+
+            if self._length >= self._capacity:
+                if self._policy == 'lowest':
+                    victim = min(self._buckets)
+                    if victim > priority:
+                        return item
+                else:
+                    victim = self._oldest()
+
+                shed = self._pop(victim)
+
+            self._buckets.setdefault(priority, deque()).append((next(self._sequence), item))
+            self._length += 1
+            self._condition.notify()
+
+            return shed
+
+    def get(self):
+        with self._condition:
+            while not self._length:
+                self._condition.wait()
+
+            return self._pop(self._oldest())
+
+    def _oldest(self):
+        return min(self._buckets, key=lambda p: self._buckets[p][0][0])
+
+    def _pop(self, priority):
+        bucket = self._buckets[priority]
+        _, item = bucket.popleft()
+
+        if not bucket:
+            del self._buckets[priority]
+
+        self._length -= 1
+        return item
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from utils.constants import Constants
+
+class TokenBucket:
+    def __init__(self, rate):
+        # Waits are the missing tokens divided by the rate, so a bucket that never refills has no meaning
+        if rate <= 0:
+            raise ValueError(f'Upload speed must be positive, got {rate}')
+
+        self._rate = rate
+        self._capacity = max(1, int(rate * Constants.TOKEN_BUCKET_BURST))
+
+        self._tokens = self._capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+        self._history = deque()
+        self._history_bytes = 0
+        self._total = 0
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def total(self):
+        return self._total
+
+    def reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+
+            self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            self._tokens -= amount
+            self._total += amount
+
+            wait = max(0, -self._tokens / self._rate)
+            self._record(now, wait, amount)
+
+            return wait
+
+    def consume(self, amount):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def consume_async(self, amount):
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def achieved_rate(self):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            if not self._history:
+                return 0
+
+            span = max(now, self._history[-1][1]) - self._history[0][0]
+
+            return self._history_bytes / min(max(span, Constants.TOKEN_BUCKET_BURST), Constants.TOKEN_BUCKET_RATE_WINDOW)
+
+    def _record(self, now, wait, amount):
+        self._history.append((now, now + wait, amount))
+        self._history_bytes += amount
+
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._history and self._history[0][1] < now - Constants.TOKEN_BUCKET_RATE_WINDOW:
+            _, _, amount = self._history.popleft()
+            self._history_bytes -= amount